@@ -1,12 +1,12 @@
 # app/__init__.py
 
 from flask import Flask
-from redis import Redis
-from rq_scheduler import Scheduler
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_bootstrap import Bootstrap
 from flask_sqlalchemy import SQLAlchemy
+from app.database import configure_database, is_sqlite
+from app.metrics import InstrumentedRedis
+from app import metrics, queues
+import os
 
 """
 This file shall contain configurations for the web app
@@ -16,34 +16,172 @@ This file shall contain configurations for the web app
 app = Flask(__name__)
 
 db = SQLAlchemy()
-migrate = Migrate()
-bootstrap = Bootstrap()
+# Created by `create_app`, workers have no use for them
+migrate = None
+bootstrap = None
 # Handles login functionality eg creating and removing login sessions
 login = LoginManager()
 
 
-def create_app():
-    global app, db, migrate, login, bootstrap
+def configure_app():
+    """
+    Read `instance.config` into the app config, set up the database and connect Redis and the task queues.
+    This is all the workers need, see app/worker.py
+    """
+    global app, db
     import instance.config as cfg
     app.config['DEBUG'] = cfg.DEBUG
     app.config['SECRET_KEY'] = 'secretkey'
 
     # database set up
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///Info.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    configure_database(app, cfg)
 
     # Initialize Redis and RQ
-    app.config['REDIS_URL'] = 'redis://'
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    # The queue where periodic tasks are submitted
-    queue_name = 'ann_tasks'
-    app.scheduler = Scheduler(queue_name, connection=app.redis)
+    app.config['REDIS_URL'] = getattr(cfg, 'REDIS_URL', 'redis://')
+    app.redis = InstrumentedRedis.from_url(app.config['REDIS_URL'])
+    # Queues the jobs about subscribers are spread over, see app/queues.py
+    app.config['TASK_QUEUE_SHARDS'] = getattr(cfg, 'TASK_QUEUE_SHARDS', 4)
+    queues.configure(app)
+    # Seconds between the scheduler's checks for due jobs, on the node holding the scheduler lease
+    app.config['SCHEDULER_INTERVAL'] = getattr(cfg, 'SCHEDULER_INTERVAL', 10)
+    # Seconds the lease is held without renewal, another node takes over the scheduler after it runs out
+    app.config['SCHEDULER_LEASE'] = getattr(cfg, 'SCHEDULER_LEASE', 30)
+    # Seconds a user record stays in the Redis cache
+    app.config['USER_CACHE_TTL'] = getattr(cfg, 'USER_CACHE_TTL', 300)
+    # Seconds a session is kept in Redis after the last request that used it
+    app.config['SESSION_TTL'] = getattr(cfg, 'SESSION_TTL', 86400)
+
+    # Password settings
+    # Hash method with its cost, stored hashes with another cost are replaced on login
+    app.config['PASSWORD_HASH_METHOD'] = getattr(cfg, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+    # Processes hashing passwords, per web worker
+    app.config['PASSWORD_WORKERS'] = getattr(cfg, 'PASSWORD_WORKERS', 2)
+    # Requests allowed to wait for a hash, per hashing process
+    app.config['PASSWORD_QUEUE_FACTOR'] = getattr(cfg, 'PASSWORD_QUEUE_FACTOR', 4)
+    # Seconds to wait for a hash before giving up
+    app.config['PASSWORD_TIMEOUT'] = getattr(cfg, 'PASSWORD_TIMEOUT', 5)
+    # Login attempts allowed per window, per phone and per IP address
+    app.config['LOGIN_ATTEMPTS_PER_PHONE'] = getattr(cfg, 'LOGIN_ATTEMPTS_PER_PHONE', 5)
+    app.config['LOGIN_ATTEMPTS_PER_IP'] = getattr(cfg, 'LOGIN_ATTEMPTS_PER_IP', 30)
+    app.config['LOGIN_WINDOW'] = getattr(cfg, 'LOGIN_WINDOW', 300)
+
+    # Admission control of /receiver and /code/, see app/admission.py
+    # Requests a web process works on at the same time, and how many of them are kept for /receiver
+    app.config['ADMISSION_CAPACITY'] = getattr(cfg, 'ADMISSION_CAPACITY', 32)
+    app.config['ADMISSION_RESERVED'] = getattr(cfg, 'ADMISSION_RESERVED', 8)
+    # Overrides of `admission.DEFAULT_LIMITS` per endpoint, e.g. {'code': {'concurrency': 16}}
+    app.config['ADMISSION_LIMITS'] = getattr(cfg, 'ADMISSION_LIMITS', {})
+
+    # Token the network equipment sends to /authorize, checks are open when not set
+    app.config['AUTHORIZATION_TOKEN'] = getattr(cfg, 'AUTHORIZATION_TOKEN', None)
+
+    # Reporting settings
+    # Token dashboards send to /reports, checks are open when not set
+    app.config['REPORTING_TOKEN'] = getattr(cfg, 'REPORTING_TOKEN', None)
+    # Seconds clients may cache a report, and the summary is cached in Redis
+    app.config['REPORT_MAX_AGE'] = getattr(cfg, 'REPORT_MAX_AGE', 60)
+    # Most days returned by /reports/daily
+    app.config['REPORT_MAX_DAYS'] = getattr(cfg, 'REPORT_MAX_DAYS', 366)
+
+    # GPON provisioning settings, see app/provisioning.py
+    app.config['OLTS'] = getattr(cfg, 'OLTS', {})
+    # Commands per action, defaults to `provisioning.DEFAULT_COMMANDS`
+    app.config['OLT_COMMANDS'] = getattr(cfg, 'OLT_COMMANDS', None)
+    # ONT commands written to a session in one go
+    app.config['OLT_BATCH_SIZE'] = getattr(cfg, 'OLT_BATCH_SIZE', 50)
+    # Batches run at the same time across all OLTs
+    app.config['OLT_WORKERS'] = getattr(cfg, 'OLT_WORKERS', 8)
+    # Times the commands that failed are sent again
+    app.config['OLT_RETRIES'] = getattr(cfg, 'OLT_RETRIES', 2)
+
+    # Seconds of traffic summed into one usage record
+    app.config['USAGE_BUCKET'] = getattr(cfg, 'USAGE_BUCKET', 86400)
+
+    # Seconds a worker may spend billing one shard
+    app.config['BILLING_JOB_TIMEOUT'] = getattr(cfg, 'BILLING_JOB_TIMEOUT', 1800)
+
+    # Subscription settings
+    # Number of days a payment keeps a subscriber connected
+    app.config['SUBSCRIPTION_DAYS'] = getattr(cfg, 'SUBSCRIPTION_DAYS', 30)
+    # Price of a period for subscribers without a plan, in cents. Payments add up until they cover it
+    app.config['SUBSCRIPTION_PRICE_CENTS'] = getattr(cfg, 'SUBSCRIPTION_PRICE_CENTS', 100000)
+    # Seconds between runs of the expiry sweeper.
+    # Subscriptions are expired on time by the expiry worker, the sweeper only catches what it missed
+    app.config['SWEEP_INTERVAL'] = getattr(cfg, 'SWEEP_INTERVAL', 3600)
+    # Seconds between runs of the removal of orphaned scheduler jobs
+    app.config['RECONCILE_INTERVAL'] = getattr(cfg, 'RECONCILE_INTERVAL', 86400)
+    # Seconds between updates of the balance snapshots, see app/ledger.py
+    app.config['LEDGER_SNAPSHOT_INTERVAL'] = getattr(cfg, 'LEDGER_SNAPSHOT_INTERVAL', 3600)
+
+    # Reminder settings, see app/notifications.py
+    # Subscribers are reminded when their subscription ends within this many days
+    app.config['NOTIFY_DAYS'] = getattr(cfg, 'NOTIFY_DAYS', 3)
+    # Seconds between searches for subscriptions ending soon
+    app.config['NOTIFY_INTERVAL'] = getattr(cfg, 'NOTIFY_INTERVAL', 3600)
+    # Template of the reminder, in app/templates
+    app.config['NOTIFY_TEMPLATE'] = getattr(cfg, 'NOTIFY_TEMPLATE', 'sms/reminder.txt')
+    # SMS gateway adapter and its settings, the stub prints the messages
+    app.config['SMS_GATEWAY'] = getattr(cfg, 'SMS_GATEWAY', {'adapter': 'stub'})
+    # Subscribers per job, messages per gateway request and gateway requests a job makes at the same time
+    app.config['NOTIFY_BATCH_SIZE'] = getattr(cfg, 'NOTIFY_BATCH_SIZE', 500)
+    app.config['NOTIFY_GATEWAY_BATCH'] = getattr(cfg, 'NOTIFY_GATEWAY_BATCH', 100)
+    app.config['NOTIFY_CONCURRENCY'] = getattr(cfg, 'NOTIFY_CONCURRENCY', 4)
+    # Messages sent per second across all workers
+    app.config['NOTIFY_RATE'] = getattr(cfg, 'NOTIFY_RATE', 200)
+
+    # Payments storage settings, see app/archive.py
+    # Months of payments kept in the payments table, older ones are moved to the archive
+    app.config['PAYMENTS_HOT_MONTHS'] = getattr(cfg, 'PAYMENTS_HOT_MONTHS', 6)
+    # Monthly partitions created ahead of the current month, PostgreSQL only
+    app.config['PAYMENTS_PARTITIONS_AHEAD'] = getattr(cfg, 'PAYMENTS_PARTITIONS_AHEAD', 2)
+    # Directory of the archived months
+    app.config['ARCHIVE_DIR'] = getattr(cfg, 'ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+    # Seconds between runs of the partition maintenance and archiving
+    app.config['ARCHIVE_INTERVAL'] = getattr(cfg, 'ARCHIVE_INTERVAL', 86400)
+
+    # Metrics settings
+    # Token Prometheus sends to /metrics, checks are open when not set
+    app.config['METRICS_TOKEN'] = getattr(cfg, 'METRICS_TOKEN', None)
+    # Seconds each process adds up measurements before adding them to the totals in Redis
+    app.config['METRICS_FLUSH_INTERVAL'] = getattr(cfg, 'METRICS_FLUSH_INTERVAL', 5)
+    metrics.configure(app)
+
+    # Async serving mode settings, see app/asgi.py
+    # Database URI of the async endpoints, e.g. postgresql://..., defaults to SQLALCHEMY_DATABASE_URI
+    app.config['ASYNC_DATABASE_URI'] = getattr(cfg, 'ASYNC_DATABASE_URI', None)
+    # Connections each async process keeps to the database and to Redis
+    app.config['ASYNC_DB_POOL_SIZE'] = getattr(cfg, 'ASYNC_DB_POOL_SIZE', 10)
+    app.config['ASYNC_REDIS_POOL_SIZE'] = getattr(cfg, 'ASYNC_REDIS_POOL_SIZE', 20)
+
+    if 'sqlalchemy' not in app.extensions:
+        db.init_app(app)
+    from app import models
+    return app
+
+
+def create_app():
+    global app, db, migrate, login, bootstrap
+    configure_app()
+    if 'bootstrap' in app.extensions:
+        # Already built in this process, e.g. by a command that also imports the tasks
+        return app
+    from flask_migrate import Migrate
+    from flask_bootstrap import Bootstrap
+    from app.sessions import RedisSessionInterface
+    migrate = Migrate()
+    bootstrap = Bootstrap()
+
+    # Sessions are kept in Redis, the cookie only carries their id
+    app.session_interface = RedisSessionInterface()
 
-    db.init_app(app)
     login.init_app(app)
-    migrate.init_app(app, db)
+    metrics.init_app(app)
+    # SQLite can only alter tables by copying them, which Alembic does in batch mode
+    migrate.init_app(app, db, render_as_batch=is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']))
     bootstrap.init_app(app)
 
-    from app import models, views
+    from app import views, phones
+    # Load phone number metadata now rather than on the first sign up or login
+    phones.preload()
 
     return app
@@ -0,0 +1,156 @@
+# app/admission.py
+
+from flask import current_app, make_response, jsonify
+from functools import wraps
+from app import ingest, metrics
+import threading
+import time
+
+"""
+This module shall contain the admission control of the endpoints that slow down under a payment rush.
+Each web process works on at most `ADMISSION_CAPACITY` of their requests at a time, of which
+`ADMISSION_RESERVED` only go to higher priority endpoints, so the gateway's `/receiver` callbacks
+always find room next to the portal. Each endpoint also has its own limit and a short queue of
+requests waiting for a slot. Requests that don't get in are answered at once with a Retry-After:
+429 when the endpoint is at its limit, 503 when the payments worker is too far behind
+"""
+
+# Per endpoint: requests worked on at the same time, requests waiting for a slot, seconds they wait,
+# priority, payments backlog above which requests are refused, and seconds clients are told to wait.
+# ADMISSION_LIMITS in `instance.config` overrides them per endpoint
+DEFAULT_LIMITS = {
+    # Refused only when the stream is close to trimming callbacks that were never saved
+    'receiver': {'concurrency': 32, 'queue': 256, 'wait': 5, 'priority': 1,
+                 'max_backlog': ingest.STREAM_LENGTH // 2, 'retry_after': 5},
+    # Codes are looked up in the payments table, which is behind by the backlog
+    'code': {'concurrency': 8, 'queue': 16, 'wait': 1, 'priority': 0,
+             'max_backlog': 10000, 'retry_after': 10},
+}
+# Seconds the payments backlog is cached per process
+BACKLOG_TTL = 1
+
+
+class Shed(Exception):
+    """
+    Raised when a request is not admitted
+    """
+
+    def __init__(self, reason, status, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+_condition = threading.Condition()
+# Requests being worked on in this process, in total and per endpoint, and waiting per endpoint
+_in_flight = 0
+_active = {}
+_waiting = {}
+_backlog = (0, 0.0)
+
+
+def limits(endpoint):
+    return dict(DEFAULT_LIMITS.get(endpoint, {}), **current_app.config['ADMISSION_LIMITS'].get(endpoint, {}))
+
+
+def payments_backlog():
+    """
+    The payments backlog, read from Redis at most once every `BACKLOG_TTL` seconds
+    """
+    global _backlog
+    value, read_at = _backlog
+    if time.monotonic() - read_at > BACKLOG_TTL:
+        try:
+            value = ingest.backlog()
+        except Exception as err:
+            # Redis being down is for the endpoint to find out
+            print(err)
+        _backlog = (value, time.monotonic())
+    return value
+
+
+def _can_start(endpoint, settings, capacity, reserved):
+    if _active.get(endpoint, 0) >= settings['concurrency']:
+        return False
+    endpoints = set(DEFAULT_LIMITS) | set(current_app.config['ADMISSION_LIMITS'])
+    if settings['priority'] < max(limits(other)['priority'] for other in endpoints):
+        # Leave the reserved slots to the highest priority
+        if _in_flight >= capacity - reserved:
+            return False
+        # and let waiting higher priorities that have room under their own limit go first
+        for other, count in _waiting.items():
+            other_settings = limits(other)
+            if (count and other_settings['priority'] > settings['priority']
+                    and _active.get(other, 0) < other_settings['concurrency']):
+                return False
+    return _in_flight < capacity
+
+
+def acquire(endpoint):
+    """
+    Wait for a slot for a request to the endpoint
+    :return: seconds waited
+    :raises Shed: if the endpoint's queue is full, no slot came free in time or the backlog is too long
+    """
+    global _in_flight
+    config = current_app.config
+    settings = limits(endpoint)
+    if payments_backlog() > settings['max_backlog']:
+        raise Shed('backlog', 503, settings['retry_after'])
+    capacity, reserved = config['ADMISSION_CAPACITY'], config['ADMISSION_RESERVED']
+    started = time.monotonic()
+    deadline = started + settings['wait']
+    with _condition:
+        if not _can_start(endpoint, settings, capacity, reserved):
+            if _waiting.get(endpoint, 0) >= settings['queue']:
+                raise Shed('queue', 429, settings['retry_after'])
+            _waiting[endpoint] = _waiting.get(endpoint, 0) + 1
+            try:
+                while not _can_start(endpoint, settings, capacity, reserved):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Shed('timeout', 429, settings['retry_after'])
+                    _condition.wait(remaining)
+            finally:
+                _waiting[endpoint] -= 1
+                # A waiting higher priority may have been holding others back
+                _condition.notify_all()
+        _active[endpoint] = _active.get(endpoint, 0) + 1
+        _in_flight += 1
+    return time.monotonic() - started
+
+
+def release(endpoint):
+    global _in_flight
+    with _condition:
+        _active[endpoint] -= 1
+        _in_flight -= 1
+        _condition.notify_all()
+
+
+def admit(endpoint):
+    """
+    Decorator that puts a view behind admission control. Refused requests get
+    {"message": ..., "status": -8} with a Retry-After header
+    :param endpoint: name of the endpoint's limits, see DEFAULT_LIMITS
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                waited = acquire(endpoint)
+            except Shed as shed:
+                metrics.inc('admission_requests_total', (('endpoint', endpoint), ('result', f'shed_{shed.reason}')))
+                resp = make_response(jsonify({'message': "Too busy, try again later", 'status': -8}), shed.status)
+                resp.headers['Retry-After'] = str(shed.retry_after)
+                return resp
+            metrics.inc('admission_requests_total', (('endpoint', endpoint), ('result', 'accepted')))
+            metrics.observe('admission_wait_seconds', (('endpoint', endpoint),), waited, metrics.LATENCY_BUCKETS)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                release(endpoint)
+        return wrapper
+    return decorator
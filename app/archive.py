@@ -0,0 +1,322 @@
+# app/archive.py
+
+from app.models import Payment, PaymentArchive
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import text, func
+from app import db
+import numpy as np
+import shutil
+import json
+import os
+
+"""
+This module shall contain the monthly partitions of the payments table and its archive.
+On PostgreSQL each month of payments is a partition, created ahead of time, and payments outside
+every partition land in `payments_default`. Months older than PAYMENTS_HOT_MONTHS are written to
+the archive and removed from the table, dropping their partition, so the table only holds the
+payments duplicate checks, dashboards and billing read.
+
+The archive keeps one directory per month with a .npy file per column, sorted by creation date.
+Text columns are stored as indices into a sorted array of their distinct values and the M-Pesa codes
+as fixed width bytes, which makes them a fraction of their size in the database while every file
+can still be memory-mapped, so audits read only the pages of the rows they look at
+"""
+
+PARTITION = 'payments_{:%Y_%m}'
+DEFAULT_PARTITION = 'payments_default'
+COLUMNS = ('code', 'sender', 'creation_date', 'amount_cents', 'source', 'scheduled_task_id')
+# Columns stored as indices into an array of their values
+DICTIONARY_COLUMNS = ('sender', 'source', 'scheduled_task_id')
+# Rows read from the database per round trip
+READ_CHUNK = 10000
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def months_between(start, end):
+    """
+    First days of the months from the one of start up to end, exclusive
+    """
+    month = month_start(start)
+    while month < end:
+        yield month
+        month = add_months(month, 1)
+
+
+def is_partitioned():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def hot_start():
+    """
+    First day of the oldest month kept in the payments table
+    """
+    return add_months(month_start(datetime.now()), -current_app.config['PAYMENTS_HOT_MONTHS'])
+
+
+def month_path(month):
+    return os.path.join(current_app.config['ARCHIVE_DIR'], 'payments', f'{month:%Y-%m}')
+
+
+def ensure_partitions():
+    """
+    Create the partitions of this month and of the next PAYMENTS_PARTITIONS_AHEAD months.
+    A partition is filled with the payments of its month already in the default partition and then
+    attached, which doesn't block writes to the other partitions
+    :return: number of partitions created
+    """
+    if not is_partitioned():
+        return 0
+    created = 0
+    month = month_start(datetime.now())
+    for _ in range(current_app.config['PAYMENTS_PARTITIONS_AHEAD'] + 1):
+        name, bounds = PARTITION.format(month), {'start': month, 'end': add_months(month, 1)}
+        if db.session.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar() is None:
+            try:
+                db.session.execute(text(f"CREATE TABLE {name} (LIKE payments INCLUDING DEFAULTS)"))
+                db.session.execute(text(
+                    f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                    f"WHERE creation_date >= :start AND creation_date < :end RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved"
+                ), bounds)
+                db.session.execute(text(
+                    f"ALTER TABLE payments ATTACH PARTITION {name} FOR VALUES FROM (:start) TO (:end)"
+                ), bounds)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            created += 1
+        month = add_months(month, 1)
+    return created
+
+
+def take_month(month):
+    """
+    Remove a month of payments from the table, uncommitted
+    :return: lists of the values of each column
+    """
+    start, end = month, add_months(month, 1)
+    columns = ', '.join(f'"{Payment.__mapper__.columns[name].name}"' for name in COLUMNS)
+    bounds = {'start': start, 'end': end}
+    if is_partitioned():
+        # Stragglers of the month in the default partition, then the month's own partition
+        rows = db.session.execute(text(
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE creation_date >= :start AND creation_date < :end "
+            f"RETURNING {columns}"
+        ), bounds).fetchall()
+        name = PARTITION.format(month)
+        if db.session.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar() is not None:
+            db.session.execute(text(f"ALTER TABLE payments DETACH PARTITION {name}"))
+            rows += db.session.execute(text(f"SELECT {columns} FROM {name}")).fetchall()
+            db.session.execute(text(f"DROP TABLE {name}"))
+    else:
+        rows = []
+        query = db.session.query(*(getattr(Payment, name) for name in COLUMNS)).filter(
+            Payment.creation_date >= start, Payment.creation_date < end,
+        )
+        for row in query.yield_per(READ_CHUNK):
+            rows.append(tuple(row))
+        # Delete what was read, a payment saved in the meantime waits for the next run
+        codes = [row[0] for row in rows]
+        for i in range(0, len(codes), READ_CHUNK):
+            Payment.query.filter(Payment.code.in_(codes[i:i + READ_CHUNK])).delete(synchronize_session=False)
+    return [list(values) for values in zip(*rows)] if rows else [[] for _ in COLUMNS]
+
+
+def encode(columns):
+    """
+    Arrays of the archive files, sorted by creation date, keeping the first payment of each code
+    :param columns: dict of column name to the list of its values
+    """
+    codes = np.array([code.encode() for code in columns['code']], dtype=bytes)
+    dates = np.array(columns['creation_date'], dtype='datetime64[us]')
+    _, first = np.unique(codes, return_index=True)
+    order = first[np.argsort(dates[first], kind='stable')]
+    arrays = {
+        'code': codes[order],
+        'creation_date': dates[order],
+        'amount_cents': np.array(columns['amount_cents'], dtype=np.int64)[order],
+    }
+    for name in DICTIONARY_COLUMNS:
+        values, indices = np.unique(np.array([value or '' for value in columns[name]], dtype=str),
+                                    return_inverse=True)
+        arrays[name] = indices.astype(np.int32)[order]
+        arrays[f'{name}_values'] = values
+    return arrays
+
+
+def decode(arrays):
+    """
+    Lists of the values of each column of an archived month, for rewriting it
+    """
+    columns = {
+        'code': [code.decode() for code in arrays['code']],
+        'creation_date': arrays['creation_date'].tolist(),
+        'amount_cents': arrays['amount_cents'].tolist(),
+    }
+    for name in DICTIONARY_COLUMNS:
+        columns[name] = arrays[f'{name}_values'][arrays[name]].tolist()
+    return columns
+
+
+def write_month(month, arrays):
+    """
+    Replace the files of a month. They are written next to it and swapped in,
+    so readers see either the old month or the new one
+    """
+    path = month_path(month)
+    temporary, previous = f'{path}.tmp', f'{path}.old'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, f'{name}.npy'), array)
+    with open(os.path.join(temporary, 'meta.json'), 'w') as file:
+        json.dump({'month': f'{month:%Y-%m}', 'payments': len(arrays['code']),
+                   'amount_cents': int(arrays['amount_cents'].sum())}, file)
+    if os.path.isdir(path):
+        os.rename(path, previous)
+    os.rename(temporary, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def read_month(month):
+    """
+    Memory-mapped arrays of an archived month, None if the month isn't archived
+    """
+    path = month_path(month)
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+    return {
+        name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+        for name in os.listdir(path) if name.endswith('.npy')
+    }
+
+
+def archive_month(month):
+    """
+    Move a month of payments from the table to the archive. A month archived before is rewritten
+    with the payments saved for it since, so archiving again is safe
+    :return: number of payments archived from the table
+    """
+    month = month_start(month)
+    try:
+        taken = dict(zip(COLUMNS, take_month(month)))
+        archived = read_month(month)
+        if archived is None and not taken['code']:
+            db.session.rollback()
+            return 0
+        columns = decode(archived) if archived is not None else {name: [] for name in COLUMNS}
+        for name in COLUMNS:
+            columns[name] += taken[name]
+        arrays = encode(columns)
+        # Files first: if the commit fails the payments are still in the table and get merged next time
+        write_month(month, arrays)
+        db.session.merge(PaymentArchive(
+            month=month.date(), payments=len(arrays['code']), amount_cents=int(arrays['amount_cents'].sum()),
+            archived_at=datetime.utcnow(),
+        ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(taken['code'])
+
+
+def archive_closed_months():
+    """
+    Archive every month older than PAYMENTS_HOT_MONTHS that still has payments in the table
+    :return: dict of month to number of payments archived
+    """
+    cutoff = hot_start()
+    oldest = db.session.query(func.min(Payment.creation_date)).filter(Payment.creation_date < cutoff).scalar()
+    if oldest is None:
+        return {}
+    return {month: archive_month(month) for month in months_between(oldest, cutoff)}
+
+
+def is_archived(month):
+    return PaymentArchive.query.get(month_start(month).date()) is not None
+
+
+def find_payments(start, end, telephone=None, code=None):
+    """
+    Archived payments from start to end, read from the memory-mapped files
+    :param telephone: only the payments of this E.164 telephone
+    :param code: only the payment with this M-Pesa code
+    :return: list of dicts of Payment columns, oldest first
+    """
+    found = []
+    for month in months_between(start, end):
+        arrays = read_month(month)
+        if arrays is None:
+            continue
+        dates = arrays['creation_date']
+        # Rows are sorted by date, so the period is a slice
+        first = np.searchsorted(dates, np.datetime64(start, 'us'))
+        last = np.searchsorted(dates, np.datetime64(end, 'us'))
+        selected = np.arange(first, last)
+        if telephone is not None:
+            values = arrays['source_values']
+            index = np.searchsorted(values, telephone)
+            if index == len(values) or values[index] != telephone:
+                continue
+            selected = selected[arrays['source'][first:last] == index]
+        if code is not None:
+            selected = selected[arrays['code'][selected] == code.encode()]
+        for i in selected:
+            found.append({
+                'code': arrays['code'][i].decode(),
+                'sender': str(arrays['sender_values'][arrays['sender'][i]]),
+                'creation_date': dates[i].item(),
+                'amount_cents': int(arrays['amount_cents'][i]),
+                'source': str(arrays['source_values'][arrays['source'][i]]),
+                'scheduled_task_id': str(arrays['scheduled_task_id_values'][arrays['scheduled_task_id'][i]]),
+            })
+    return found
+
+
+def codes(month):
+    """
+    M-Pesa codes of an archived month, empty if it isn't archived
+    """
+    arrays = read_month(month)
+    return set() if arrays is None else {code.decode() for code in arrays['code']}
+
+
+def archived_codes(month, codes):
+    """
+    Which of the given M-Pesa codes are in an archived month, compared on the memory-mapped file
+    """
+    arrays = read_month(month)
+    if arrays is None or not codes:
+        return set()
+    codes = list(codes)
+    found = np.isin(np.array([code.encode() for code in codes], dtype=bytes), arrays['code'])
+    return {code for code, archived in zip(codes, found) if archived}
+
+
+def daily_counts():
+    """
+    Payments and revenue per day of every archived month, for rebuilding the daily counters
+    :return: dict of date to (payments, revenue in cents)
+    """
+    counts = {}
+    for archived in PaymentArchive.query:
+        arrays = read_month(datetime.combine(archived.month, datetime.min.time()))
+        if arrays is None or not len(arrays['code']):
+            continue
+        days, inverse = np.unique(arrays['creation_date'].astype('datetime64[D]'), return_inverse=True)
+        payments = np.bincount(inverse)
+        revenue = np.bincount(inverse, weights=arrays['amount_cents'])
+        for day, count, cents in zip(days.tolist(), payments, revenue):
+            counts[day] = (int(count), int(cents))
+    return counts
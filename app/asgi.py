@@ -0,0 +1,153 @@
+# app/asgi.py
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from databases import Database
+from sqlalchemy import select
+from app.models import User
+from app.database import is_sqlite
+from app.sessions import SESSION_KEY, RedisSessionInterface
+from app import authz, cache, ingest, phones, configure_app
+import aioredis
+import json
+
+"""
+This module shall contain the async serving mode of the endpoints called most at peak:
+the M-Pesa callback, the network equipment's /authorize and the portal's /status poll.
+Requests wait on Redis and the database without holding a thread, so one process keeps thousands
+of them in flight. It runs next to the Flask app, which still serves every other page:
+
+    uvicorn app.asgi:app --port 8001
+
+Validation, Redis keys and answers are those of the Flask endpoints in app/views.py
+"""
+
+# The shared helpers read their settings from the Flask app, there is no request context to set up
+flask_app = configure_app()
+flask_app.app_context().push()
+config = flask_app.config
+
+uri = config['ASYNC_DATABASE_URI'] or config['SQLALCHEMY_DATABASE_URI']
+database = Database(uri) if is_sqlite(uri) else Database(
+    uri, min_size=1, max_size=config['ASYNC_DB_POOL_SIZE'],
+)
+redis = None
+
+
+async def startup():
+    global redis
+    await database.connect()
+    redis = await aioredis.create_redis_pool(config['REDIS_URL'], maxsize=config['ASYNC_REDIS_POOL_SIZE'])
+    # Load phone number metadata now rather than on the first callback
+    phones.preload()
+
+
+async def shutdown():
+    redis.close()
+    await redis.wait_closed()
+    await database.disconnect()
+
+
+def message(text, status, status_code):
+    return JSONResponse({'message': text, 'status': status}, status_code=status_code)
+
+
+def bearer_authorized(request, token):
+    return not token or request.headers.get('Authorization') == f'Bearer {token}'
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def status(telephones):
+    """
+    Paid status of a batch of subscribers, as `authz.status`
+    """
+    telephones = list(dict.fromkeys(telephones))
+    if not telephones:
+        return {}
+    values = await redis.mget(*[authz.AUTH_KEY.format(telephone) for telephone in telephones])
+    expiries = {telephone: int(value) for telephone, value in zip(telephones, values) if value is not None}
+    missing = [telephone for telephone in telephones if telephone not in expiries]
+    if missing:
+        rows = await database.fetch_all(select([User.telephone, User.paid, User.date_paid]).where(
+            User.telephone.in_(missing),
+        ))
+        loaded = authz.to_expiries(missing, [(row['telephone'], row['paid'], row['date_paid']) for row in rows])
+        pipe = redis.pipeline()
+        for telephone, ends in loaded.items():
+            pipe.set(authz.AUTH_KEY.format(telephone), int(ends), expire=authz.ttl(ends))
+        await pipe.execute()
+        expiries.update(loaded)
+    return authz.to_statuses(expiries)
+
+
+async def receiver(request):
+    """
+    M-Pesa callback, validated and appended to the stream the payments worker saves from
+    """
+    try:
+        payload, error = ingest.validate_callback(await read_json(request))
+        if error:
+            text, code = error
+            return message(text, code, 401)
+        if payload:
+            transaction = redis.multi_exec()
+            transaction.xadd(ingest.STREAM_KEY, {'payload': json.dumps(payload)}, max_len=ingest.STREAM_LENGTH)
+            transaction.incr(ingest.BACKLOG_KEY)
+            await transaction.execute()
+        return message("Success", 0, 200)
+    except Exception as err:
+        print(err)
+        return message("Error receiving MPESA response", -1, 401)
+
+
+async def authorize(request):
+    """
+    Paid status of up to `authz.MAX_BATCH` subscribers for the OLT/BNG
+    """
+    if not bearer_authorized(request, config['AUTHORIZATION_TOKEN']):
+        return message("Not authorized", -1, 401)
+    data = (await read_json(request) if request.method == 'POST' else None) or {}
+    telephones, error = authz.validate(data, request.query_params.getlist('telephone'))
+    if error:
+        return message(error, -3, 400)
+    normalised = authz.normalise(telephones)
+    statuses = await status([e164 for e164 in normalised.values() if e164])
+    return JSONResponse(authz.answer(normalised, statuses))
+
+
+async def subscriber_status(request):
+    """
+    Paid status of the logged in subscriber, read from the session the Flask app keeps in Redis
+    """
+    sid = request.cookies.get(flask_app.session_cookie_name)
+    session = await redis.get(SESSION_KEY.format(sid)) if sid else None
+    user_id = RedisSessionInterface.serializer.loads(session.decode()).get('_user_id') if session else None
+    if not user_id:
+        return message("Not logged in", -1, 401)
+    record = await redis.get(cache.USER_KEY.format(user_id))
+    if record:
+        telephone = json.loads(record)['telephone']
+    else:
+        telephone = await database.fetch_val(select([User.telephone]).where(User.id == int(user_id)))
+    if not telephone:
+        return message("Not logged in", -1, 401)
+    statuses = await status([telephone])
+    return JSONResponse(dict(statuses[telephone], status=0))
+
+
+app = Starlette(
+    routes=[
+        Route('/receiver', receiver, methods=['POST', 'GET']),
+        Route('/authorize', authorize, methods=['GET', 'POST']),
+        Route('/status', subscriber_status),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
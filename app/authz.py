@@ -0,0 +1,133 @@
+# app/authz.py
+
+from app.phones import process_telephone
+from app.models import User
+from flask import current_app
+from app import db, subscriptions
+import time
+
+"""
+This module shall contain the answer to the question the network equipment asks most:
+is this subscriber paid right now? Each subscriber has a Redis key holding the unix time at which
+their subscription ends, 0 if unpaid, so a batch of subscribers is answered with one MGET.
+Keys expire, so telephones asked about once don't stay in Redis for good
+"""
+
+AUTH_KEY = 'ann:auth:{}'
+# Most subscribers answered per call
+MAX_BATCH = 1000
+# Seconds an unpaid or unregistered telephone is remembered
+UNPAID_TTL = 300
+# Seconds a paid subscriber is remembered after their subscription ends, the expiry worker revokes them by then
+EXPIRY_MARGIN = 3600
+
+
+def ttl(ends):
+    """
+    Seconds to keep the key of a subscriber whose subscription ends at `ends`, 0 if unpaid
+    """
+    return max(UNPAID_TTL, int(ends - time.time()) + EXPIRY_MARGIN) if ends else UNPAID_TTL
+
+
+def grant(expiries):
+    """
+    :param expiries: dict of telephone to the timestamp the subscription ends, 0 if unpaid
+    """
+    if expiries:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for telephone, ends in expiries.items():
+            pipe.set(AUTH_KEY.format(telephone), int(ends), ex=ttl(ends))
+        pipe.execute()
+
+
+def revoke(telephones):
+    grant({telephone: 0 for telephone in telephones})
+
+
+def validate(data, arguments):
+    """
+    Check the telephones of an /authorize call
+    :param data: JSON body of the call, None or {} if it has none
+    :param arguments: the `telephone` query arguments
+    :return: (list of telephones, None) if valid, (None, message) if not
+    """
+    if not isinstance(data, dict):
+        return None, "The body must be a JSON object"
+    telephones = data.get('telephones') or arguments
+    if not telephones:
+        return None, "No telephone received"
+    if not isinstance(telephones, list) or not all(isinstance(telephone, str) for telephone in telephones):
+        return None, "telephones must be a list of strings"
+    if len(telephones) > MAX_BATCH:
+        return None, f"At most {MAX_BATCH} telephones per call"
+    return telephones, None
+
+
+def to_expiries(telephones, rows):
+    """
+    :param rows: (telephone, paid, date_paid) of the registered subscribers among the telephones
+    :return: dict of telephone to the timestamp the subscription ends, 0 if unpaid or unregistered
+    """
+    expiries = {telephone: 0 for telephone in telephones}
+    for telephone, paid, date_paid in rows:
+        if paid and date_paid:
+            expiries[telephone] = subscriptions.to_timestamp(subscriptions.paid_until(date_paid))
+    return expiries
+
+
+def to_statuses(expiries):
+    now = time.time()
+    return {
+        telephone: {'paid': ends > now, 'expires': int(ends) if ends else None}
+        for telephone, ends in expiries.items()
+    }
+
+
+def load(telephones):
+    """
+    Read subscribers missing from Redis from the database and store them
+    :return: dict of telephone to the timestamp the subscription ends, 0 if unpaid
+    """
+    expiries = to_expiries(telephones, db.session.query(User.telephone, User.paid, User.date_paid).filter(
+        User.telephone.in_(telephones)))
+    grant(expiries)
+    return expiries
+
+
+def status(telephones):
+    """
+    Paid status of a batch of subscribers
+    :param telephones: E.164 telephones
+    :return: dict of telephone to {'paid': bool, 'expires': timestamp or None}
+    """
+    telephones = list(dict.fromkeys(telephones))
+    values = current_app.redis.mget([AUTH_KEY.format(telephone) for telephone in telephones])
+    expiries = {telephone: int(value) for telephone, value in zip(telephones, values) if value is not None}
+    missing = [telephone for telephone in telephones if telephone not in expiries]
+    if missing:
+        expiries.update(load(missing))
+    return to_statuses(expiries)
+
+
+def normalise(telephones):
+    """
+    E.164 form of each telephone as it was sent, None for what isn't a phone number
+    """
+    normalised = {}
+    for telephone in telephones:
+        try:
+            normalised[telephone] = process_telephone(telephone)
+        except Exception:
+            normalised[telephone] = None
+    return normalised
+
+
+def answer(normalised, statuses):
+    """
+    Body of an /authorize answer, keyed by the telephones as they were sent
+    """
+    unpaid = {'paid': False, 'expires': None}
+    return {
+        'subscribers': {telephone: statuses.get(e164, unpaid) for telephone, e164 in normalised.items()},
+        'status': 0,
+    }
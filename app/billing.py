@@ -0,0 +1,167 @@
+# app/billing.py
+
+from app.models import User, Payment, Invoice
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from app import db, metering, queues
+import time
+
+"""
+This module shall contain the monthly billing run.
+Subscribers are split into shards by id, each shard is billed by a worker with a few aggregate
+queries and its invoices are written in one bulk insert. A shard replaces its own invoices,
+so a run that stopped part way can be started again and only the missing shards are redone
+"""
+
+RUN_KEY = 'ann:billing:{}'
+DONE_KEY = 'ann:billing:{}:done'
+# Job of a shard of a run, so a run started twice doesn't queue the shard twice
+JOB_ID = 'bill:{}:{}'
+# Statuses of a job that is still going to bill its shard
+PENDING_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+# Invoices inserted per statement
+INSERT_CHUNK = 5000
+
+
+class BillingError(Exception):
+    pass
+
+
+def run_id(start):
+    return start.strftime('%Y-%m-%d')
+
+
+def run_shards(start):
+    """
+    Number of shards the run of a period was started with, None if it wasn't started
+    """
+    shards = current_app.redis.hget(RUN_KEY.format(run_id(start)), 'shards')
+    return None if shards is None else int(shards)
+
+
+def start_run(start, end, shards, restart=False):
+    """
+    Queue one job per shard that has not been billed yet and has no job queued or running
+    :param start: start of the billing period, inclusive
+    :param end: end of the billing period, exclusive
+    :param shards: number of shards to split the subscribers into
+    :param restart: bill every shard again, even those already done, e.g. with another number of shards
+    :return: number of shards queued
+    :raises BillingError: if the run was started with another number of shards and isn't restarted
+    """
+    redis = current_app.redis
+    run = run_id(start)
+    key, done_key = RUN_KEY.format(run), DONE_KEY.format(run)
+    started_with = run_shards(start)
+    if started_with is not None and started_with != shards and not restart:
+        raise BillingError(f"The run of {run} was started with {started_with} shards, "
+                           f"continue it with as many or restart it")
+    if restart:
+        redis.delete(key, done_key)
+    done = {int(shard) for shard in redis.smembers(done_key)}
+    redis.hsetnx(key, 'started', time.time())
+    redis.hset(key, 'shards', shards)
+    queued = 0
+    for shard in range(shards):
+        if shard in done:
+            continue
+        job_id = JOB_ID.format(run, shard)
+        try:
+            job = Job.fetch(job_id, connection=redis)
+        except NoSuchJobError:
+            job = None
+        if job is not None and job.get_status() in PENDING_STATUSES:
+            if not restart:
+                continue
+            # Queued before the restart, maybe for another number of shards: take it off its queue
+            job.cancel()
+        queues.queue_of(shard).enqueue(
+            'app.tasks.bill_shard', start.isoformat(), end.isoformat(), shard, shards,
+            job_id=job_id, job_timeout=current_app.config['BILLING_JOB_TIMEOUT'],
+        )
+        queued += 1
+    return queued
+
+
+def bill_shard(start, end, shard, shards):
+    """
+    Compute and save the invoices of one shard of subscribers
+    :return: number of invoices written, None if the run was restarted with another number of shards
+    """
+    if run_shards(start) not in (None, shards):
+        return None
+    started = time.perf_counter()
+    in_shard = User.id % shards == shard
+
+    # Plan and usage charges of users with a plan
+    rating = metering.rate_usage(start, end, in_shard)
+    charges = {
+        int(user_id): (int(used), int(plan), int(overage))
+        for user_id, used, plan, overage in zip(
+            rating.user_ids, rating.used_bytes, rating.plan_cents, rating.overage_cents,
+        )
+    }
+    # Payments of the period summed per user in one query
+    payments = dict(db.session.query(User.id, func.sum(Payment.amount_cents)).join(
+        Payment, Payment.source == User.telephone,
+    ).filter(
+        in_shard, Payment.creation_date >= start, Payment.creation_date < end,
+    ).group_by(User.id).all())
+
+    now = datetime.utcnow()
+    rows = []
+    for user_id in sorted(set(charges) | set(payments)):
+        used, plan, overage = charges.get(user_id, (0, 0, 0))
+        paid = int(payments.get(user_id) or 0)
+        rows.append({
+            'user_id': user_id, 'period_start': start, 'period_end': end,
+            'plan_cents': plan, 'overage_cents': overage, 'payments_cents': paid,
+            'balance_cents': plan + overage - paid, 'used_bytes': used, 'creation_date': now,
+        })
+
+    try:
+        # Replace what an earlier attempt at this shard wrote
+        Invoice.query.filter(
+            Invoice.period_start == start, Invoice.user_id % shards == shard,
+        ).delete(synchronize_session=False)
+        for i in range(0, len(rows), INSERT_CHUNK):
+            db.session.execute(Invoice.__table__.insert(), rows[i:i + INSERT_CHUNK])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    elapsed = time.perf_counter() - started
+    redis = current_app.redis
+    pipe = redis.pipeline()
+    pipe.sadd(DONE_KEY.format(run_id(start)), shard)
+    # Kept per shard so a shard billed twice is counted once
+    pipe.hset(RUN_KEY.format(run_id(start)), mapping={
+        f'invoices:{shard}': len(rows), f'seconds:{shard}': elapsed, 'finished': time.time(),
+    })
+    pipe.execute()
+    return len(rows)
+
+
+def run_status(start):
+    """
+    Progress and throughput of a billing run
+    """
+    redis = current_app.redis
+    run = {key.decode(): float(value) for key, value in redis.hgetall(RUN_KEY.format(run_id(start))).items()}
+    if not run:
+        return None
+    done = redis.scard(DONE_KEY.format(run_id(start)))
+    invoices = sum(value for key, value in run.items() if key.startswith('invoices:'))
+    wall_seconds = run.get('finished', run['started']) - run['started']
+    return {
+        'shards': int(run.get('shards', 0)),
+        'shards_done': done,
+        'invoices': int(invoices),
+        'wall_seconds': wall_seconds,
+        'invoices_per_second': invoices / wall_seconds if wall_seconds > 0 else None,
+        'worker_seconds': sum(value for key, value in run.items() if key.startswith('seconds:')),
+    }
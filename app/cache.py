@@ -0,0 +1,60 @@
+# app/cache.py
+
+from flask import current_app
+import json
+
+"""
+This module shall contain the Redis cache of frequently read database records
+"""
+
+USER_KEY = 'ann:user:{}'
+# Balance and paid-until date of a subscriber, see `ledger.cached_state`
+ACCOUNT_KEY = 'ann:account:{}'
+
+
+def get_user_record(user_id):
+    """
+    Cached fields of a user, or None on a cache miss
+    """
+    raw = current_app.redis.get(USER_KEY.format(user_id))
+    return json.loads(raw) if raw else None
+
+
+def set_user_record(user_id, record):
+    current_app.redis.setex(
+        USER_KEY.format(user_id), current_app.config['USER_CACHE_TTL'], json.dumps(record),
+    )
+
+
+def invalidate_users(user_ids):
+    """
+    Drop cached users so the next read goes to the database
+    """
+    keys = [USER_KEY.format(user_id) for user_id in user_ids]
+    if keys:
+        current_app.redis.delete(*keys)
+
+
+def get_account_record(user_id):
+    """
+    Cached account of a subscriber, or None on a cache miss
+    """
+    raw = current_app.redis.get(ACCOUNT_KEY.format(user_id))
+    return json.loads(raw) if raw else None
+
+
+def set_account_records(records):
+    """
+    :param records: dict of user id to the fields cached
+    """
+    if records:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, record in records.items():
+            pipe.setex(ACCOUNT_KEY.format(user_id), current_app.config['USER_CACHE_TTL'], json.dumps(record))
+        pipe.execute()
+
+
+def invalidate_accounts(user_ids):
+    keys = [ACCOUNT_KEY.format(user_id) for user_id in user_ids]
+    if keys:
+        current_app.redis.delete(*keys)
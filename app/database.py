@@ -0,0 +1,65 @@
+# app/database.py
+
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+import sqlite3
+
+"""
+This module shall contain the database connection settings.
+PostgreSQL is used for production installs and SQLite for single-node installs
+"""
+
+# Settings applied to every new SQLite connection
+SQLITE_PRAGMAS = {}
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+
+def configure_database(app, cfg):
+    """
+    Read the database settings from `instance.config` into the app config
+    """
+    uri = getattr(cfg, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///Info.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    if is_sqlite(uri):
+        # Seconds a writer waits for the file lock before failing with "database is locked"
+        busy_timeout = getattr(cfg, 'SQLITE_BUSY_TIMEOUT', 15)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': busy_timeout}}
+        SQLITE_PRAGMAS.update({
+            # Readers no longer block the writer and the writer no longer blocks readers
+            'journal_mode': 'WAL',
+            # Safe with WAL, only the last transactions can be lost on power failure
+            'synchronous': getattr(cfg, 'SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'busy_timeout': int(busy_timeout * 1000),
+        })
+        if not event.contains(Engine, 'connect', set_sqlite_pragmas):
+            event.listen(Engine, 'connect', set_sqlite_pragmas)
+    else:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            # Connections kept open per process
+            'pool_size': getattr(cfg, 'DB_POOL_SIZE', 10),
+            # Extra connections opened during bursts and closed once returned
+            'max_overflow': getattr(cfg, 'DB_MAX_OVERFLOW', 20),
+            # Seconds to wait for a free connection
+            'pool_timeout': getattr(cfg, 'DB_POOL_TIMEOUT', 10),
+            # Test connections before use so a database restart does not fail requests
+            'pool_pre_ping': True,
+            # Seconds after which a connection is replaced, below server and firewall idle timeouts
+            'pool_recycle': getattr(cfg, 'DB_POOL_RECYCLE', 1800),
+        }
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Apply the SQLite settings to every new connection
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
@@ -0,0 +1,63 @@
+# app/expiry.py
+
+from flask import current_app
+import time
+
+"""
+This module shall contain the expiry index: a Redis sorted set of user ids scored by the
+unix timestamp at which their subscription ends
+"""
+
+EXPIRY_KEY = 'ann:expiry'
+# List pushed to whenever the index changes so a sleeping worker wakes up early
+WAKE_KEY = 'ann:expiry:wake'
+
+# Atomically read and remove the members that are due, so two workers never expire the same user
+POP_DUE = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+end
+return ids
+"""
+
+
+def track(expiries):
+    """
+    Add or move users in the index
+    :param expiries: dict of user id to expiry timestamp
+    """
+    if not expiries:
+        return
+    pipe = current_app.redis.pipeline()
+    pipe.zadd(EXPIRY_KEY, expiries)
+    pipe.lpush(WAKE_KEY, 1)
+    pipe.ltrim(WAKE_KEY, 0, 0)
+    pipe.execute()
+
+
+def pop_due(timestamp, limit):
+    """
+    Remove and return the ids of users whose subscription ends at or before the timestamp
+    """
+    pop = current_app.redis.register_script(POP_DUE)
+    return [int(user_id) for user_id in pop(keys=[EXPIRY_KEY], args=[timestamp, limit])]
+
+
+def next_deadline():
+    """
+    Timestamp of the earliest expiry in the index, or None if it is empty
+    """
+    earliest = current_app.redis.zrange(EXPIRY_KEY, 0, 0, withscores=True)
+    return earliest[0][1] if earliest else None
+
+
+def wait(timeout):
+    """
+    Block for up to `timeout` seconds or until the index changes
+    """
+    if timeout >= 1:
+        current_app.redis.blpop(WAKE_KEY, timeout=int(timeout))
+    elif timeout > 0:
+        # BLPOP only takes whole seconds and a timeout of 0 blocks forever
+        time.sleep(timeout)
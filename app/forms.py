@@ -1,9 +1,9 @@
 # app/forms.py
 
-import phonenumbers
+from flask import current_app, request
 from flask_wtf import FlaskForm
-from phonenumbers import carrier
 from app.models import User
+from app import phones, limits, passwords
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired
 
@@ -43,26 +43,20 @@ class SignUpForm(FlaskForm):
         if type(telephone) != str:
             self.telephone.errors.append("Unable to determine phone number")
             return False
-        region = "KE"
-        # Create a `PhoneNumber` object from a string representing a phone number
-        # Specify country of origin of phone number.
-        # This maybe unnecessary for numbers starting with '+' since they are globally unique.
-        phone = phonenumbers.parse(telephone, region)
+        # Parse the phone number, served from cache for numbers seen before
+        phone = phones.lookup(telephone)
         # Check whether it's a possible number (e.g. it has the right number of digits)
-        if not phonenumbers.is_possible_number(phone):
+        if not phone.possible:
             self.telephone.errors.append("Possibly not a number. Check if e.g. number of digits is correct")
             return False
         # Check whether it's a valid number (e.g. it's in an assigned exchange)
-        if not phonenumbers.is_valid_number_for_region(phone, region):
+        if not phone.valid:
             self.telephone.errors.append("Invalid phone number")
             return False
-        # Format number as per international format code E164
-        phone_number = phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164)
-        # Get the carrier of the phone number
-        operator = carrier.name_for_number(phone, "en") if carrier.name_for_number(phone, "en") else ''
-        print(phone_number, operator)
+        # Number in international format code E164
+        phone_number = phone.e164
         # Ensure phone is Safaricom
-        if operator != "Safaricom":
+        if phone.carrier != "Safaricom":
             self.telephone.errors.append("Kindly use a Safaricom line for MPESA prompt")
             return False
         # If telephone is previously, raise error
@@ -84,6 +78,12 @@ class LoginForm(FlaskForm):
         if not rv:
             return False
 
+        # Turn away floods before any password hashing is done
+        config = current_app.config
+        if not limits.hit('login:ip', request.remote_addr, config['LOGIN_ATTEMPTS_PER_IP'], config['LOGIN_WINDOW']):
+            self.submit.errors.append("Too many login attempts. Try again in a few minutes")
+            return False
+
         password = self.password.data
         if len(password) < 8 or len(password) > 100:
             self.password.errors.append("Please enter a password of between 8 and 100 characters")
@@ -96,28 +96,25 @@ class LoginForm(FlaskForm):
         if type(telephone) != str:
             self.telephone.errors.append("Unable to determine phone number")
             return False
-        region = "KE"
-        # Create a `PhoneNumber` object from a string representing a phone number
-        # Specify country of origin of phone number.
-        # This maybe unnecessary for numbers starting with '+' since they are globally unique.
-        phone = phonenumbers.parse(telephone, region)
+        # Parse the phone number, served from cache for numbers seen before
+        phone = phones.lookup(telephone)
         # Check whether it's a possible number (e.g. it has the right number of digits)
-        if not phonenumbers.is_possible_number(phone):
+        if not phone.possible:
             self.telephone.errors.append("Possibly not a number. Check if e.g. number of digits is correct")
             return False
         # Check whether it's a valid number (e.g. it's in an assigned exchange)
-        if not phonenumbers.is_valid_number_for_region(phone, region):
+        if not phone.valid:
             self.telephone.errors.append("Invalid phone number")
             return False
-        # Format number as per international format code E164
-        phone_number = phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164)
-        # Get the carrier of the phone number
-        operator = carrier.name_for_number(phone, "en") if carrier.name_for_number(phone, "en") else ''
-        print(phone_number, operator)
+        # Number in international format code E164
+        phone_number = phone.e164
         # Ensure phone is Safaricom
-        if operator != "Safaricom":
+        if phone.carrier != "Safaricom":
             self.telephone.errors.append("Kindly use a Safaricom line for MPESA prompt")
             return False
+        if not limits.hit('login:phone', phone_number, config['LOGIN_ATTEMPTS_PER_PHONE'], config['LOGIN_WINDOW']):
+            self.telephone.errors.append("Too many login attempts. Try again in a few minutes")
+            return False
         # If telephone is not registered, raise error
         user = User.query.filter_by(telephone=phone_number).first()
         if not user:
@@ -125,9 +122,20 @@ class LoginForm(FlaskForm):
             return False
 
         # confirm user's password
-        if not user.verify_password(password):
-            self.password.errors.append("Invalid password")
-            return False
+        try:
+            if not user.verify_password(password):
+                self.password.errors.append("Invalid password")
+                return False
+            # Hash made with old cost parameters, replace it while the password is at hand
+            if passwords.needs_rehash(user.password_hash):
+                user.set_password(password)
+                user.save()
+        except passwords.PasswordBusy:
+            self.submit.errors.append("The server is busy. Try again shortly")
+            return False
+        limits.reset('login:phone', phone_number)
+        # Logged in user, so the view doesn't look it up again
+        self.user = user
 
         return True
 
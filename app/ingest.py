@@ -0,0 +1,401 @@
+# app/ingest.py
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.phones import process_telephone
+from app.models import User, Payment, PaymentCode
+from redis.exceptions import ResponseError
+from sqlalchemy.exc import OperationalError
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import text
+from app import db, archive, ledger, reporting, subscriptions
+import socket
+import json
+import time
+import sys
+
+"""
+This module shall contain the ingestion of M-Pesa callbacks.
+`/receiver` appends each callback to a Redis stream and the payments worker saves them in batches
+"""
+
+STREAM_KEY = 'ann:mpesa:callbacks'
+GROUP = 'payments'
+# Callbacks queued and not yet saved, counted as they are added and acknowledged
+# and reset from the stream every BACKLOG_RESYNC_INTERVAL seconds by the payments worker
+BACKLOG_KEY = 'ann:mpesa:backlog'
+BACKLOG_RESYNC_INTERVAL = 60
+# Callbacks for telephones that are not registered, kept for reconciliation
+UNMATCHED_KEY = 'ann:mpesa:unmatched'
+# Callbacks that could not be saved after MAX_DELIVERIES reads, with the error, kept for reconciliation
+DEAD_KEY = 'ann:mpesa:dead'
+MAX_DELIVERIES = 5
+# Approximate number of entries kept in the streams, far above what is ever left unprocessed
+STREAM_LENGTH = 1000000
+# Smallest payment accepted, in cents
+MINIMUM_AMOUNT = 500
+# Entries counted per XRANGE by RESYNC_BACKLOG
+RESYNC_PAGE = 1000
+
+# Acknowledge entries and take them off the backlog in one step
+ACKNOWLEDGE = """
+local acknowledged = 0
+for i = 2, #ARGV do
+    acknowledged = acknowledged + redis.call('XACK', KEYS[1], ARGV[1], ARGV[i])
+end
+redis.call('DECRBY', KEYS[2], acknowledged)
+return acknowledged
+"""
+# Set the backlog to the entries read but not acknowledged plus those the group has not read yet.
+# Redis 7 reports the latter as the group's lag; older versions, or a lag Redis can't tell after
+# a trim, count them after the last entry delivered, a page at a time
+RESYNC_BACKLOG = """
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1])[1]
+local lag, last
+for _, group in ipairs(redis.call('XINFO', 'GROUPS', KEYS[1])) do
+    local fields = {}
+    for i = 1, #group, 2 do
+        fields[group[i]] = group[i + 1]
+    end
+    if fields['name'] == ARGV[1] then
+        lag, last = fields['lag'], fields['last-delivered-id']
+    end
+end
+if not last then
+    return redis.error_reply('NOGROUP ' .. ARGV[1])
+end
+if type(lag) ~= 'number' then
+    lag = 0
+    local page = tonumber(ARGV[2])
+    while true do
+        local entries = redis.call('XRANGE', KEYS[1], last, '+', 'COUNT', page + 1)
+        local count = #entries
+        if count > 0 and entries[1][1] == last then
+            count = count - 1
+        end
+        lag = lag + count
+        if #entries <= page then
+            break
+        end
+        last = entries[#entries][1]
+    end
+end
+redis.call('SET', KEYS[2], pending + lag)
+return pending + lag
+"""
+
+# SQLite: a write that changes nothing, run first so the transaction holds the write lock until its commit
+TAKE_WRITE_LOCK = text('DELETE FROM payment_codes WHERE 0')
+# PostgreSQL: claim the codes in `payment_codes` and save the payments of the codes claimed, in one statement.
+# Payments are only unique per month there, a retry stamped with another date would be saved again
+CLAIM_AND_INSERT = text("""
+    WITH batch AS (
+        SELECT * FROM unnest(
+            CAST(:codes AS text[]), CAST(:senders AS text[]), CAST(:dates AS timestamp[]),
+            CAST(:amounts AS integer[]), CAST(:sources AS varchar[])
+        ) AS batch (code, sender, creation_date, amount_cents, source)
+    ), claimed AS (
+        INSERT INTO payment_codes (code) SELECT code FROM batch ON CONFLICT DO NOTHING RETURNING code
+    )
+    INSERT INTO payments (code, sender, creation_date, amount_cents, "User", scheduled_task_id)
+    SELECT code, sender, creation_date, amount_cents, source, '' FROM batch JOIN claimed USING (code)
+    ON CONFLICT DO NOTHING
+    RETURNING code
+""")
+
+
+def validate_callback(data):
+    """
+    Check an M-Pesa callback without touching the database
+    :return: (payment fields, None) if valid, (None, (message, status)) if not.
+             Both are None for the gateway's sample callback, which is acknowledged but not saved
+    """
+    if not data:
+        return None, ("No data received", -2)
+
+    sender, amount, date = data.get('sender', ''), data.get('amount', 'Ksh0.00'), data.get('date', '0')
+    phone, _id = data.get('phone'), data.get('id')
+
+    if not phone:
+        return None, ("No phone number received", -3)
+    if not _id:
+        return None, ("No MPESA code received", -3)
+    if not amount:
+        return None, ("No amount received", -3)
+
+    if not date or int(date) == 0:
+        date = datetime.now()
+    else:
+        date = datetime.fromtimestamp(int(date) / 1000.0)
+
+    if sender == 'Sample sender':
+        return None, None
+
+    amount_cents = Payment.parse_amount(amount)
+    if not amount_cents:
+        return None, ("No amount received", -6)
+    if amount_cents < MINIMUM_AMOUNT:
+        return None, ("1000/= needed for internet connection", -7)
+
+    return {
+        'code': _id,
+        'sender': sender,
+        'creation_date': date.isoformat(),
+        'amount_cents': amount_cents,
+        'source': process_telephone(phone),
+    }, None
+
+
+def enqueue(payload):
+    """
+    Append a validated callback to the stream. Returns once Redis has it
+    """
+    pipe = current_app.redis.pipeline()
+    pipe.xadd(STREAM_KEY, {'payload': json.dumps(payload)}, maxlen=STREAM_LENGTH)
+    pipe.incr(BACKLOG_KEY)
+    pipe.execute()
+
+
+def backlog():
+    """
+    Number of callbacks waiting for the payments worker, without reading the stream
+    """
+    return max(0, int(current_app.redis.get(BACKLOG_KEY) or 0))
+
+
+def resync_backlog():
+    """
+    Reset the backlog from the stream, undoing the drift of the counter, e.g. callbacks trimmed before
+    they were read or a worker stopping between saving a batch and acknowledging it
+    :return: the backlog
+    """
+    resync = current_app.redis.register_script(RESYNC_BACKLOG)
+    return resync(keys=[STREAM_KEY, BACKLOG_KEY], args=[GROUP, RESYNC_PAGE])
+
+
+def insert_ignoring_duplicates(table):
+    """
+    INSERT that skips rows whose primary key already exists, instead of a lookup before every insert
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return pg_insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def skip_archived(rows):
+    """
+    Leave out the rows whose code is in the archive. Only rows dated in an archived month are looked up,
+    codes saved since `payment_codes` exists are in it whether archived or not
+    """
+    hot_start = archive.hot_start()
+    old = {}
+    for row in rows:
+        if row['creation_date'] < hot_start:
+            old.setdefault(archive.month_start(row['creation_date']), []).append(row['code'])
+    archived = set()
+    for month, codes in old.items():
+        archived |= archive.archived_codes(month, codes)
+    return [row for row in rows if row['code'] not in archived] if archived else rows
+
+
+def record_payments(rows):
+    """
+    Save payments, skipping M-Pesa codes that were ever saved, and add them to the daily counters
+    and the ledger. Changes are left uncommitted
+    :param rows: dicts of Payment columns
+    :return: (the rows that were inserted, dict of user id to (telephone, paid-until date) of the
+             subscribers they paid for), pass the latter to `subscriptions.activate` once committed
+    """
+    unique = {}
+    for row in rows:
+        # Gateway retries can put the same code in one batch twice
+        unique.setdefault(row['code'], row)
+    rows = skip_archived(list(unique.values()))
+    if not rows:
+        return [], {}
+    if db.engine.dialect.name == 'postgresql':
+        inserted = {code for code, in db.session.execute(CLAIM_AND_INSERT, {
+            'codes': [row['code'] for row in rows], 'senders': [row['sender'] for row in rows],
+            'dates': [row['creation_date'] for row in rows], 'amounts': [row['amount_cents'] for row in rows],
+            'sources': [row['source'] for row in rows],
+        })}
+    else:
+        inserted = claim_codes([row['code'] for row in rows])
+        values = [
+            {
+                'code': row['code'], 'sender': row['sender'], 'creation_date': row['creation_date'],
+                'amount_cents': row['amount_cents'], 'User': row['source'], 'scheduled_task_id': '',
+            }
+            for row in rows if row['code'] in inserted
+        ]
+        if values:
+            db.session.execute(insert_ignoring_duplicates(Payment.__table__), values)
+    rows = [row for row in rows if row['code'] in inserted]
+    reporting.count_payments(rows)
+    return rows, ledger.post_payments(rows)
+
+
+class ActivationError(Exception):
+    """
+    Raised when payments were saved but their subscribers could not be activated.
+    The entries stay pending and the retry activates them from the ledger
+    """
+    pass
+
+
+def claim_codes(codes):
+    """
+    SQLite: add the codes that are not in `payment_codes` yet. The transaction takes the database's
+    single write lock first, so no other worker can claim a code between the lookup and the insert
+    :return: set of codes claimed
+    """
+    db.session.execute(TAKE_WRITE_LOCK)
+    claimed = set(codes)
+    for chunk in subscriptions.chunks(list(claimed)):
+        claimed -= {code for code, in db.session.query(PaymentCode.code).filter(PaymentCode.code.in_(chunk))}
+    if claimed:
+        db.session.execute(PaymentCode.__table__.insert(), [{'code': code} for code in claimed])
+    return claimed
+
+
+def ensure_group():
+    try:
+        current_app.redis.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except ResponseError as err:
+        # The group already exists
+        if 'BUSYGROUP' not in str(err):
+            raise
+
+
+def process_batch(entries):
+    """
+    Save a batch of stream entries
+    :param entries: list of (entry id, fields)
+    :return: number of payments inserted
+    """
+    # Entries trimmed from the stream while pending come back without fields
+    payments = [json.loads(fields[b'payload']) for _, fields in entries if fields]
+    for payment in payments:
+        payment['creation_date'] = datetime.fromisoformat(payment['creation_date'])
+    telephones = {payment['source'] for payment in payments}
+    registered = {telephone for telephone, in db.session.query(User.telephone).filter(
+        User.telephone.in_(telephones),
+    )}
+    matched = [payment for payment in payments if payment['source'] in registered]
+    try:
+        inserted, paid_until = record_payments(matched)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    try:
+        # Codes saved before, e.g. by an attempt that failed after its commit, are activated again
+        saved_before = {payment['code'] for payment in matched} - {row['code'] for row in inserted}
+        if saved_before:
+            paid_until = {**ledger.charged_by(saved_before), **paid_until}
+        subscriptions.activate(paid_until)
+        pipe = current_app.redis.pipeline()
+        for payment in payments:
+            if payment['source'] not in registered:
+                current_app.logger.warning(f"Payment {payment['code']} from unregistered {payment['source']}")
+                payment['creation_date'] = payment['creation_date'].isoformat()
+                pipe.xadd(UNMATCHED_KEY, {'payload': json.dumps(payment)}, maxlen=STREAM_LENGTH)
+        pipe.execute()
+    except Exception as err:
+        db.session.rollback()
+        raise ActivationError(f"{len(inserted)} payments saved but not activated: {err}") from err
+    return len(inserted)
+
+
+def acknowledge(entry_ids):
+    """
+    Remove saved entries from the consumer group's pending list and from the backlog
+    :return: number of entries acknowledged
+    """
+    ack = current_app.redis.register_script(ACKNOWLEDGE)
+    return ack(keys=[STREAM_KEY, BACKLOG_KEY], args=[GROUP, *entry_ids])
+
+
+def deliveries(entries, consumer):
+    """
+    :param entries: list of (entry id, fields) pending for the consumer, in stream order
+    :return: the most times any of the entries was read
+    """
+    pending = current_app.redis.xpending_range(STREAM_KEY, GROUP, entries[0][0], entries[-1][0], len(entries),
+                                               consumer)
+    return max((item['times_delivered'] for item in pending), default=0)
+
+
+def settle(entries):
+    """
+    Save the entries of a batch that keeps failing one at a time, so one bad callback doesn't hold back
+    the others, and move those that still fail to DEAD_KEY. Stops at the first error of the database itself,
+    or of activating a saved payment, which are not the entry's fault, and leaves the rest pending
+    :return: (number of payments inserted, number moved to DEAD_KEY)
+    """
+    inserted = dead = 0
+    for entry_id, fields in entries:
+        try:
+            inserted += process_batch([(entry_id, fields)])
+        except (OperationalError, ActivationError):
+            raise
+        except Exception as err:
+            db.session.rollback()
+            print(err)
+            current_app.logger.exception(f"Unable to save payment {entry_id}", exc_info=sys.exc_info())
+            current_app.redis.xadd(DEAD_KEY, dict(fields or {}, entry=entry_id, error=str(err)), maxlen=STREAM_LENGTH)
+            dead += 1
+        acknowledge([entry_id])
+    return inserted, dead
+
+
+def run_consumer(consumer=None, batch_size=500, block=5000):
+    """
+    Drain the callback stream in batches. Entries are acknowledged only once saved,
+    so callbacks read by a worker that crashed are picked up again on restart. A batch read
+    MAX_DELIVERIES times is saved one entry at a time, see `settle`. The backlog is reset from
+    the stream every BACKLOG_RESYNC_INTERVAL seconds
+    :param consumer: name of this worker in the consumer group
+    :param batch_size: most entries saved per transaction
+    :param block: milliseconds to wait for new entries
+    """
+    consumer = consumer or socket.gethostname()
+    redis = current_app.redis
+    ensure_group()
+    # Start with the entries this consumer read but did not acknowledge
+    last_id = '0'
+    resynced = 0.0
+    while True:
+        if time.monotonic() - resynced > BACKLOG_RESYNC_INTERVAL:
+            try:
+                resync_backlog()
+            except Exception as err:
+                print(err)
+                current_app.logger.exception("Unable to resync the payments backlog", exc_info=sys.exc_info())
+            resynced = time.monotonic()
+        response = redis.xreadgroup(GROUP, consumer, {STREAM_KEY: last_id}, count=batch_size, block=block)
+        entries = response[0][1] if response else []
+        if not entries:
+            if last_id == '0':
+                # Backlog done, move on to new entries
+                last_id = '>'
+            continue
+        try:
+            inserted = process_batch(entries)
+        except Exception as err:
+            print(err)
+            current_app.logger.exception("Unable to save payments", exc_info=sys.exc_info())
+            # Retry the entries still pending for this consumer, one at a time once they were read too often
+            last_id = '0'
+            try:
+                if deliveries(entries, consumer) >= MAX_DELIVERIES:
+                    inserted, dead = settle(entries)
+                    print(f"Saved {inserted} of {len(entries)} payments one at a time, {dead} moved to {DEAD_KEY}")
+                    continue
+            except Exception as err:
+                print(err)
+                current_app.logger.exception("Unable to save payments one at a time", exc_info=sys.exc_info())
+            time.sleep(1)
+            continue
+        acknowledge([entry_id for entry_id, _ in entries])
+        print(f"Saved {inserted} of {len(entries)} payments")
@@ -0,0 +1,138 @@
+# app/leader.py
+
+from flask import current_app
+from uuid import uuid4
+import socket
+import signal
+import time
+import sys
+import os
+
+"""
+This module shall contain the election of the node that runs the scheduler.
+Every node may run `flask scheduler`; the one holding a lease in Redis moves due jobs to the queues
+and renews the lease, the others check for it every interval. When the leader stops or loses Redis,
+its lease runs out and another node takes over within `SCHEDULER_LEASE` seconds. A long pass over
+due jobs renews the lease as it goes and stops as soon as the lease is lost, so two nodes never
+move jobs at the same time
+"""
+
+LEASE_KEY = 'ann:leader:{}'
+
+# Extend or give up the lease only if this process still holds it
+RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease:
+    """
+    A lock in Redis that expires unless its holder renews it
+    """
+
+    def __init__(self, name, ttl, redis=None):
+        self.redis = redis or current_app.redis
+        self.key = LEASE_KEY.format(name)
+        self.ttl = ttl
+        self.token = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex}'
+        self.held = False
+        # monotonic time of the last successful take or renewal
+        self.renewed = 0.0
+
+    def acquire(self):
+        """
+        Renew the lease if this process holds it, or take it if it is free
+        :return: True while this process holds the lease
+        """
+        # Taken before the round trip, the lease may have started running out as the request left
+        started = time.monotonic()
+        if self.held:
+            renew = self.redis.register_script(RENEW)
+            self.held = bool(renew(keys=[self.key], args=[self.token, int(self.ttl * 1000)]))
+        if not self.held:
+            self.held = bool(self.redis.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)))
+        if self.held:
+            self.renewed = started
+        return self.held
+
+    def remaining(self):
+        """
+        :return: seconds left on the lease as of its last renewal, 0 if it is not held
+        """
+        return max(0.0, self.ttl - (time.monotonic() - self.renewed)) if self.held else 0.0
+
+    def release(self):
+        if self.held:
+            release = self.redis.register_script(RELEASE)
+            release(keys=[self.key], args=[self.token])
+            self.held = False
+
+
+def holder(name):
+    """
+    :return: the host, process id and token of the lease's holder, or None if nobody holds it
+    """
+    token = current_app.redis.get(LEASE_KEY.format(name))
+    return token.decode() if token else None
+
+
+def enqueue_due(scheduler, lease):
+    """
+    Move the due jobs to the queues, renewing the lease once a third of it is used up
+    :return: number of jobs moved, which stops short if the lease is lost
+    """
+    moved = 0
+    for job in scheduler.get_jobs_to_queue():
+        if lease.remaining() < lease.ttl * 2 / 3 and not lease.acquire():
+            break
+        scheduler.enqueue_job(job)
+        moved += 1
+    return moved
+
+
+def run_scheduler(interval=None, ttl=None):
+    """
+    Move due jobs from the scheduler to the queues while this node holds the scheduler lease,
+    and wait to take it over otherwise
+    """
+    interval = interval or current_app.config['SCHEDULER_INTERVAL']
+    ttl = ttl or current_app.config['SCHEDULER_LEASE']
+    if interval >= ttl:
+        raise ValueError("The scheduler interval must be shorter than its lease")
+    scheduler = current_app.scheduler
+    lease = Lease('scheduler', ttl)
+    # Leave through the `finally` so the lease is given up rather than left to run out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    leading = False
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                if lease.acquire():
+                    if not leading:
+                        current_app.logger.info(f"Scheduler lease taken by {lease.token}")
+                    enqueue_due(scheduler, lease)
+                # Lost before this pass or during it
+                if leading and not lease.held:
+                    current_app.logger.warning(f"Scheduler lease lost to {holder('scheduler')}")
+                leading = lease.held
+            except Exception as err:
+                print(err)
+                current_app.logger.exception("Unable to run the scheduler", exc_info=sys.exc_info())
+                # Redis may be gone; the lease is renewed next time if nobody took it over meanwhile
+                leading = False
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        try:
+            lease.release()
+        except Exception:
+            pass
@@ -0,0 +1,306 @@
+# app/ledger.py
+
+from app.models import User, Plan, LedgerEntry, LedgerSnapshot
+from sqlalchemy import text, func, bindparam, and_, or_, event
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db, cache, subscriptions
+import sys
+
+"""
+This module shall contain the subscriber ledger.
+Every payment is added to the subscriber's account as it is saved, and each full price in the
+account is charged for a period that starts when the previous one ends, so partial payments add up
+and a payment of several periods buys all of them. `users.paid` and `users.date_paid` are kept
+in line with the ledger for the sweeper, the expiry index and authorization.
+A subscriber's balance and paid-until date are their snapshot plus the few entries after it,
+and are cached in Redis for the dashboard until an entry is added
+"""
+
+SUBSCRIBER, MPESA, REVENUE = 'subscriber', 'mpesa', 'revenue'
+
+State = namedtuple('State', ['entry_id', 'balance_cents', 'paid_until'])
+EMPTY = State(0, 0, None)
+# Key of `Session.info` holding the subscribers whose cached account is dropped at the commit
+STALE_ACCOUNTS = 'ledger_stale_accounts'
+
+UPSERT_SNAPSHOT = text("""
+    INSERT INTO ledger_snapshots (user_id, entry_id, balance_cents, paid_until, taken_at)
+    VALUES (:user_id, :entry_id, :balance_cents, :paid_until, :taken_at)
+    ON CONFLICT (user_id) DO UPDATE SET
+        entry_id = excluded.entry_id,
+        balance_cents = excluded.balance_cents,
+        paid_until = excluded.paid_until,
+        taken_at = excluded.taken_at
+""")
+
+
+def states(user_ids):
+    """
+    Current balance and paid-until date of subscribers, from their snapshot and the entries after it
+    :return: dict of user id to State, subscribers without entries are left out
+    """
+    user_ids = list(user_ids)
+    current = {}
+    for chunk in subscriptions.chunks(user_ids):
+        for snapshot in LedgerSnapshot.query.filter(LedgerSnapshot.user_id.in_(chunk)):
+            current[snapshot.user_id] = State(snapshot.entry_id, snapshot.balance_cents, snapshot.paid_until)
+        # A bound per subscriber, so each tail is a seek on (user_id, id) however long the history
+        after = [and_(LedgerEntry.user_id == user_id, LedgerEntry.id > current[user_id].entry_id)
+                 for user_id in chunk if user_id in current]
+        tails = db.session.query(
+            LedgerEntry.user_id, func.max(LedgerEntry.id), func.sum(LedgerEntry.amount_cents),
+            func.max(LedgerEntry.paid_until),
+        ).filter(or_(
+            LedgerEntry.user_id.in_([user_id for user_id in chunk if user_id not in current]), *after,
+        )).group_by(LedgerEntry.user_id)
+        for user_id, entry_id, amount, paid_until in tails:
+            _, balance, paid_until_before = current.get(user_id, EMPTY)
+            if paid_until_before and (paid_until is None or paid_until_before > paid_until):
+                paid_until = paid_until_before
+            current[user_id] = State(entry_id, balance + int(amount or 0), paid_until)
+    return current
+
+
+def state(user_id):
+    return states([user_id]).get(user_id, EMPTY)
+
+
+def account_record(account):
+    """
+    Fields of a State kept in the account cache
+    """
+    return {
+        'balance_cents': account.balance_cents,
+        'paid_until': account.paid_until.isoformat() if account.paid_until else None,
+    }
+
+
+def cached_state(user_id):
+    """
+    Balance and paid-until date of a subscriber, served from Redis when possible
+    :return: State, without the entry id when read from the cache
+    """
+    record = cache.get_account_record(user_id)
+    if record is not None:
+        paid_until = datetime.fromisoformat(record['paid_until']) if record['paid_until'] else None
+        return State(None, record['balance_cents'], paid_until)
+    account = state(user_id)
+    cache.set_account_records({user_id: account_record(account)})
+    return account
+
+
+def forget(user_ids):
+    """
+    Drop the cached accounts of the subscribers once the entries being added for them are committed
+    """
+    db.session.info.setdefault(STALE_ACCOUNTS, set()).update(user_ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed(session):
+    stale = session.info.pop(STALE_ACCOUNTS, None)
+    if stale:
+        try:
+            cache.invalidate_accounts(list(stale))
+        except Exception as err:
+            # The commit went through, the cached accounts run out with USER_CACHE_TTL
+            print(err)
+            current_app.logger.exception("Unable to invalidate cached accounts", exc_info=sys.exc_info())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def keep_cached(session):
+    session.info.pop(STALE_ACCOUNTS, None)
+
+
+def price(plan):
+    """
+    :return: (price in cents, length) of a period of the plan, or of the default subscription
+    """
+    if plan:
+        return plan.price_cents, timedelta(days=plan.duration_days)
+    return current_app.config['SUBSCRIPTION_PRICE_CENTS'], subscriptions.payment_deadline()
+
+
+def entry(transaction, account, kind, amount_cents, at, user_id=None, paid_until=None):
+    return {
+        'transaction': transaction, 'account': account, 'user_id': user_id, 'kind': kind,
+        'amount_cents': amount_cents, 'paid_until': paid_until, 'creation_date': at,
+    }
+
+
+def post_payments(rows):
+    """
+    Add payments to their subscribers' accounts and charge a period for each full price in the balance.
+    The subscribers are locked until the commit so two workers don't charge the same balance.
+    Changes are left uncommitted
+    :param rows: dicts of Payment columns, as saved by `ingest.record_payments`
+    :return: dict of user id to (telephone, paid-until date) of the subscribers charged
+    """
+    if not rows:
+        return {}
+    users, legacy = {}, {}
+    for chunk in subscriptions.chunks(list({row['source'] for row in rows})):
+        for user_id, telephone, plan_id, paid, date_paid in db.session.query(
+                User.id, User.telephone, User.plan_id, User.paid, User.date_paid,
+        ).filter(User.telephone.in_(chunk)).with_for_update():
+            users[telephone] = (user_id, plan_id)
+            # Where subscribers without an account stand, see `open_accounts`
+            legacy[user_id] = State(0, 0, subscriptions.paid_until(date_paid) if paid and date_paid else None)
+    plans = {plan.id: plan for plan in Plan.query.filter(
+        Plan.id.in_({plan_id for _, plan_id in users.values() if plan_id}))}
+    current = {**legacy, **states(legacy)}
+
+    entries, charged = [], {}
+    for row in sorted(rows, key=lambda row: row['creation_date']):
+        if row['source'] not in users:
+            continue
+        user_id, plan_id = users[row['source']]
+        _, balance, paid_until = current[user_id]
+        at, amount = row['creation_date'], row['amount_cents']
+        transaction = f"payment:{row['code']}"
+        entries += [
+            entry(transaction, SUBSCRIBER, 'payment', amount, at, user_id),
+            entry(transaction, MPESA, 'payment', -amount, at),
+        ]
+        balance += amount
+        cost, length = price(plans.get(plan_id))
+        periods = 0
+        while 0 < cost <= balance:
+            periods += 1
+            # A period bought while still paid starts when the current one ends
+            paid_until = max(paid_until or at, at) + length
+            balance -= cost
+            transaction = f"charge:{row['code']}:{periods}"
+            entries += [
+                entry(transaction, SUBSCRIBER, 'charge', -cost, at, user_id, paid_until),
+                entry(transaction, REVENUE, 'charge', cost, at),
+            ]
+        current[user_id] = State(None, balance, paid_until)
+        forget([user_id])
+        if periods:
+            charged[user_id] = (row['source'], paid_until)
+    if entries:
+        db.session.execute(LedgerEntry.__table__.insert(), entries)
+    sync_users(charged)
+    return charged
+
+
+def charged_by(codes):
+    """
+    Subscribers charged a period by the payments of the given codes, with the date they are paid until now.
+    Lets a payment saved by an earlier attempt whose activation failed be activated again
+    :return: dict of user id to (telephone, paid-until date), like `post_payments`
+    """
+    user_ids = set()
+    for chunk in subscriptions.chunks(list(codes)):
+        # Every charge of a payment has a first period
+        user_ids |= {user_id for user_id, in db.session.query(LedgerEntry.user_id).filter(
+            LedgerEntry.transaction.in_([f'charge:{code}:1' for code in chunk]), LedgerEntry.account == SUBSCRIBER,
+        )}
+    if not user_ids:
+        return {}
+    telephones = {}
+    for chunk in subscriptions.chunks(list(user_ids)):
+        telephones.update(db.session.query(User.id, User.telephone).filter(User.id.in_(chunk)))
+    return {
+        user_id: (telephones[user_id], current.paid_until)
+        for user_id, current in states(user_ids).items() if user_id in telephones and current.paid_until
+    }
+
+
+def sync_users(paid_until):
+    """
+    Set `paid` and `date_paid` from the paid-until dates, see `subscriptions.paid_until`.
+    Changes are left uncommitted
+    :param paid_until: dict of user id to (telephone, paid-until date)
+    """
+    if not paid_until:
+        return
+    now = subscriptions.now()
+    users = User.__table__
+    db.session.execute(
+        users.update().where(users.c.id == bindparam('_id')).values(
+            paid=bindparam('paid'), date_paid=bindparam('date_paid'),
+        ),
+        [
+            {'_id': user_id, 'paid': until > now, 'date_paid': subscriptions.date_paid_for(until)}
+            for user_id, (_, until) in paid_until.items()
+        ],
+    )
+
+
+def post_expiries(user_ids):
+    """
+    Record that subscriptions ran out. Changes are left uncommitted
+    """
+    at = subscriptions.now()
+    entries = [
+        entry(f'expiry:{user_id}:{at:%Y%m%d%H%M%S%f}', SUBSCRIBER, 'expiry', 0, at, user_id)
+        for user_id in user_ids
+    ]
+    if entries:
+        db.session.execute(LedgerEntry.__table__.insert(), entries)
+        forget(user_ids)
+
+
+def open_accounts():
+    """
+    Open the account of every subscriber without one, paid until their current deadline.
+    Payments saved before the ledger existed are accounted for by this opening entry
+    :return: number of accounts opened
+    """
+    has_entries = db.session.query(LedgerEntry.id).filter(LedgerEntry.user_id == User.id).exists()
+    query = db.session.query(User.id, User.paid, User.date_paid).filter(~has_entries)
+    at = subscriptions.now()
+    opened = 0
+    try:
+        for chunk in subscriptions.chunks(query.all()):
+            db.session.execute(LedgerEntry.__table__.insert(), [
+                entry(f'opening:{user_id}', SUBSCRIBER, 'opening', 0, at, user_id,
+                      subscriptions.paid_until(date_paid) if paid and date_paid else None)
+                for user_id, paid, date_paid in chunk
+            ])
+            forget([user_id for user_id, _, _ in chunk])
+            opened += len(chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return opened
+
+
+def snapshot():
+    """
+    Bring the snapshot of every subscriber with new entries up to date,
+    reading each subscriber's entries after their snapshot only
+    :return: number of snapshots written
+    """
+    user_ids = [user_id for user_id, in db.session.query(User.id).order_by(User.id)]
+    written = 0
+    for chunk in subscriptions.chunks(user_ids):
+        snapshots = {
+            user_id: entry_id
+            for user_id, entry_id in db.session.query(LedgerSnapshot.user_id, LedgerSnapshot.entry_id).filter(
+                LedgerSnapshot.user_id.in_(chunk))
+        }
+        taken_at = subscriptions.now()
+        rows = [
+            {'user_id': user_id, 'entry_id': current.entry_id, 'balance_cents': current.balance_cents,
+             'paid_until': current.paid_until, 'taken_at': taken_at}
+            for user_id, current in states(chunk).items() if current.entry_id != snapshots.get(user_id)
+        ]
+        if rows:
+            try:
+                db.session.execute(UPSERT_SNAPSHOT, rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            # A payment committed while the chunk was read may be missing from its states,
+            # so the cached accounts are dropped rather than refreshed from them
+            cache.invalidate_accounts([row['user_id'] for row in rows])
+            written += len(rows)
+    return written
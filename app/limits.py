@@ -0,0 +1,55 @@
+# app/limits.py
+
+from flask import current_app
+import time
+
+"""
+This module shall contain Redis backed limits on how often something may be attempted
+"""
+
+LIMIT_KEY = 'ann:limit:{}:{}'
+
+
+def hit(scope, key, limit, window):
+    """
+    Count an attempt in a fixed window
+    :param scope: what is limited, e.g. 'login:phone'
+    :param key: who is limited, e.g. a phone number or IP address
+    :param limit: attempts allowed per window
+    :param window: length of the window in seconds
+    :return: True if the attempt is within the limit
+    """
+    name = LIMIT_KEY.format(scope, key)
+    pipe = current_app.redis.pipeline()
+    pipe.incr(name)
+    pipe.ttl(name)
+    count, ttl = pipe.execute()
+    if ttl < 0:
+        # First attempt of the window
+        current_app.redis.expire(name, window)
+    return count <= limit
+
+
+def reset(scope, key):
+    current_app.redis.delete(LIMIT_KEY.format(scope, key))
+
+
+def throttle(scope, count, rate):
+    """
+    Wait until `count` more attempts fit in a rate shared by every process.
+    Attempts are counted per second, one that doesn't fit is taken back and tried in the next second
+    :param scope: what is limited, e.g. 'sms'
+    :param count: attempts about to be made, at most `rate`
+    :param rate: attempts allowed per second
+    """
+    while True:
+        second = int(time.time())
+        name = LIMIT_KEY.format(scope, second)
+        pipe = current_app.redis.pipeline()
+        pipe.incrby(name, count)
+        pipe.expire(name, 2)
+        total, _ = pipe.execute()
+        if total <= rate or total == count:
+            return
+        current_app.redis.decrby(name, count)
+        time.sleep(max(0.0, second + 1 - time.time()))
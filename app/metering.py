@@ -0,0 +1,192 @@
+# app/metering.py
+
+from app.models import User, Plan, UsageRecord
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import text, func
+from app import db
+import numpy as np
+import csv
+import sys
+
+"""
+This module shall contain usage metering and rating.
+Traffic samples of the ONTs are summed per user and time bucket with numpy before they reach the
+database, and usage is rated against the plans with array arithmetic rather than per user
+"""
+
+GB = 10 ** 9
+# Samples read from a file before they are summed and saved
+SAMPLE_CHUNK = 500000
+
+Rating = namedtuple('Rating', ['user_ids', 'used_bytes', 'plan_cents', 'overage_cents', 'total_cents'])
+
+# Adds to the counters of a bucket that already exists, works on PostgreSQL and SQLite 3.24+
+UPSERT_USAGE = text("""
+    INSERT INTO usage_records (user_id, bucket_start, bytes_in, bytes_out)
+    VALUES (:user_id, :bucket_start, :bytes_in, :bytes_out)
+    ON CONFLICT (user_id, bucket_start) DO UPDATE SET
+        bytes_in = usage_records.bytes_in + excluded.bytes_in,
+        bytes_out = usage_records.bytes_out + excluded.bytes_out
+""")
+
+
+def rollup(user_ids, timestamps, bytes_in, bytes_out, bucket):
+    """
+    Sum traffic samples per user and bucket
+    :param user_ids: array of the user of each sample
+    :param timestamps: array of unix times of the samples
+    :param bytes_in: array of bytes received since the previous sample
+    :param bytes_out: array of bytes sent since the previous sample
+    :param bucket: bucket length in seconds
+    :return: arrays of user ids, bucket start times and the summed bytes in and out
+    """
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    buckets = np.asarray(timestamps, dtype=np.int64) // bucket
+    first = buckets.min()
+    span = int(buckets.max() - first) + 1
+    # One integer key per user and bucket
+    keys = user_ids * span + (buckets - first)
+    bins = int(keys.max()) + 1
+    if bins <= 4 * len(keys) + 1000000:
+        # Keys are dense enough to count into an array directly, which avoids sorting
+        summed_in = np.bincount(keys, weights=np.asarray(bytes_in, dtype=np.float64), minlength=bins)
+        summed_out = np.bincount(keys, weights=np.asarray(bytes_out, dtype=np.float64), minlength=bins)
+        unique = np.flatnonzero(np.bincount(keys, minlength=bins))
+        summed_in, summed_out = summed_in[unique], summed_out[unique]
+    else:
+        unique, inverse = np.unique(keys, return_inverse=True)
+        summed_in = np.bincount(inverse, weights=np.asarray(bytes_in, dtype=np.float64))
+        summed_out = np.bincount(inverse, weights=np.asarray(bytes_out, dtype=np.float64))
+    starts = (unique % span + first) * bucket
+    return unique // span, starts, summed_in.astype(np.int64), summed_out.astype(np.int64)
+
+
+def save_rollup(user_ids, bucket_starts, bytes_in, bytes_out):
+    """
+    Add summed usage to the usage table. Changes are left uncommitted
+    """
+    rows = [
+        {
+            'user_id': int(user_id), 'bucket_start': datetime.utcfromtimestamp(int(start)),
+            'bytes_in': int(received), 'bytes_out': int(sent),
+        }
+        for user_id, start, received, sent in zip(user_ids, bucket_starts, bytes_in, bytes_out)
+    ]
+    if rows:
+        db.session.execute(UPSERT_USAGE, rows)
+    return len(rows)
+
+
+def read_samples(file):
+    """
+    Read traffic samples written by the collector, one per line:
+    olt,ont,timestamp,bytes_in,bytes_out
+    where the byte counts are the traffic since the ONT's previous sample
+    """
+    for row in csv.reader(file):
+        if not row or row[0].startswith('#') or row[0] == 'olt':
+            continue
+        yield row
+
+
+def ingest(file):
+    """
+    Save the traffic samples of a file or stream
+    :return: dict of counts
+    """
+    ont_users = {(olt, ont): user_id for user_id, olt, ont in db.session.query(User.id, User.olt, User.ont).filter(
+        User.olt.isnot(None), User.ont.isnot(None),
+    )}
+    bucket = current_app.config['USAGE_BUCKET']
+    report = {'samples': 0, 'unknown': 0, 'buckets': 0}
+    columns = ([], [], [], [])
+
+    def flush():
+        if columns[0]:
+            report['buckets'] += save_rollup(*rollup(*columns, bucket=bucket))
+            db.session.commit()
+        for column in columns:
+            column.clear()
+
+    for olt, ont, timestamp, received, sent in read_samples(file):
+        report['samples'] += 1
+        user_id = ont_users.get((olt, ont))
+        if user_id is None:
+            report['unknown'] += 1
+            continue
+        columns[0].append(user_id)
+        columns[1].append(int(float(timestamp)))
+        columns[2].append(int(received))
+        columns[3].append(int(sent))
+        if len(columns[0]) >= SAMPLE_CHUNK:
+            flush()
+    try:
+        flush()
+    except Exception as err:
+        print(err)
+        db.session.rollback()
+        current_app.logger.exception("Unable to save usage", exc_info=sys.exc_info())
+        raise
+    return report
+
+
+def rate(plans, used_bytes, plan_ids):
+    """
+    Charge usage against plans
+    :param plans: list of Plan
+    :param used_bytes: array of bytes used per user
+    :param plan_ids: array of the plan of each user, 0 for none
+    :return: arrays of the plan price and the overage charge per user, in cents
+    """
+    size = max([plan.id for plan in plans], default=0) + 1
+    price = np.zeros(size, dtype=np.int64)
+    quota = np.zeros(size, dtype=np.int64)
+    overage_rate = np.zeros(size, dtype=np.int64)
+    for plan in plans:
+        price[plan.id] = plan.price_cents
+        quota[plan.id] = plan.quota_bytes
+        overage_rate[plan.id] = plan.overage_cents_per_gb
+    plan_ids = np.asarray(plan_ids, dtype=np.int64)
+    user_quota = quota[plan_ids]
+    # Unlimited plans have no quota
+    over = np.where(user_quota > 0, np.maximum(np.asarray(used_bytes, dtype=np.int64) - user_quota, 0), 0)
+    # Every started GB above the quota is charged
+    overage = -(-over // GB) * overage_rate[plan_ids]
+    return price[plan_ids], overage
+
+
+def rate_usage(start, end, user_filter=None):
+    """
+    Rate the usage of every user with a plan over a period
+    :param start: start of the period, inclusive
+    :param end: end of the period, exclusive
+    :param user_filter: optional SQLAlchemy condition on User, e.g. to rate one shard of users
+    :return: Rating of arrays ordered by user id
+    """
+    users = db.session.query(User.id, User.plan_id).filter(User.plan_id.isnot(None))
+    if user_filter is not None:
+        users = users.filter(user_filter)
+    users = users.order_by(User.id).all()
+    user_ids = np.fromiter((user_id for user_id, _ in users), dtype=np.int64, count=len(users))
+    plan_ids = np.fromiter((plan_id for _, plan_id in users), dtype=np.int64, count=len(users))
+
+    # The database sums the buckets, one row per user comes back
+    usage = db.session.query(
+        UsageRecord.user_id, func.sum(UsageRecord.bytes_in + UsageRecord.bytes_out),
+    ).filter(UsageRecord.bucket_start >= start, UsageRecord.bucket_start < end)
+    if user_filter is not None:
+        usage = usage.join(User, User.id == UsageRecord.user_id).filter(user_filter)
+    usage = usage.group_by(UsageRecord.user_id).all()
+    used_bytes = np.zeros(len(user_ids), dtype=np.int64)
+    if usage and len(user_ids):
+        used_ids = np.fromiter((user_id for user_id, _ in usage), dtype=np.int64, count=len(usage))
+        used = np.fromiter((int(total or 0) for _, total in usage), dtype=np.int64, count=len(usage))
+        positions = np.searchsorted(user_ids, used_ids)
+        # Usage of users without a plan is not rated
+        known = (positions < len(user_ids)) & (user_ids[np.minimum(positions, len(user_ids) - 1)] == used_ids)
+        used_bytes[positions[known]] = used[known]
+
+    plan_cents, overage_cents = rate(Plan.query.all(), used_bytes, plan_ids)
+    return Rating(user_ids, used_bytes, plan_cents, overage_cents, plan_cents + overage_cents)
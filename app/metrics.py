@@ -0,0 +1,264 @@
+# app/metrics.py
+
+from redis.client import Redis, Pipeline
+from sqlalchemy.engine import Engine
+from collections import defaultdict
+from flask import current_app, request, g
+from sqlalchemy import event
+import threading
+import logging
+import time
+
+"""
+This module shall contain the instrumentation of requests, queries, jobs and Redis calls.
+Each process adds up its measurements in memory and every few seconds adds them to a Redis hash
+in one pipeline, so `/metrics` shows the web processes and the workers together
+in the Prometheus text format
+"""
+
+METRICS_KEY = 'ann:metrics'
+# Upper bounds of the histogram buckets, in seconds unless noted
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, float('inf'))
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 1, float('inf'))
+# Queries per request or job
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, float('inf'))
+
+# Name, type and help of what is exported
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Time to answer a request'),
+    'db_queries': ('histogram', 'Database queries per request or job'),
+    'db_duration_seconds': ('histogram', 'Time spent in the database per request or job'),
+    'redis_command_duration_seconds': ('histogram', 'Redis round trips, a pipeline counts as one'),
+    'rq_job_duration_seconds': ('histogram', 'Time to run a background job'),
+    'rq_jobs_failed_total': ('counter', 'Background jobs that raised'),
+    'errors_total': ('counter', 'Errors logged'),
+    'notifications_total': ('counter', 'Reminders sent, failed or skipped as already sent'),
+    'admission_requests_total': ('counter', 'Requests to admission controlled endpoints, accepted or shed and why'),
+    'admission_wait_seconds': ('histogram', 'Time admitted requests waited for a slot'),
+    'payments_backlog': ('gauge', 'M-Pesa callbacks waiting for the payments worker'),
+    'rq_queue_jobs': ('gauge', 'Jobs per queue that are waiting, running or failed'),
+    'rq_scheduled_jobs': ('gauge', 'Jobs waiting in the scheduler'),
+    'scheduler_leader': ('gauge', 'Whether a node holds the scheduler lease, and which'),
+}
+
+_values = defaultdict(float)
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+# What the current thread is working on: a request or a job, and its query counters
+_work = threading.local()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+def inc(name, labels=(), amount=1):
+    with _lock:
+        _values[series(name, labels)] += amount
+
+
+def observe(name, labels, value, buckets):
+    """
+    Add a measurement to a histogram. Buckets are cumulative, as Prometheus expects
+    """
+    fields = [series(f'{name}_bucket', labels + (('le', '+Inf' if le == float('inf') else le),))
+              for le in buckets if value <= le]
+    with _lock:
+        for field in fields:
+            _values[field] += 1
+        _values[series(f'{name}_sum', labels)] += value
+        _values[series(f'{name}_count', labels)] += 1
+
+
+def flush(force=False):
+    """
+    Add what this process measured since the last flush to the shared totals in Redis
+    """
+    global _values, _last_flush
+    if not force and time.monotonic() - _last_flush < current_app.config['METRICS_FLUSH_INTERVAL']:
+        return
+    with _lock:
+        values, _values = _values, defaultdict(float)
+        _last_flush = time.monotonic()
+    if not values:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for field, amount in values.items():
+            pipe.hincrbyfloat(METRICS_KEY, field, amount)
+        pipe.execute()
+    except Exception as err:
+        print(err)
+        # Keep them for the next flush
+        with _lock:
+            for field, amount in values.items():
+                _values[field] += amount
+
+
+def gauges():
+    """
+    Measurements read from Redis as they are now: queue depths, the payments backlog and the scheduler's state
+    :return: dict of name to list of (series, value)
+    """
+    from app import ingest, leader, queues
+    values = defaultdict(list)
+    values['payments_backlog'].append(('payments_backlog', ingest.backlog()))
+    for name, counts in queues.depths().items():
+        for state, count in zip(('queued', 'started', 'failed'), counts):
+            values['rq_queue_jobs'].append((series('rq_queue_jobs', (('queue', name), ('state', state))), count))
+    scheduler = current_app.scheduler
+    values['rq_scheduled_jobs'].append(('rq_scheduled_jobs', scheduler.connection.zcard(scheduler.scheduled_jobs_key)))
+    holder = leader.holder('scheduler')
+    values['scheduler_leader'].append(
+        (series('scheduler_leader', (('holder', holder.rsplit(':', 1)[0]),)), 1) if holder else ('scheduler_leader', 0)
+    )
+    return values
+
+
+def render():
+    """
+    The shared totals and the gauges in the Prometheus text format
+    """
+    by_name = gauges()
+    for field, value in current_app.redis.hgetall(METRICS_KEY).items():
+        field = field.decode()
+        name = field.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                name = name[:-len(suffix)]
+        by_name[name].append((field, float(value)))
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for field, value in sorted(by_name.get(name, [])):
+            lines.append(f'{field} {value:g}' if value != int(value) else f'{field} {int(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_work(source):
+    """
+    Count the queries of a request or job from here on
+    """
+    _work.source = source
+    _work.queries = 0
+    _work.db_seconds = 0.0
+
+
+def end_work():
+    """
+    :return: (source, queries, seconds in the database) of the request or job that ended
+    """
+    source = getattr(_work, 'source', None)
+    _work.source = None
+    if source is None:
+        return None, 0, 0.0
+    observe('db_queries', (('source', source),), _work.queries, QUERY_BUCKETS)
+    observe('db_duration_seconds', (('source', source),), _work.db_seconds, LATENCY_BUCKETS)
+    return source, _work.queries, _work.db_seconds
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution's context, which a failed query drops along with it.
+    # The dialect's own queries run without one and aren't timed
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is not None and getattr(_work, 'source', None) is not None:
+        _work.queries += 1
+        _work.db_seconds += time.perf_counter() - started
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts what the app logs at ERROR and above, per request or job
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        inc('errors_total', (('source', getattr(_work, 'source', None) or 'none'),))
+
+
+class InstrumentedPipeline(Pipeline):
+
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            observe('redis_command_duration_seconds', (('command', 'PIPELINE'),),
+                    time.perf_counter() - started, REDIS_BUCKETS)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client that times each round trip
+    """
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            observe('redis_command_duration_seconds', (('command', str(args[0]).upper()),),
+                    time.perf_counter() - started, REDIS_BUCKETS)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def configure(app):
+    """
+    Instrument what the web app and the workers share: queries and logged errors
+    """
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    if not any(isinstance(handler, ErrorCounter) for handler in app.logger.handlers):
+        app.logger.addHandler(ErrorCounter())
+
+
+def init_app(app):
+    """
+    Time every request
+    """
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        start_work(request.endpoint or 'unknown')
+
+    @app.after_request
+    def record_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def end_request(err=None):
+        if 'request_started' not in g:
+            return
+        elapsed = time.perf_counter() - g.request_started
+        source, _, _ = end_work()
+        observe('http_request_duration_seconds', (
+            ('endpoint', source), ('method', request.method), ('status', g.get('response_status', 500)),
+        ), elapsed, LATENCY_BUCKETS)
+        flush()
+
+
+def record_job(func_name, seconds, ok):
+    labels = (('func', func_name),)
+    observe('rq_job_duration_seconds', labels, seconds, JOB_BUCKETS)
+    if not ok:
+        inc('rq_jobs_failed_total', labels)
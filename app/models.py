@@ -1,10 +1,10 @@
 # app/models.py
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import make_transient_to_detached
 from flask import current_app
 from flask_login import UserMixin
 from datetime import datetime
-from app import db, login
+from app import db, login, cache, passwords
 import rq
 import sys
 
@@ -20,10 +20,16 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.Text, nullable=False)
     password_hash = db.Column(db.Text, nullable=False)
-    telephone = db.Column(db.Integer, unique=True, nullable=False)
+    # E.164 format, e.g. +254712345678
+    telephone = db.Column(db.String(16), unique=True, nullable=False)
     paid = db.Column(db.Boolean, nullable=False, default=False)
+    # When the subscription ends less the payment deadline, whatever the plan, see `subscriptions.paid_until`
     date_paid = db.Column(db.DateTime, nullable=True)
-    creation_date = db.Column(db.DateTime, default=datetime.now())
+    creation_date = db.Column(db.DateTime, default=datetime.now)
+    # OLT name, as in the OLTS setting, and the ONT's frame/slot/port and id on it, e.g. '0/1/3 12'
+    olt = db.Column(db.String(64), nullable=True)
+    ont = db.Column(db.String(64), nullable=True)
+    plan_id = db.Column(db.Integer, db.ForeignKey('plans.id'), nullable=True)
     # Relation between users and payments
     payer = db.relationship(
         'Payment',
@@ -31,6 +37,11 @@ class User(UserMixin, db.Model):
         backref='payer', lazy='dynamic',
     )
 
+    __table_args__ = (
+        # Range query of the expiry sweeper on paid users
+        db.Index('ix_users_paid_date_paid', 'paid', 'date_paid'),
+    )
+
     @property
     def password(self):
         """
@@ -43,27 +54,74 @@ class User(UserMixin, db.Model):
         """
         Set password to a hashed password
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def verify_password(self, password):
         """
         Check if hashed password matches actual password
         """
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify_password(self.password_hash, password)
 
     def save(self):
         try:
             db.session.add(self)
             db.session.commit()
+            cache.invalidate_users([self.id])
             return 0
         except Exception as err:
             print(err)
             db.session.rollback()
             return 1
 
+    def to_record(self):
+        """
+        Fields kept in the user cache. The password hash is left out and loaded on access
+        """
+        return {
+            'id': self.id,
+            'username': self.username,
+            'telephone': self.telephone,
+            'paid': self.paid,
+            'date_paid': self.date_paid.isoformat() if self.date_paid else None,
+            'creation_date': self.creation_date.isoformat() if self.creation_date else None,
+            'olt': self.olt,
+            'ont': self.ont,
+            'plan_id': self.plan_id,
+        }
+
+    @staticmethod
+    def from_record(record):
+        """
+        Attach a cached user to the session without querying the database
+        """
+        for field in ('date_paid', 'creation_date'):
+            if record[field]:
+                record[field] = datetime.fromisoformat(record[field])
+        user = User(**record)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def get_cached(user_id):
+        """
+        Read-through lookup of a user by id, served from Redis when possible
+        :return: User or None
+        """
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        record = cache.get_user_record(user_id)
+        if record:
+            return User.from_record(record)
+        user = User.query.get(user_id)
+        if user:
+            cache.set_user_record(user_id, user.to_record())
+        return user
+
     def __repr__(self):
         return f"User('{self.username}', '{self.telephone}')"
 
@@ -75,24 +133,120 @@ def load_user(user_id):
      For that reason, the extension expects that the application will configure a user loader function,
      that can be called to load a user given the ID
     """
-    return User.query.get(int(user_id))
+    return User.get_cached(user_id)
 
 
 class Payment(db.Model):
+    """
+    Payments of the recent months. On PostgreSQL the table is partitioned by month of creation_date,
+    and closed months are moved to the archive, see app/archive.py
+    """
     __tablename__ = 'payments'
 
     code = db.Column(db.Text, primary_key=True)
     sender = db.Column(db.Text, default='')
-    creation_date = db.Column(db.DateTime, default=datetime.now())
-    amount = db.Column(db.Text, default='Ksh0.00')
-    source = db.Column('User', db.String(60),
+    creation_date = db.Column(db.DateTime, default=datetime.now, index=True)
+    amount_cents = db.Column(db.Integer, nullable=False, default=0)
+    source = db.Column('User', db.String(16),
                        db.ForeignKey('users.telephone', ondelete='CASCADE', onupdate='CASCADE'), )
     scheduled_task_id = db.Column(db.String(36), default='')
 
+    __table_args__ = (
+        # Payments of a user, newest first, as read through `User.payer`
+        db.Index('ix_payments_user_creation_date', 'User', 'creation_date'),
+    )
+
+    @staticmethod
+    def parse_amount(amount):
+        """
+        Convert an M-Pesa amount such as 'Ksh1,000.00' to cents
+        """
+        value = str(amount).split("h")[-1].replace(',', '').strip()
+        return int(round(float(value or 0) * 100))
+
+    @property
+    def amount(self):
+        return f"Ksh{(self.amount_cents or 0) / 100:.2f}"
+
     def __repr__(self):
         return f"Payment('{self.code}', 'Sender: {self.sender}', 'Phone: {self.source}')"
 
 
+class PaymentCode(db.Model):
+    """
+    Every M-Pesa code ever saved, never archived. Payments are only unique per month on PostgreSQL,
+    where the month is part of their primary key, so a code is claimed here before it is saved
+    """
+    __tablename__ = 'payment_codes'
+
+    code = db.Column(db.Text, primary_key=True)
+
+    def __repr__(self):
+        return f"PaymentCode('{self.code}')"
+
+
+class PaymentArchive(db.Model):
+    """
+    A month of payments moved out of the payments table into the files of app/archive.py
+    """
+    __tablename__ = 'payment_archives'
+
+    month = db.Column(db.Date, primary_key=True)
+    payments = db.Column(db.Integer, nullable=False, default=0)
+    amount_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"PaymentArchive('{self.month}', '{self.payments}')"
+
+
+class LedgerEntry(db.Model):
+    """
+    One leg of a ledger transaction. Entries are only ever added and those of a transaction add up to
+    zero: a payment moves money from the M-Pesa account to the subscriber's, a charge moves it from the
+    subscriber's to revenue and pushes back the date they are paid until. See app/ledger.py
+    """
+    __tablename__ = 'ledger_entries'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    # e.g. 'payment:<M-Pesa code>', shared by the legs of a transaction
+    transaction = db.Column(db.String(64), nullable=False)
+    account = db.Column(db.String(16), nullable=False)
+    # Subscriber of the 'subscriber' legs
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=True)
+    kind = db.Column(db.String(16), nullable=False)
+    amount_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    # Date the subscriber is paid until after a charge, Nairobi time like `date_paid`
+    paid_until = db.Column(db.DateTime, nullable=True)
+    creation_date = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('transaction', 'account', name='uq_ledger_entries_transaction_account'),
+        # Entries of a subscriber after their snapshot
+        db.Index('ix_ledger_entries_user_id_id', 'user_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f"LedgerEntry('{self.transaction}', '{self.account}', '{self.amount_cents}')"
+
+
+class LedgerSnapshot(db.Model):
+    """
+    A subscriber's balance and paid-until date as of one ledger entry,
+    so their current state is this row plus the entries after it
+    """
+    __tablename__ = 'ledger_snapshots'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    entry_id = db.Column(db.BigInteger, nullable=False)
+    balance_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    paid_until = db.Column(db.DateTime, nullable=True)
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"LedgerSnapshot('{self.user_id}', '{self.entry_id}', '{self.balance_cents}')"
+
+
 class ScheduledTask(db.Model):
     """
     Create a Scheduled Task table
@@ -103,7 +257,7 @@ class ScheduledTask(db.Model):
 
     id = db.Column(db.String(36), primary_key=True, nullable=False)
     name = db.Column(db.String(128), index=True)
-    start = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    start = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     interval = db.Column(db.Integer, default=0)
     description = db.Column(db.Text)
     cancelled = db.Column(db.Boolean, default=False)
@@ -121,15 +275,16 @@ class ScheduledTask(db.Model):
 
     def cancel_scheduled_task(self, job):
         """
-        Given a job, check if it is in scheduler and cancel it if true
+        Given a job, remove it from the scheduler and mark the task cancelled
         :param job: RQ Job or Job ID
-        :return: None
+        :return: 0 on success
         """
+        from app import scheduling
         try:
             status = 0
-            scheduler = current_app.scheduler
-            if job and (type(job) == rq.job or type(job) == str) and job in scheduler:
-                scheduler.cancel(job)
+            job_id = job.id if isinstance(job, rq.job.Job) else job
+            if job_id:
+                scheduling.remove([job_id])
                 self.cancelled = True
                 status = self.save()
             return status
@@ -163,3 +318,91 @@ class ScheduledTask(db.Model):
             print(err)
             db.session.rollback()
             return 1
+
+
+class Plan(db.Model):
+    """
+    A subscription plan. Usage above the quota is charged per started GB
+    """
+    __tablename__ = 'plans'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    price_cents = db.Column(db.Integer, nullable=False, default=0)
+    duration_days = db.Column(db.Integer, nullable=False, default=30)
+    # Bytes included in the price, 0 for unlimited
+    quota_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    overage_cents_per_gb = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"Plan('{self.name}', '{self.price_cents}')"
+
+
+class UsageRecord(db.Model):
+    """
+    Traffic of a user's ONT, summed per time bucket (a day by default). Bucket times are UTC
+    """
+    __tablename__ = 'usage_records'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    bytes_in = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes_out = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        # Rating reads every user's usage over a period
+        db.Index('ix_usage_records_bucket_start', 'bucket_start'),
+    )
+
+    def __repr__(self):
+        return f"UsageRecord('{self.user_id}', '{self.bucket_start}')"
+
+
+class Invoice(db.Model):
+    """
+    A user's bill for a period: plan price and usage above the quota, less what they paid
+    """
+    __tablename__ = 'invoices'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False)
+    period_end = db.Column(db.DateTime, nullable=False)
+    plan_cents = db.Column(db.Integer, nullable=False, default=0)
+    overage_cents = db.Column(db.Integer, nullable=False, default=0)
+    payments_cents = db.Column(db.Integer, nullable=False, default=0)
+    # Amount still owed, negative when the user paid more than the bill
+    balance_cents = db.Column(db.Integer, nullable=False, default=0)
+    used_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    creation_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period_start', name='uq_invoices_user_id_period_start'),
+        db.Index('ix_invoices_period_start', 'period_start'),
+    )
+
+    def __repr__(self):
+        return f"Invoice('{self.user_id}', '{self.period_start}', '{self.balance_cents}')"
+
+
+class DailyStat(db.Model):
+    """
+    Counters of one day, Nairobi time, kept up to date as payments, signups and expirations are saved
+    so reports read one row per day
+    """
+    __tablename__ = 'daily_stats'
+
+    day = db.Column(db.Date, primary_key=True)
+    payments = db.Column(db.Integer, nullable=False, default=0)
+    revenue_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    signups = db.Column(db.Integer, nullable=False, default=0)
+    expirations = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'day': self.day.isoformat(), 'payments': self.payments, 'revenue_cents': self.revenue_cents,
+            'signups': self.signups, 'expirations': self.expirations,
+        }
+
+    def __repr__(self):
+        return f"DailyStat('{self.day}', '{self.payments}', '{self.revenue_cents}')"
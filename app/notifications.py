@@ -0,0 +1,257 @@
+# app/notifications.py
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import import_string
+from collections import namedtuple, Counter
+from app.models import User, Plan
+from datetime import timedelta
+from flask import current_app
+from app import db, ledger, limits, metrics, queues, scheduling, subscriptions
+import urllib.request
+import threading
+import json
+import math
+import time
+
+"""
+This module shall contain the reminders sent to subscribers before their subscription ends.
+A periodic task finds the subscribers whose subscription ends within `NOTIFY_DAYS` with one range
+query on `users.date_paid` and queues a job per batch of them. Each job renders the messages and
+sends them through the SMS gateway in concurrent batches, within a rate shared by every worker.
+A subscriber is reminded once per subscription period, whichever worker gets there first
+
+The gateway is configured in `instance.config`, e.g.
+
+    SMS_GATEWAY = {'adapter': 'http', 'url': 'https://sms.example.com/send', 'token': '...', 'sender': 'ANN'}
+
+Adapters are 'stub' (the default, prints or appends the messages to a file), 'http' or the import path
+of a `Gateway` subclass
+"""
+
+# Set once a subscriber is reminded, per subscription period: user id and the unix time the period ends
+SENT_KEY = 'ann:notify:{}:{}'
+# How long after the period ends a reminder is remembered
+SENT_KEEP = 86400
+
+Message = namedtuple('Message', ['user_id', 'telephone', 'text'])
+
+
+class GatewayError(Exception):
+    pass
+
+
+class Gateway:
+    """
+    Sends text messages. Adapters override `send_batch`
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def send_batch(self, messages):
+        """
+        :param messages: list of Message
+        :return: list of telephones that could not be sent to, raises GatewayError if none were sent
+        """
+        raise NotImplementedError
+
+
+class StubGateway(Gateway):
+    """
+    Sends nothing: prints the messages, or appends them as JSON lines to the file in `path`.
+    `latency` seconds are spent per batch, as a real gateway would
+    """
+
+    lock = threading.Lock()
+
+    def send_batch(self, messages):
+        time.sleep(self.settings.get('latency', 0))
+        lines = [json.dumps({'to': message.telephone, 'text': message.text}) for message in messages]
+        with self.lock:
+            if self.settings.get('path'):
+                with open(self.settings['path'], 'a') as file:
+                    file.write(''.join(f'{line}\n' for line in lines))
+            else:
+                print('\n'.join(lines))
+        return []
+
+
+class HttpGateway(Gateway):
+    """
+    Posts each batch as JSON, {"from": sender, "messages": [{"to": ..., "text": ...}]}, to `url`.
+    The gateway may answer {"failed": [telephone, ...]}
+    """
+
+    def send_batch(self, messages):
+        body = json.dumps({
+            'from': self.settings.get('sender'),
+            'messages': [{'to': message.telephone, 'text': message.text} for message in messages],
+        }).encode()
+        request = urllib.request.Request(self.settings['url'], data=body, method='POST', headers={
+            'Content-Type': 'application/json', 'Authorization': f"Bearer {self.settings.get('token', '')}",
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.settings.get('timeout', 30)) as response:
+                answer = response.read()
+        except Exception as err:
+            raise GatewayError(f"{self.settings['url']}: {err}")
+        try:
+            return list(json.loads(answer).get('failed', []))
+        except (ValueError, AttributeError):
+            return []
+
+
+ADAPTERS = {'stub': StubGateway, 'http': HttpGateway}
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            settings = current_app.config['SMS_GATEWAY']
+            adapter = settings.get('adapter', 'stub')
+            _gateway = (ADAPTERS.get(adapter) or import_string(adapter))(settings)
+        return _gateway
+
+
+def window(days=None):
+    """
+    :return: the `date_paid` range of subscriptions ending within `days`, oldest excluded
+    """
+    days = current_app.config['NOTIFY_DAYS'] if days is None else days
+    start = subscriptions.date_paid_for(subscriptions.now())
+    return start, start + timedelta(days=days)
+
+
+def ending(days=None):
+    """
+    Subscribers whose subscription ends within `days`, read in one pass over the index on
+    `users.paid, users.date_paid`
+    :return: iterator of (user id, unix time the subscription ends)
+    """
+    start, end = window(days)
+    query = db.session.query(User.id, User.date_paid).filter(
+        User.paid.is_(True), User.date_paid > start, User.date_paid <= end,
+    ).order_by(User.date_paid).yield_per(subscriptions.CHUNK_SIZE)
+    for user_id, date_paid in query:
+        yield user_id, int(subscriptions.to_timestamp(subscriptions.paid_until(date_paid)))
+
+
+def fan_out(days=None):
+    """
+    Queue `send_reminders` jobs of up to `NOTIFY_BATCH_SIZE` subscribers whose subscription ends soon
+    and who were not reminded of it yet, on their shard's queue
+    :return: (number of subscribers whose subscription ends soon, number queued)
+    """
+    redis, batch_size = current_app.redis, current_app.config['NOTIFY_BATCH_SIZE']
+    days = current_app.config['NOTIFY_DAYS'] if days is None else days
+    due = queued = 0
+    pending = []
+    for chunk in scheduling.chunks(ending(days), batch_size):
+        due += len(chunk)
+        pipe = redis.pipeline(transaction=False)
+        for user_id, ends in chunk:
+            pipe.exists(SENT_KEY.format(user_id, ends))
+        pending += [user_id for (user_id, _), sent in zip(chunk, pipe.execute()) if not sent]
+        if len(pending) >= batch_size:
+            queues.enqueue_by_subscriber('app.tasks.send_reminders', pending, days)
+            queued += len(pending)
+            pending = []
+    if pending:
+        queues.enqueue_by_subscriber('app.tasks.send_reminders', pending, days)
+    return due, queued + len(pending)
+
+
+def render(user_ids, days=None):
+    """
+    The reminders of the given subscribers whose subscription still ends within `days`,
+    e.g. not of those who paid again since they were queued
+    :return: dict of user id to (Message, unix time the subscription ends)
+    """
+    start, end = window(days)
+    template = current_app.jinja_env.get_template(current_app.config['NOTIFY_TEMPLATE'])
+    current = subscriptions.now()
+    rows = []
+    for chunk in subscriptions.chunks(list(user_ids)):
+        rows += db.session.query(User.id, User.username, User.telephone, User.date_paid, User.plan_id).filter(
+            User.id.in_(chunk), User.paid.is_(True), User.date_paid > start, User.date_paid <= end,
+        ).all()
+    plan_ids = {row.plan_id for row in rows if row.plan_id}
+    plans = {plan.id: plan for plan in Plan.query.filter(Plan.id.in_(plan_ids))} if plan_ids else {}
+    balances = ledger.states([row.id for row in rows])
+    messages = {}
+    for row in rows:
+        expires = subscriptions.paid_until(row.date_paid)
+        price, _ = ledger.price(plans.get(row.plan_id))
+        text = template.render(
+            username=row.username, telephone=row.telephone, expires=expires,
+            days_left=max(0, math.ceil((expires - current).total_seconds() / 86400)),
+            amount_due=max(0, price - balances.get(row.id, ledger.EMPTY).balance_cents),
+        ).strip()
+        messages[row.id] = (Message(row.id, row.telephone, text), int(subscriptions.to_timestamp(expires)))
+    return messages
+
+
+def claim(messages):
+    """
+    Mark subscribers reminded for their current period, unless another job already did
+    :param messages: dict of user id to (Message, unix time the subscription ends)
+    :return: the messages claimed
+    """
+    pipe = current_app.redis.pipeline(transaction=False)
+    now = time.time()
+    for user_id, (_, ends) in messages.items():
+        pipe.set(SENT_KEY.format(user_id, ends), 1, nx=True, ex=max(1, int(ends - now)) + SENT_KEEP)
+    return {user_id: item for (user_id, item), claimed in zip(messages.items(), pipe.execute()) if claimed}
+
+
+def release(items):
+    """
+    Forget the reminders that could not be sent so the next run tries again
+    :param items: list of (Message, unix time the subscription ends)
+    """
+    if items:
+        current_app.redis.delete(*[SENT_KEY.format(message.user_id, ends) for message, ends in items])
+
+
+def send(user_ids, days=None):
+    """
+    Remind the given subscribers that their subscription ends within `days`, if they were not reminded yet.
+    Batches of `NOTIFY_GATEWAY_BATCH` messages go to the gateway `NOTIFY_CONCURRENCY` at a time,
+    and no more than `NOTIFY_RATE` messages a second are sent across all workers
+    :return: Counter of 'sent', 'failed' and 'skipped'
+    """
+    config = current_app.config
+    messages = render(user_ids, days)
+    claimed = claim(messages)
+    counts = Counter(skipped=len(user_ids) - len(claimed))
+    items = list(claimed.values())
+    size = config['NOTIFY_GATEWAY_BATCH']
+    batches = [items[i:i + size] for i in range(0, len(items), size)]
+    gateway = get_gateway()
+    app = current_app._get_current_object()
+
+    def send_batch(batch):
+        with app.app_context():
+            limits.throttle('sms', len(batch), config['NOTIFY_RATE'])
+            try:
+                failed = set(gateway.send_batch([message for message, _ in batch]))
+            except Exception as err:
+                app.logger.error(f"Unable to send {len(batch)} reminders: {err}")
+                return batch
+            return [item for item in batch if item[0].telephone in failed]
+
+    failed = []
+    if batches:
+        workers = max(1, min(len(batches), config['NOTIFY_CONCURRENCY']))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch_failed in executor.map(send_batch, batches):
+                failed.extend(batch_failed)
+    release(failed)
+    counts.update(sent=len(items) - len(failed), failed=len(failed))
+    for result, count in counts.items():
+        metrics.inc('notifications_total', (('result', result),), count)
+    return counts
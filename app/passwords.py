@@ -0,0 +1,75 @@
+# app/passwords.py
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from flask import current_app
+import threading
+
+"""
+This module shall contain password hashing.
+Hashing is deliberately slow, so it runs on a small pool of processes instead of the request worker,
+and the number of requests waiting for the pool is capped
+"""
+
+_pool = None
+_slots = None
+_lock = threading.Lock()
+
+
+class PasswordBusy(Exception):
+    """
+    Raised when too many requests are already waiting for a password hash
+    """
+
+
+def _get_pool():
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            # Created on first use so each web worker process gets its own pool after forking
+            workers = current_app.config['PASSWORD_WORKERS']
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _slots = threading.BoundedSemaphore(workers * current_app.config['PASSWORD_QUEUE_FACTOR'])
+    return _pool
+
+
+def _run(func, *args):
+    pool = _get_pool()
+    if not _slots.acquire(timeout=current_app.config['PASSWORD_TIMEOUT']):
+        raise PasswordBusy('Too many password checks in progress')
+    future = pool.submit(func, *args)
+    try:
+        return future.result(timeout=current_app.config['PASSWORD_TIMEOUT'])
+    except TimeoutError:
+        # Drop it if it hasn't started, the pool is too far behind
+        future.cancel()
+        raise PasswordBusy('Password check timed out')
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+def parameters(method):
+    """
+    Hash function and iterations of a werkzeug method, with werkzeug's defaults filled in,
+    e.g. ('pbkdf2', 'sha256', 150000) for 'pbkdf2:sha256'
+    """
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        return 'pbkdf2', parts[1], int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    return tuple(parts)
+
+
+def needs_rehash(password_hash):
+    """
+    Check if a hash was made with other cost parameters than the configured ones,
+    e.g. 'pbkdf2:sha256:150000$salt$hash' when the method is 'pbkdf2:sha256:260000'
+    """
+    return parameters(password_hash.split('$', 1)[0]) != parameters(current_app.config['PASSWORD_HASH_METHOD'])
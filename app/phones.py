@@ -0,0 +1,51 @@
+# app/phones.py
+
+from phonenumbers import carrier
+from functools import lru_cache
+from collections import namedtuple
+import phonenumbers
+
+"""
+This module shall contain helpers for handling subscriber phone numbers.
+Parsing and carrier lookups are slow and the same subscribers come back again and again,
+so results are kept in a bounded cache
+"""
+
+REGION = "KE"
+# Most numbers kept in the cache, a few MB
+CACHE_SIZE = 100000
+
+PhoneInfo = namedtuple('PhoneInfo', ['e164', 'possible', 'valid', 'carrier'])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def lookup(telephone, region=REGION):
+    """
+    Parse a phone number once and return everything the app checks about it
+    :return: PhoneInfo of the E.164 number, whether it is possible (e.g. right number of digits),
+             whether it is valid for the region and the name of its carrier
+    :raises phonenumbers.NumberParseException: if it is not a phone number at all
+    """
+    # Specify country of origin of phone number.
+    # This maybe unnecessary for numbers starting with '+' since they are globally unique.
+    phone = phonenumbers.parse(telephone, region)
+    return PhoneInfo(
+        e164=phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164),
+        possible=phonenumbers.is_possible_number(phone),
+        valid=phonenumbers.is_valid_number_for_region(phone, region),
+        carrier=carrier.name_for_number(phone, "en") or '',
+    )
+
+
+def process_telephone(telephone):
+    return lookup(telephone).e164
+
+
+def preload():
+    """
+    Load the number and carrier metadata of the region, which phonenumbers otherwise
+    loads on the first request that needs it
+    """
+    example = phonenumbers.example_number_for_type(REGION, phonenumbers.PhoneNumberType.MOBILE)
+    phonenumbers.is_valid_number_for_region(example, REGION)
+    carrier.name_for_number(example, "en")
@@ -0,0 +1,276 @@
+# app/provisioning.py
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from flask import current_app
+import threading
+import paramiko
+import queue
+import time
+import re
+
+"""
+This module shall contain the suspension and resumption of subscribers' ONTs on the GPON OLTs.
+Each OLT keeps a pool of open SSH shell sessions. Commands for many ONTs are written to a session
+in one go and the replies are read back by counting prompts, and OLTs are worked on in parallel
+
+OLTs are configured in `instance.config`, e.g.
+
+    OLTS = {
+        'olt-1': {'host': '10.0.0.2', 'username': 'admin', 'password': '...', 'prompt': r'MA5608T\\S*#'},
+    }
+"""
+
+# Commands sent for each ONT, formatted with the `ont` of the User, e.g. '0/1/3 12'
+DEFAULT_COMMANDS = {
+    'suspend': 'ont deactivate {ont}',
+    'resume': 'ont activate {ont}',
+}
+# Replies that mean a command failed
+DEFAULT_ERROR = r'(?i)(error|failure|unknown command|invalid)'
+# Prompt at the start of a line, e.g. 'OLT#' or 'MA5608T(config)#'
+DEFAULT_PROMPT = r'[\w\-./()]+[#>]'
+# Seconds before the failed commands are sent again, times the attempt
+RETRY_DELAY = 1
+
+Result = namedtuple('Result', ['olt', 'ont', 'action', 'ok', 'latency', 'output'])
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class OltSession:
+    """
+    An interactive shell on an OLT
+    """
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.prompt = re.compile(r'(?m)^' + settings.get('prompt', DEFAULT_PROMPT))
+        self.error = re.compile(settings.get('error', DEFAULT_ERROR))
+        self.timeout = settings.get('timeout', 30)
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        if settings.get('known_hosts'):
+            self.client.load_host_keys(settings['known_hosts'])
+        if settings.get('trust_unknown_host'):
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(
+            settings['host'], port=settings.get('port', 22),
+            username=settings.get('username'), password=settings.get('password'),
+            key_filename=settings.get('key_filename'), timeout=self.timeout,
+            look_for_keys=False, allow_agent=False,
+        )
+        self.channel = self.client.invoke_shell(width=512)
+        self.channel.settimeout(self.timeout)
+        # Wait for the first prompt and run the commands that prepare the session, e.g. 'enable'
+        self._read_prompts(1)
+        setup = settings.get('setup', [])
+        if setup:
+            self.run(setup)
+
+    @property
+    def alive(self):
+        transport = self.client.get_transport()
+        return bool(transport and transport.is_active() and not self.channel.closed)
+
+    def _read_prompts(self, count):
+        """
+        Read until `count` more prompts have been printed
+        :return: list of (output before the prompt, time the prompt arrived)
+        """
+        replies = []
+        buffer = ''
+        position = 0
+        deadline = time.monotonic() + self.timeout
+        while len(replies) < count:
+            if time.monotonic() > deadline:
+                raise ProvisioningError(f"{self.name}: timed out waiting for the prompt")
+            data = self.channel.recv(65536)
+            if not data:
+                raise ProvisioningError(f"{self.name}: connection closed")
+            buffer += data.decode('utf-8', errors='replace')
+            for match in self.prompt.finditer(buffer, position):
+                replies.append((buffer[position:match.start()], time.perf_counter()))
+                position = match.end()
+        return replies[:count]
+
+    def run(self, commands):
+        """
+        Send a batch of commands in one write and read all the replies
+        :return: list of (output, seconds since the previous reply)
+        """
+        started = time.perf_counter()
+        self.channel.sendall(''.join(f'{command}\n' for command in commands).encode())
+        replies = []
+        for output, arrived in self._read_prompts(len(commands)):
+            replies.append((output, arrived - started))
+            started = arrived
+        return replies
+
+    def close(self):
+        self.client.close()
+
+
+class SessionPool:
+    """
+    Open sessions to one OLT, reused across batches
+    """
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.size = settings.get('pool_size', 2)
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            session = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if not can_open:
+                timeout = self.settings.get('timeout', 30)
+                try:
+                    session = self.idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise ProvisioningError(f"{self.name}: no session came free within {timeout}s")
+            else:
+                try:
+                    return OltSession(self.name, self.settings)
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+        if not session.alive:
+            self.discard(session)
+            return self.acquire()
+        return session
+
+    def release(self, session):
+        self.idle.put(session)
+
+    def discard(self, session):
+        session.close()
+        with self.lock:
+            self.opened -= 1
+
+    def run(self, commands):
+        session = self.acquire()
+        try:
+            replies = session.run(commands)
+        except Exception:
+            # The session may be out of step with the OLT, don't reuse it
+            self.discard(session)
+            raise
+        self.release(session)
+        return replies
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    with _pools_lock:
+        if name not in _pools:
+            settings = current_app.config['OLTS'].get(name)
+            if not settings:
+                raise ProvisioningError(f"Unknown OLT: {name}")
+            _pools[name] = SessionPool(name, settings)
+        return _pools[name]
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            while not pool.idle.empty():
+                pool.discard(pool.idle.get_nowait())
+        _pools.clear()
+
+
+def _run_batch(pool, action, onts, commands):
+    try:
+        replies = pool.run(commands)
+    except Exception as err:
+        return [Result(pool.name, ont, action, False, None, str(err)) for ont in onts]
+    error = re.compile(pool.settings.get('error', DEFAULT_ERROR))
+    return [
+        Result(pool.name, ont, action, not error.search(output), latency, output.strip())
+        for ont, (output, latency) in zip(onts, replies)
+    ]
+
+
+def _provision(action, template, targets):
+    """
+    Send the commands for the targets once, in batches of `OLT_BATCH_SIZE` run in parallel
+    :return: list of Result, one per target
+    """
+    config = current_app.config
+    batch_size = config['OLT_BATCH_SIZE']
+    by_olt = {}
+    for olt, ont in targets:
+        by_olt.setdefault(olt, []).append(ont)
+
+    results = []
+    batches = []
+    sessions = 0
+    for olt, onts in by_olt.items():
+        try:
+            pool = get_pool(olt)
+        except ProvisioningError as err:
+            results.extend(Result(olt, ont, action, False, None, str(err)) for ont in onts)
+            continue
+        sessions += pool.size
+        for i in range(0, len(onts), batch_size):
+            chunk = onts[i:i + batch_size]
+            batches.append((pool, action, chunk, [template.format(ont=ont) for ont in chunk]))
+    if not batches:
+        return results
+
+    # More workers than sessions would only wait for one
+    workers = max(1, min(len(batches), config['OLT_WORKERS'], sessions))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_results in executor.map(lambda batch: _run_batch(*batch), batches):
+            results.extend(batch_results)
+    return results
+
+
+def provision(action, targets):
+    """
+    Suspend or resume ONTs. Commands that fail on a known OLT, e.g. over a dropped session,
+    are sent again up to `OLT_RETRIES` times
+    :param action: 'suspend' or 'resume'
+    :param targets: list of (olt name, ont)
+    :return: list of Result, one per target
+    """
+    config = current_app.config
+    template = (config['OLT_COMMANDS'] or DEFAULT_COMMANDS)[action]
+    results = {}
+    pending = list(dict.fromkeys(targets))
+    for attempt in range(config['OLT_RETRIES'] + 1):
+        if attempt:
+            time.sleep(RETRY_DELAY * attempt)
+        for result in _provision(action, template, pending):
+            results[(result.olt, result.ont)] = result
+        pending = [target for target in pending if not results[target].ok and target[0] in config['OLTS']]
+        if not pending:
+            break
+    return [results[target] for target in targets]
+
+
+def latency_report(results):
+    """
+    Summary of per-command latency in milliseconds
+    """
+    latencies = sorted(result.latency * 1000 for result in results if result.latency is not None)
+    if not latencies:
+        return 'no commands completed'
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return (f"{len(latencies)} commands, p50 {latencies[len(latencies) // 2]:.1f} ms, "
+            f"p99 {p99:.1f} ms, max {latencies[-1]:.1f} ms")
@@ -0,0 +1,79 @@
+# app/queues.py
+
+from rq_scheduler import Scheduler
+from collections import defaultdict
+from flask import current_app
+from rq import Queue
+import zlib
+
+"""
+This module shall contain the task queues.
+Periodic and one-off tasks go to the main queue. Jobs about particular subscribers, e.g. provisioning,
+reminders and expiries, go to `TASK_QUEUE_SHARDS` queues picked by a hash of the subscriber's id,
+so workers on several cores or machines can each take some of the shards:
+
+    python -m app.worker ann_tasks:0 ann_tasks:1
+"""
+
+QUEUE_NAME = 'ann_tasks'
+SHARD_QUEUE_NAME = 'ann_tasks:{}'
+
+
+def configure(app):
+    """
+    Create the scheduler and the queues on `app.redis`
+    """
+    # The queue where periodic tasks are submitted
+    app.scheduler = Scheduler(QUEUE_NAME, connection=app.redis)
+    # The queue where one-off background tasks are submitted
+    app.task_queue = Queue(QUEUE_NAME, connection=app.redis)
+    app.shard_queues = [
+        Queue(SHARD_QUEUE_NAME.format(shard), connection=app.redis)
+        for shard in range(max(1, app.config['TASK_QUEUE_SHARDS']))
+    ]
+
+
+def all_queues():
+    return [current_app.task_queue] + current_app.shard_queues
+
+
+def shard_of(user_id, shards):
+    """
+    Shard of a subscriber, the same in every process
+    """
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def queue_of(shard):
+    """
+    Queue of a shard, e.g. of a billing shard. Shards beyond the number of queues wrap around
+    """
+    return current_app.shard_queues[shard % len(current_app.shard_queues)]
+
+
+def enqueue_by_subscriber(func, user_ids, *args, **kwargs):
+    """
+    Queue a job per shard, each given the subscribers of its shard as `user_ids`
+    :return: list of the jobs queued
+    """
+    by_shard = defaultdict(list)
+    for user_id in user_ids:
+        by_shard[shard_of(user_id, len(current_app.shard_queues))].append(user_id)
+    return [
+        queue_of(shard).enqueue(func, *args, user_ids=ids, **kwargs)
+        for shard, ids in sorted(by_shard.items())
+    ]
+
+
+def depths():
+    """
+    :return: dict of queue name to (jobs waiting, jobs running, jobs failed)
+    """
+    queues = all_queues()
+    pipe = current_app.redis.pipeline(transaction=False)
+    for queue in queues:
+        pipe.llen(queue.key)
+        pipe.zcard(queue.started_job_registry.key)
+        pipe.zcard(queue.failed_job_registry.key)
+    counts = pipe.execute()
+    return {queue.name: tuple(counts[i * 3:i * 3 + 3]) for i, queue in enumerate(queues)}
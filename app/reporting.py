@@ -0,0 +1,148 @@
+# app/reporting.py
+
+from app.models import User, Payment, DailyStat
+from datetime import date, timedelta
+from flask import current_app
+from sqlalchemy import text, func
+from app import db, archive, subscriptions
+import json
+
+"""
+This module shall contain the reporting rollups.
+Each day has a row of counters that is added to in the same transaction as the payments,
+signups and expirations it counts, so reports read one row per day instead of scanning payments
+"""
+
+COUNTERS = ('payments', 'revenue_cents', 'signups', 'expirations')
+SUMMARY_KEY = 'ann:reports:summary'
+
+# Adds to the counters of a day that already exists, works on PostgreSQL and SQLite 3.24+
+UPSERT_DAILY = text("""
+    INSERT INTO daily_stats (day, payments, revenue_cents, signups, expirations)
+    VALUES (:day, :payments, :revenue_cents, :signups, :expirations)
+    ON CONFLICT (day) DO UPDATE SET
+        payments = daily_stats.payments + excluded.payments,
+        revenue_cents = daily_stats.revenue_cents + excluded.revenue_cents,
+        signups = daily_stats.signups + excluded.signups,
+        expirations = daily_stats.expirations + excluded.expirations
+""")
+
+
+def today():
+    return subscriptions.now().date()
+
+
+def add(counts):
+    """
+    Add to the counters of some days. Changes are left uncommitted
+    :param counts: dict of day to a dict of counter increments, e.g. {date(2021, 3, 1): {'signups': 1}}
+    """
+    rows = [
+        dict({counter: int(increments.get(counter, 0)) for counter in COUNTERS}, day=day)
+        for day, increments in counts.items()
+    ]
+    if rows:
+        db.session.execute(UPSERT_DAILY, rows)
+
+
+def count_payments(rows):
+    """
+    :param rows: dicts of Payment columns, as saved by `ingest.record_payments`
+    """
+    counts = {}
+    for row in rows:
+        day = counts.setdefault(row['creation_date'].date(), {'payments': 0, 'revenue_cents': 0})
+        day['payments'] += 1
+        day['revenue_cents'] += row['amount_cents']
+    add(counts)
+
+
+def count_signup():
+    add({today(): {'signups': 1}})
+
+
+def count_expirations(expired):
+    if expired:
+        add({today(): {'expirations': expired}})
+
+
+def to_date(value):
+    # SQLite returns the result of date() as text
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def rebuild():
+    """
+    Recompute the payment and signup counters from the tables and the payments archive, e.g. to fill
+    in the days before the rollups existed. Expirations can't be recounted and are kept
+    :return: number of days written
+    """
+    counts = {
+        day: {'expirations': expirations}
+        for day, expirations in db.session.query(DailyStat.day, DailyStat.expirations)
+    }
+    for day, (payments, revenue) in archive.daily_counts().items():
+        counts.setdefault(day, {}).update(payments=payments, revenue_cents=revenue)
+    payment_day = func.date(Payment.creation_date)
+    for day, payments, revenue in db.session.query(
+            payment_day, func.count(), func.sum(Payment.amount_cents)).group_by(payment_day):
+        # Payments saved for an archived month stay in the table until the next archiving run
+        counted = counts.setdefault(to_date(day), {})
+        counted['payments'] = counted.get('payments', 0) + payments
+        counted['revenue_cents'] = counted.get('revenue_cents', 0) + (revenue or 0)
+    signup_day = func.date(User.creation_date)
+    for day, signups in db.session.query(signup_day, func.count()).filter(
+            User.creation_date.isnot(None)).group_by(signup_day):
+        counts.setdefault(to_date(day), {})['signups'] = signups
+    try:
+        DailyStat.query.delete()
+        add(counts)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    current_app.redis.delete(SUMMARY_KEY)
+    return len(counts)
+
+
+def daily(start, end):
+    """
+    Counters of the days from start to end, inclusive
+    """
+    return [
+        stat.to_dict()
+        for stat in DailyStat.query.filter(DailyStat.day >= start, DailyStat.day <= end).order_by(DailyStat.day)
+    ]
+
+
+def totals(start, end):
+    sums = db.session.query(*[func.coalesce(func.sum(getattr(DailyStat, counter)), 0) for counter in COUNTERS]).filter(
+        DailyStat.day >= start, DailyStat.day <= end,
+    ).one()
+    return {counter: int(value) for counter, value in zip(COUNTERS, sums)}
+
+
+def summary():
+    """
+    Subscribers by status and the counters of today and this month.
+    Cached in Redis for as long as clients may cache the response
+    """
+    redis = current_app.redis
+    cached = redis.get(SUMMARY_KEY)
+    if cached:
+        return json.loads(cached)
+    day = today()
+    # Counted from the index on (paid, date_paid)
+    statuses = dict(db.session.query(User.paid, func.count()).group_by(User.paid))
+    report = {
+        'date': day.isoformat(),
+        'subscribers': {
+            'paid': statuses.get(True, 0),
+            'unpaid': sum(count for paid, count in statuses.items() if not paid),
+        },
+        'today': totals(day, day),
+        'month': totals(day.replace(day=1), day),
+        'last_30_days': totals(day - timedelta(days=29), day),
+    }
+    redis.setex(SUMMARY_KEY, current_app.config['REPORT_MAX_AGE'], json.dumps(report))
+    return report
@@ -0,0 +1,220 @@
+# app/scheduling.py
+
+from rq_scheduler.utils import to_unix
+from app.models import ScheduledTask
+from datetime import datetime, timedelta
+from itertools import islice
+from flask import current_app
+from rq.utils import utcparse
+from rq.job import Job
+from app import db
+
+"""
+This module shall contain the management of scheduled tasks.
+The scheduler keeps job ids in a sorted set and the job data in one hash per job; tasks are
+cancelled and rescheduled by id with sorted set commands, batches of them in one pipeline,
+and `reconcile` removes the jobs that no `scheduled_tasks` row accounts for
+"""
+
+SWEEPER_ID = 'sweep-expired-subscriptions'
+SWEEPER_FUNC = 'app.tasks.sweep_expired_subscriptions'
+RECONCILER_ID = 'reconcile-scheduler'
+RECONCILER_FUNC = 'app.tasks.reconcile_scheduler'
+ARCHIVER_ID = 'maintain-payments'
+ARCHIVER_FUNC = 'app.tasks.maintain_payments'
+SNAPSHOT_ID = 'snapshot-ledger'
+SNAPSHOT_FUNC = 'app.tasks.snapshot_ledger'
+REMINDER_ID = 'queue-reminders'
+REMINDER_FUNC = 'app.tasks.queue_reminders'
+# Task that used to be scheduled once per subscriber on every successful code submission
+LEGACY_PAYMENT_FUNC = 'app.tasks.check_payment_status'
+# Ids sent per pipeline, and per `IN (...)` list
+CHUNK_SIZE = 500
+# Jobs and rows younger than this may be half registered and are left alone by `reconcile`
+GRACE_PERIOD = timedelta(minutes=5)
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def remove(job_ids):
+    """
+    Take jobs out of the scheduler and delete their data
+    :return: number of jobs that were scheduled
+    """
+    scheduler = current_app.scheduler
+    removed = 0
+    for chunk in chunks(job_ids):
+        pipe = scheduler.connection.pipeline(transaction=False)
+        pipe.zrem(scheduler.scheduled_jobs_key, *chunk)
+        pipe.delete(*[Job.key_for(job_id) for job_id in chunk])
+        removed += pipe.execute()[0]
+    return removed
+
+
+def cancel(task_ids):
+    """
+    Cancel tasks in the scheduler and mark their rows cancelled. Changes are left uncommitted
+    :param task_ids: ids of ScheduledTask, which are also the ids of their jobs
+    :return: number of jobs that were still scheduled
+    """
+    removed = 0
+    for chunk in chunks(task_ids):
+        removed += remove(chunk)
+        ScheduledTask.query.filter(ScheduledTask.id.in_(chunk)).update(
+            {ScheduledTask.cancelled: True}, synchronize_session=False,
+        )
+    return removed
+
+
+def reschedule(task_id, scheduled_time):
+    """
+    Move the next run of a scheduled task. Changes are left uncommitted
+    :param scheduled_time: UTC time of the next run
+    :return: True if the task was scheduled, False if there was no job to move
+    """
+    scheduler = current_app.scheduler
+    pipe = scheduler.connection.pipeline()
+    # Only updates the score of a job that is already scheduled
+    pipe.zadd(scheduler.scheduled_jobs_key, {task_id: to_unix(scheduled_time)}, xx=True)
+    pipe.zscore(scheduler.scheduled_jobs_key, task_id)
+    if pipe.execute()[1] is None:
+        return False
+    ScheduledTask.query.filter(ScheduledTask.id == task_id).update(
+        {ScheduledTask.start: scheduled_time}, synchronize_session=False,
+    )
+    return True
+
+
+def schedule_periodic(task_id, func, interval, description):
+    """
+    Register a periodic task under a fixed id.
+    Safe to call repeatedly: any previous registration is replaced
+    :param interval: seconds between runs
+    :return: the ScheduledTask row of the task
+    """
+    scheduler = current_app.scheduler
+    scheduler.cancel(task_id)
+    scheduler.schedule(
+        scheduled_time=datetime.utcnow(),
+        func=func,
+        interval=interval,  # Seconds between runs
+        repeat=None,  # Repeat forever
+        id=task_id,
+    )
+    task = db.session.merge(ScheduledTask(
+        id=task_id,
+        name=func,
+        start=datetime.utcnow(),
+        interval=interval,
+        description=description,
+        cancelled=False,
+    ))
+    db.session.commit()
+    return task
+
+
+def schedule_expiry_sweeper():
+    """
+    Register the single periodic expiry sweeper
+    """
+    return schedule_periodic(SWEEPER_ID, SWEEPER_FUNC, current_app.config['SWEEP_INTERVAL'],
+                             'Expiring overdue subscriptions')
+
+
+def schedule_reconciler():
+    """
+    Register the periodic removal of orphaned scheduler jobs
+    """
+    return schedule_periodic(RECONCILER_ID, RECONCILER_FUNC, current_app.config['RECONCILE_INTERVAL'],
+                             'Removing orphaned scheduler jobs')
+
+
+def schedule_archiver():
+    """
+    Register the periodic creation of payment partitions and archiving of closed months
+    """
+    return schedule_periodic(ARCHIVER_ID, ARCHIVER_FUNC, current_app.config['ARCHIVE_INTERVAL'],
+                             'Creating payment partitions and archiving closed months')
+
+
+def schedule_ledger_snapshots():
+    """
+    Register the periodic update of the subscribers' balance snapshots
+    """
+    return schedule_periodic(SNAPSHOT_ID, SNAPSHOT_FUNC, current_app.config['LEDGER_SNAPSHOT_INTERVAL'],
+                             'Updating balance snapshots')
+
+
+def schedule_reminders():
+    """
+    Register the periodic search for subscriptions ending soon, which queues their reminders
+    """
+    return schedule_periodic(REMINDER_ID, REMINDER_FUNC, current_app.config['NOTIFY_INTERVAL'],
+                             'Reminding subscribers whose subscription ends soon')
+
+
+def reconcile():
+    """
+    Make the scheduler and the `scheduled_tasks` table agree:
+    jobs without an active row, or whose data is gone, are removed from the scheduler,
+    and active rows whose job is no longer scheduled are marked cancelled
+    :return: (number of jobs removed, number of rows marked cancelled)
+    """
+    scheduler = current_app.scheduler
+    redis = scheduler.connection
+    recent = datetime.utcnow() - GRACE_PERIOD
+    orphans = []
+    # The sorted set is walked with ZSCAN so it is never read in one go, orphans are removed afterwards
+    for chunk in chunks(member.decode() for member, _ in redis.zscan_iter(scheduler.scheduled_jobs_key,
+                                                                          count=CHUNK_SIZE)):
+        active = {task_id for task_id, in db.session.query(ScheduledTask.id).filter(
+            ScheduledTask.id.in_(chunk), ScheduledTask.cancelled.isnot(True),
+        )}
+        pipe = redis.pipeline(transaction=False)
+        for job_id in chunk:
+            pipe.hget(Job.key_for(job_id), 'created_at')
+        for job_id, created_at in zip(chunk, pipe.execute()):
+            if created_at is None:
+                # The job's data is gone, the scheduler can't run it
+                orphans.append(job_id)
+            elif job_id not in active and utcparse(created_at.decode()) < recent:
+                orphans.append(job_id)
+    removed = remove(orphans)
+
+    stale = []
+    rows = db.session.query(ScheduledTask.id).filter(
+        ScheduledTask.cancelled.isnot(True), ScheduledTask.start < recent,
+    ).yield_per(CHUNK_SIZE)
+    for chunk in chunks(task_id for task_id, in rows):
+        pipe = redis.pipeline(transaction=False)
+        for task_id in chunk:
+            pipe.zscore(scheduler.scheduled_jobs_key, task_id)
+        stale.extend(task_id for task_id, score in zip(chunk, pipe.execute()) if score is None)
+    for chunk in chunks(stale):
+        ScheduledTask.query.filter(ScheduledTask.id.in_(chunk)).update(
+            {ScheduledTask.cancelled: True}, synchronize_session=False,
+        )
+    db.session.commit()
+    return removed, len(stale)
+
+
+def retire_payment_jobs():
+    """
+    Cancel the per-subscriber `check_payment_status` jobs created before the expiry sweeper existed.
+    Jobs whose ScheduledTask row was never saved are orphans and are removed by `reconcile`
+    :return: number of jobs cancelled
+    """
+    task_ids = [task_id for task_id, in db.session.query(ScheduledTask.id).filter(
+        ScheduledTask.name == LEGACY_PAYMENT_FUNC, ScheduledTask.cancelled.isnot(True),
+    )]
+    cancelled = cancel(task_ids)
+    db.session.commit()
+    removed, _ = reconcile()
+    return cancelled + removed
@@ -0,0 +1,83 @@
+# app/sessions.py
+
+from flask.sessions import SessionInterface, SessionMixin, TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+import secrets
+
+"""
+This module shall contain the server-side sessions.
+The session cookie only carries a random id and the session is kept in Redis. It holds what
+Flask-Login and the forms put there (the user id, CSRF token, flashed messages); the user itself
+is read from the user cache in app/cache.py, which payments and expiry invalidate
+"""
+
+SESSION_KEY = 'ann:session:{}'
+
+
+class RedisSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Id to delete when the session is given a new one
+        self.previous_sid = None
+
+    def regenerate(self):
+        """
+        Give the session a new id, e.g. on login so an id known before the login is worthless
+        """
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class RedisSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return RedisSession(sid=new_sid(), new=True)
+        ttl = app.config['SESSION_TTL']
+        # Read the session and extend its life in one round trip
+        pipe = app.redis.pipeline(transaction=False)
+        pipe.get(SESSION_KEY.format(sid))
+        pipe.expire(SESSION_KEY.format(sid), ttl)
+        data, _ = pipe.execute()
+        if data is None:
+            # Expired or never existed, don't reuse an id the client chose
+            return RedisSession(sid=new_sid(), new=True)
+        try:
+            return RedisSession(self.serializer.loads(data.decode()), sid=sid)
+        except Exception as err:
+            print(err)
+            return RedisSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid:
+            app.redis.delete(SESSION_KEY.format(session.previous_sid))
+        if not session:
+            if session.modified and not session.new:
+                app.redis.delete(SESSION_KEY.format(session.sid))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        ttl = app.config['SESSION_TTL']
+        app.redis.setex(SESSION_KEY.format(session.sid), ttl, self.serializer.dumps(dict(session)))
+        response.set_cookie(
+            app.session_cookie_name, session.sid, max_age=ttl if session.permanent else None,
+            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+        )
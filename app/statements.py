@@ -0,0 +1,167 @@
+# app/statements.py
+
+from app.ingest import record_payments, MINIMUM_AMOUNT
+from app.phones import process_telephone
+from app.models import User, Payment, PaymentCode
+from datetime import datetime
+from app import db, archive, subscriptions
+import csv
+import json
+
+"""
+This module shall contain the import of M-Pesa statement exports, used to rebuild payments
+missed while the callback endpoint was down
+"""
+
+# Column names of M-Pesa statement exports mapped to callback fields
+COLUMN_ALIASES = {
+    'receipt no.': 'id',
+    'receipt no': 'id',
+    'receipt': 'id',
+    'completion time': 'date',
+    'paid in': 'amount',
+    'other party info': 'phone',
+    'msisdn': 'phone',
+    'name': 'sender',
+}
+DATE_FORMATS = ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M')
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        for row in csv.DictReader(file):
+            yield row
+
+
+def read_json(path, chunk_size=1 << 16):
+    """
+    Yield the objects of a JSON array or of a file with one JSON object per line,
+    without loading the whole file
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    with open(path, encoding='utf-8-sig') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            buffer += chunk
+            position = 0
+            while True:
+                # Skip what separates objects: whitespace, commas and the array brackets
+                while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+                    position += 1
+                if position == len(buffer):
+                    break
+                try:
+                    item, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    # Object continues in the next chunk
+                    break
+                yield item
+            buffer = buffer[position:]
+            if not chunk:
+                return
+
+
+def read_statement(path):
+    reader = read_json if path.lower().endswith(('.json', '.jsonl', '.ndjson')) else read_csv
+    for row in reader(path):
+        yield {COLUMN_ALIASES.get(key.strip().lower(), key.strip().lower()): value for key, value in row.items()}
+
+
+def parse_date(value):
+    if not value:
+        return datetime.now()
+    value = str(value).strip()
+    if value.isdigit():
+        # Milliseconds since the epoch, as sent in callbacks
+        return datetime.fromtimestamp(int(value) / 1000.0)
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Unknown date format: {value}")
+
+
+def parse_phone(value):
+    """
+    Statements write the payer as e.g. '254712345678 - JOHN DOE'
+    """
+    number = str(value).split('-')[0].strip()
+    if number.startswith('254'):
+        number = f'+{number}'
+    return process_telephone(number)
+
+
+def import_statement(path, unmatched_path=None, chunk_size=5000):
+    """
+    Save the payments of a statement that are not saved yet
+    :param path: CSV, JSON array or JSON lines statement export
+    :param unmatched_path: CSV file the transactions of unregistered telephones are written to
+    :param chunk_size: payments inserted per statement
+    :return: dict of counts
+    """
+    # Loaded once so each row is checked without a query
+    known_codes = {code for code, in db.session.query(PaymentCode.code).yield_per(chunk_size)}
+    registered = {telephone for telephone, in db.session.query(User.telephone).yield_per(chunk_size)}
+    # Codes of the archived months, read when a row of the month comes up
+    archived_codes = {}
+    hot_start = archive.hot_start()
+    report = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'unmatched': 0}
+    chunk = []
+    unmatched = None
+
+    def flush():
+        inserted, paid_until = record_payments(chunk)
+        db.session.commit()
+        subscriptions.activate(paid_until)
+        report['inserted'] += len(inserted)
+        chunk.clear()
+
+    with open(unmatched_path or f'{path}.unmatched.csv', 'w', newline='') as unmatched_file:
+        for row in read_statement(path):
+            report['rows'] += 1
+            code = (row.get('id') or '').strip()
+            if code in known_codes:
+                report['duplicates'] += 1
+                continue
+            try:
+                payment = {
+                    'code': code,
+                    'sender': row.get('sender', ''),
+                    'creation_date': parse_date(row.get('date')),
+                    'amount_cents': Payment.parse_amount(row.get('amount') or 0),
+                    'source': parse_phone(row.get('phone', '')),
+                }
+            except Exception:
+                report['invalid'] += 1
+                continue
+            if not code or payment['amount_cents'] < MINIMUM_AMOUNT:
+                report['invalid'] += 1
+                continue
+            if payment['creation_date'] < hot_start:
+                month = archive.month_start(payment['creation_date'])
+                if month not in archived_codes:
+                    archived_codes[month] = archive.codes(month)
+                if code in archived_codes[month]:
+                    report['duplicates'] += 1
+                    continue
+            if payment['source'] not in registered:
+                report['unmatched'] += 1
+                if not unmatched:
+                    unmatched = csv.DictWriter(unmatched_file, fieldnames=list(row), extrasaction='ignore')
+                    unmatched.writeheader()
+                unmatched.writerow(row)
+                continue
+            known_codes.add(code)
+            chunk.append(payment)
+            if len(chunk) >= chunk_size:
+                flush()
+        flush()
+    return report
@@ -0,0 +1,199 @@
+# app/subscriptions.py
+
+from app.models import User, Payment, ScheduledTask
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db, authz, cache, expiry, ledger, queues, reporting, scheduling
+import time
+import sys
+import pytz
+
+"""
+This module shall contain the logic for starting and ending subscriptions
+"""
+
+TIMEZONE = pytz.timezone('Africa/Nairobi')
+# Keep `IN (...)` lists below SQLite's limit on bound parameters
+CHUNK_SIZE = 500
+
+
+def now():
+    """
+    Current Nairobi time without timezone info, the way `date_paid` is stored
+    """
+    return datetime.now(tz=TIMEZONE).replace(tzinfo=None)
+
+
+def payment_deadline():
+    """
+    How long a payment keeps a subscriber connected
+    """
+    if current_app.debug:
+        return timedelta(minutes=1)
+    return timedelta(days=current_app.config['SUBSCRIPTION_DAYS'])
+
+
+def paid_until(date_paid):
+    """
+    End of the subscription of a subscriber paid on `date_paid`. A subscription of any length is stored
+    as the date it ends less the payment deadline, so readers that add the deadline agree on when it ends
+    """
+    return date_paid + payment_deadline()
+
+
+def date_paid_for(until):
+    """
+    `date_paid` stored for a subscription that ends at `until`, see `paid_until`
+    """
+    return until - payment_deadline()
+
+
+def to_timestamp(moment):
+    """
+    Unix timestamp of a time stored like `date_paid`
+    """
+    return TIMEZONE.localize(moment).timestamp()
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def activate(paid_until):
+    """
+    Give access to subscribers the ledger charged for a period and index when it ends.
+    Called once the ledger entries are committed, `users.paid` was set with them
+    :param paid_until: dict of user id to (telephone, paid-until date), as returned by `ledger.post_payments`
+    """
+    current = now()
+    ends = {user_id: to_timestamp(until) for user_id, (_, until) in paid_until.items() if until > current}
+    if not ends:
+        return
+    cache.invalidate_users(list(ends))
+    expiry.track(ends)
+    authz.grant({paid_until[user_id][0]: timestamp for user_id, timestamp in ends.items()})
+    queue_provisioning('resume', list(ends))
+
+
+def queue_provisioning(action, user_ids):
+    """
+    Have workers suspend or resume the ONTs of the given users, if OLTs are configured, a job per shard
+    """
+    if user_ids and current_app.config['OLTS']:
+        queues.enqueue_by_subscriber('app.tasks.provision_onts', user_ids, action)
+
+
+def overdue_users(cutoff=None):
+    """
+    Ids of paid users whose payment was made before the cutoff.
+    Uses the index on `users.date_paid`
+    """
+    cutoff = cutoff or date_paid_for(now())
+    query = db.session.query(User.id).filter(User.paid.is_(True), User.date_paid <= cutoff)
+    return [user_id for user_id, in query]
+
+
+def expire(user_ids, cutoff=None):
+    """
+    Set `paid` to False for the given users, record it in the ledger
+    and cancel the hourly tasks left behind by their payments
+    :param user_ids: ids of users to expire
+    :param cutoff: only expire users who paid before this time
+    :return: number of users expired, None if the update failed
+    """
+    user_ids = list(user_ids)
+    cutoff = cutoff or date_paid_for(now())
+    expired = 0
+    try:
+        for chunk in chunks(user_ids):
+            # Re-check the deadline so a payment made since the ids were read is not undone.
+            # The rows stay locked until the commit, as they are while a payment is posted
+            due = [user_id for user_id, in db.session.query(User.id).filter(
+                User.id.in_(chunk), User.paid.is_(True), User.date_paid <= cutoff,
+            ).with_for_update()]
+            if due:
+                User.query.filter(User.id.in_(due)).update({User.paid: False}, synchronize_session=False)
+                ledger.post_expiries(due)
+            expired += len(due)
+            cancel_payment_tasks(chunk)
+        reporting.count_expirations(expired)
+        db.session.commit()
+    except Exception as err:
+        print(err)
+        db.session.rollback()
+        current_app.logger.exception("Unable to expire subscriptions", exc_info=sys.exc_info())
+        return None
+    for chunk in chunks(user_ids):
+        cache.invalidate_users(chunk)
+        # Users who paid again in the meantime are still paid and keep their access
+        unpaid = db.session.query(User.id, User.telephone).filter(User.id.in_(chunk), User.paid.is_(False)).all()
+        authz.revoke([telephone for _, telephone in unpaid])
+        queue_provisioning('suspend', [user_id for user_id, _ in unpaid])
+    return expired
+
+
+def cancel_payment_tasks(user_ids):
+    """
+    Cancel the scheduled tasks created for the payments of the given users.
+    Changes are left uncommitted
+    """
+    task_ids = db.session.query(Payment.scheduled_task_id).join(
+        User, Payment.source == User.telephone,
+    ).filter(User.id.in_(user_ids), Payment.scheduled_task_id != '')
+    tasks = [task_id for task_id, in db.session.query(ScheduledTask.id).filter(
+        ScheduledTask.id.in_(task_ids.subquery()), ScheduledTask.cancelled.isnot(True),
+    )]
+    scheduling.cancel(tasks)
+    return len(tasks)
+
+
+def queue_overdue():
+    """
+    Have workers expire every subscriber whose payment deadline has passed, a job per shard
+    :return: number of users queued
+    """
+    cutoff = date_paid_for(now())
+    user_ids = overdue_users(cutoff)
+    queues.enqueue_by_subscriber('app.tasks.expire_subscriptions', user_ids, cutoff.isoformat())
+    return len(user_ids)
+
+
+def rebuild_expiry_index():
+    """
+    Index every paid user from the database, e.g. after the index was lost
+    :return: number of users indexed
+    """
+    query = db.session.query(User.id, User.date_paid).filter(
+        User.paid.is_(True), User.date_paid.isnot(None),
+    ).yield_per(CHUNK_SIZE)
+    indexed = 0
+    batch = {}
+    for user_id, date_paid in query:
+        batch[user_id] = to_timestamp(paid_until(date_paid))
+        if len(batch) >= CHUNK_SIZE:
+            expiry.track(batch)
+            indexed += len(batch)
+            batch = {}
+    expiry.track(batch)
+    return indexed + len(batch)
+
+
+def run_expiry_worker(max_sleep=60):
+    """
+    Expire subscribers exactly when their subscription ends.
+    Sleeps until the earliest deadline in the expiry index, or until the index changes
+    """
+    while True:
+        popped_at = now()
+        due = expiry.pop_due(time.time(), CHUNK_SIZE)
+        if due:
+            # Users who paid again after being popped end later than `popped_at` and are left alone
+            if expire(due, cutoff=date_paid_for(popped_at)) is None:
+                # Put them back so they are retried
+                expiry.track({user_id: time.time() for user_id in due})
+                time.sleep(1)
+            continue
+        deadline = expiry.next_deadline()
+        timeout = max_sleep if deadline is None else min(max_sleep, deadline - time.time())
+        expiry.wait(timeout)
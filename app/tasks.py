@@ -1,18 +1,20 @@
 # app/tasks.py
 
 from app.models import User, Payment, ScheduledTask
-from app import create_app
+from app import authz, ledger, reporting, scheduling, subscriptions
+from app.worker import create_worker_app
 from datetime import datetime, timedelta
 import sys
 import pytz
 
 """
-This module shall contain the background tasks run in the app
+This module shall contain the background tasks run in the app.
+Modules only some jobs need (SSH, numpy) are imported by those jobs
 """
 
 
-# Get a Flask application instance and application context
-app = create_app()
+# Get a Flask application instance and application context, without the web parts
+app = create_worker_app()
 app.app_context().push()
 
 
@@ -33,9 +35,13 @@ def check_payment_status(telephone, payment_code):
         deadline = timedelta(minutes=1) if app.debug else timedelta(days=30)
         if passed_time >= deadline:
             _user.paid = False
+            reporting.count_expirations(1)
+            ledger.post_expiries([_user.id])
             status = _user.save()
             if status:
                 return
+            authz.revoke([_user.telephone])
+            subscriptions.queue_provisioning('suspend', [_user.id])
             # Cancel booking's current hourly scheduled task
             scheduled_task = ScheduledTask.query.filter(ScheduledTask.id == payment.scheduled_task_id).first()
             if not scheduled_task:
@@ -51,3 +57,164 @@ def check_payment_status(telephone, payment_code):
         print(err)
         app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
         return
+
+
+def sweep_expired_subscriptions():
+    """
+    Periodic task that finds every subscriber past the payment deadline in one pass
+    and queues their expiry on the shard queues.
+    Replaces the hourly `check_payment_status` task that was scheduled per subscriber
+    """
+    try:
+        overdue = subscriptions.queue_overdue()
+        if overdue:
+            print(f"Queued the expiry of {overdue} subscriptions")
+        return overdue
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def expire_subscriptions(cutoff, user_ids):
+    """
+    Expire a shard's overdue subscribers
+    :param cutoff: ISO time, only subscribers who paid before it are expired
+    """
+    try:
+        expired = subscriptions.expire(user_ids, datetime.fromisoformat(cutoff))
+        if expired:
+            print(f"Expired {expired} subscriptions")
+        return expired
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def reconcile_scheduler():
+    """
+    Periodic task that removes scheduler jobs no scheduled task accounts for
+    """
+    try:
+        removed, stale = scheduling.reconcile()
+        if removed or stale:
+            print(f"Removed {removed} orphaned jobs, marked {stale} tasks cancelled")
+        return removed
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def maintain_payments():
+    """
+    Periodic task that creates the coming months' payment partitions and archives closed months
+    """
+    from app import archive
+    try:
+        created = archive.ensure_partitions()
+        archived = sum(archive.archive_closed_months().values())
+        if created or archived:
+            print(f"Created {created} partitions, archived {archived} payments")
+        return archived
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def snapshot_ledger():
+    """
+    Periodic task that brings the subscribers' balance snapshots up to date
+    """
+    try:
+        written = ledger.snapshot()
+        if written:
+            print(f"Updated {written} balance snapshots")
+        return written
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def queue_reminders():
+    """
+    Periodic task that queues the reminders of subscribers whose subscription ends soon
+    """
+    from app import notifications
+    try:
+        due, queued = notifications.fan_out()
+        if queued:
+            print(f"{due} subscriptions ending soon, queued {queued} reminders")
+        return queued
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def send_reminders(days, user_ids):
+    """
+    Send the reminders of a batch of subscribers
+    :param days: how soon their subscription ends
+    :param user_ids: ids of subscribers whose subscription ends soon
+    """
+    from app import notifications
+    try:
+        counts = notifications.send(user_ids, days)
+        print(f"Reminders: {counts['sent']} sent, {counts['failed']} failed, {counts['skipped']} skipped")
+        return dict(counts)
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unable to send reminders", exc_info=sys.exc_info())
+        return
+
+
+def provision_onts(action, user_ids):
+    """
+    Suspend or resume the ONTs of the given users on their OLTs
+    :param action: 'suspend' or 'resume'
+    :param user_ids: ids of users whose paid status changed
+    """
+    from app import provisioning
+    try:
+        targets = [
+            (olt, ont) for olt, ont in User.query.with_entities(User.olt, User.ont).filter(
+                User.id.in_(user_ids), User.olt.isnot(None), User.ont.isnot(None),
+            )
+        ]
+        if not targets:
+            return []
+        results = provisioning.provision(action, targets)
+        for result in results:
+            if not result.ok:
+                app.logger.error(f"Unable to {action} ONT {result.ont} on {result.olt}: {result.output}")
+        print(f"{action}: {provisioning.latency_report(results)}")
+        return [result._asdict() for result in results]
+    except Exception as err:
+        print(err)
+        app.logger.exception("Unhandled exception", exc_info=sys.exc_info())
+        return
+
+
+def bill_shard(start, end, shard, shards):
+    """
+    Write the invoices of one shard of subscribers for a billing period
+    :param start: ISO start of the period
+    :param end: ISO end of the period
+    """
+    from app import billing
+    try:
+        invoices = billing.bill_shard(datetime.fromisoformat(start), datetime.fromisoformat(end), shard, shards)
+        if invoices is None:
+            print(f"Shard {shard}/{shards}: skipped, the run was restarted with another number of shards")
+        else:
+            print(f"Shard {shard}/{shards}: {invoices} invoices")
+        return invoices
+    except Exception as err:
+        print(err)
+        app.logger.exception(f"Unable to bill shard {shard}/{shards}", exc_info=sys.exc_info())
+        # Fail the job so it shows up in the failed queue and the shard is left for a restart
+        raise
@@ -1,13 +1,12 @@
 # app/views.py
 
-from flask import render_template, redirect, url_for, make_response, request, flash, jsonify
-from flask_login import login_user, logout_user, login_required
+from flask import render_template, redirect, url_for, make_response, request, flash, jsonify, Response, session
+from flask_login import login_user, logout_user, login_required, current_user
 from app.forms import SignUpForm, LoginForm
-from app.models import User, Payment, ScheduledTask
-from datetime import datetime
-from app import app, db
-import phonenumbers
-import pytz
+from app.models import User, Payment
+from app.phones import process_telephone
+from app import app, db, admission, authz, ingest, ledger, metrics, reporting
+from datetime import date, timedelta
 
 """
 This module shall contain the endpoints(routes) of the web app
@@ -19,13 +18,7 @@ def home():
     return redirect(url_for('login'))
 
 
-def process_telephone(telephone):
-    phone = phonenumbers.parse(telephone, "KE")
-    phone_number = phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164)
-    return phone_number
-
-
-# cookies on login and sign up capture user_id details for verification if code is sent.
+# The session is kept in Redis and holds the user's id, the user is read from the user cache
 
 # post get data, get post data
 @app.route('/signup/', methods=['GET', 'POST'])
@@ -45,15 +38,14 @@ def signup():
             )
             # Add record to database
             db.session.add(_user)
+            reporting.count_signup()
             # Save changes to db
             db.session.commit()
 
             # Log user in and create session
+            session.regenerate()
             login_user(_user, remember=form.remember_me.data)
-
-            resp = make_response(redirect(url_for('dashboard')))
-            resp.set_cookie("userID", f"{_user.id}")
-            return resp
+            return redirect(url_for('dashboard'))
     except Exception as err:
         print(err)
         db.session.rollback()
@@ -67,11 +59,9 @@ def login():
     try:
         if form.validate_on_submit():
             # Log user in and create session
-            _user = User.query.filter_by(telephone=process_telephone(form.telephone.data)).first()
-            login_user(_user, remember=form.remember_me.data)
-            resp = make_response(redirect(url_for('dashboard')))
-            resp.set_cookie("userID", f"{_user.id}")
-            return resp
+            session.regenerate()
+            login_user(form.user, remember=form.remember_me.data)
+            return redirect(url_for('dashboard'))
     except Exception as err:
         print(err)
         db.session.rollback()
@@ -84,7 +74,8 @@ def logout():
     try:
         logout_user()
         resp = make_response(redirect(url_for('login')))
-        resp.set_cookie("userID", None)
+        # Set by earlier versions
+        resp.delete_cookie("userID")
         return resp
     except Exception as err:
         print(err)
@@ -94,60 +85,29 @@ def logout():
 @app.route('/dashboard/')
 @login_required
 def dashboard():
-    user_id = request.cookies.get('userID')
-    _user = User.query.filter_by(id=user_id).first()
-    if not _user:
-        flash("This user doesn't exist")
-        return redirect(url_for("logout"))
-    return render_template('user.html', paid=_user.paid)
+    # Loaded from the user cache by `load_user`, the balance from the account cache
+    account = ledger.cached_state(current_user.id)
+    return render_template('user.html', paid=current_user.paid, paid_until=account.paid_until,
+                           balance=f"Ksh{account.balance_cents / 100:.2f}" if account.balance_cents else None)
 
 
 @app.route('/code/', methods=["POST"])
 @login_required
+@admission.admit('code')
 def code():
     try:
-        user_id = request.cookies.get('userID')
-        _user = User.query.filter_by(id=user_id).first()
-        if not _user:
-            flash("This user doesn't exist")
-            return redirect(url_for("logout"))
+        _user = current_user._get_current_object()
         form = request.form
         text = form.get("code", default="")
         if not text:
             flash("No code received")
         else:
             payment = Payment.query.filter(Payment.code == text).first()
-            if not payment:
+            if not payment or payment.source != _user.telephone:
                 flash("This is an invalid code")
             else:
-                # Set up a background task
-                rq_job = app.scheduler.schedule(
-                    scheduled_time=datetime.utcnow(),  # Time for first execution, in UTC timezone
-                    interval=1 if app.debug else 60,  # Time before the function is called again, in minutes
-                    func='app.tasks.check_payment_status',  # Function to be queued
-                    # Keyword arguments passed into function when executed
-                    kwargs={'telephone': _user.telephone, 'payment_code': payment.code},
-                )
-                # Create a corresponding Task object in database based on RQ-assigned task ID
-                task = ScheduledTask(
-                    id=rq_job.get_id(),
-                    name='app.tasks.check_payment_status',
-                    start=datetime.utcnow(),
-                    interval=1 if app.debug else 60,
-                    description='Checking payment status',
-                )
-                status = task.save()
-                if status:
-                    flash("Unable to check payment")
-                else:
-                    payment.scheduled_task_id = task.id
-                    db.session.add(payment)
-                    db.session.commit()
-                    # Update user's paid status
-                    _user.paid = True
-                    _user.date_paid = datetime.now(tz=pytz.timezone('Africa/Nairobi'))
-                    db.session.add(_user)
-                    db.session.commit()
+                # Payments are added to the subscriber's account as they are saved
+                flash(f"Payment of {payment.amount} received")
     except Exception as err:
         print(err)
         db.session.rollback()
@@ -155,57 +115,108 @@ def code():
 
 
 @app.route('/receiver', methods=['POST', 'GET'])
+@admission.admit('receiver')
 def receiver():
+    """
+    M-Pesa callback. The payment is validated and queued, then saved by the payments worker,
+    so the gateway gets its answer without waiting on the database
+    """
     try:
-        data = request.get_json()
-        if not data:
-            return make_response(jsonify({'message': "No data received", 'status': -2})), 401
-
-        sender, amount, date = data.get('sender', ''), data.get('amount', 'Ksh0.00'), data.get('date', '0')
-        phone, _id = data['phone'], data['id']
-
-        if not phone:
-            return make_response(jsonify({'message': "No phone number received", "status": -3})), 401
-        if not _id:
-            return make_response(jsonify({'message': "No MPESA code received", "status": -3})), 401
-        if not amount:
-            return make_response(jsonify({'message': "No amount received", "status": -3})), 401
-
-        if not date or int(date) == 0:
-            date = datetime.now()
-        else:
-            date = datetime.fromtimestamp(int(date) / 1000.0)
-            print(date)
-
-        if sender == 'Sample sender':
-            return make_response(jsonify({'message': "Success", "status": 0}))
-
-        _user = User.query.filter_by(telephone=process_telephone(phone)).first()
-        if not _user:
-            return make_response(jsonify({'message': 'User not registered', "status": -4})), 401
-
-        payment = Payment.query.filter(Payment.code == _id).first()
-        if payment:
-            return make_response(jsonify({'message': "MPESA transaction already saved", "status": -5})), 401
-
-        price = float(amount.split("h")[-1])
-        if not price:
-            return make_response(jsonify({'message': "No amount received", "status": -6})), 401
-
-        if price >= 5.0:
-            payment = Payment(code=_id, sender=sender, creation_date=date, amount=amount, source=phone)
-            try:
-                # Add record to database
-                db.session.add(payment)
-                # Save changes to db
-                db.session.commit()
-            except Exception as err:
-                print(err)
-                db.session.rollback()
-                return ({'message': 'unable to save payment. Please contact admin', 'status': 1}), 401
-        else:
-            return make_response(jsonify({'message': "1000/= needed for internet connection", "status": -7})), 401
+        payload, error = ingest.validate_callback(request.get_json())
+        if error:
+            message, status = error
+            return make_response(jsonify({'message': message, "status": status})), 401
+        if payload:
+            ingest.enqueue(payload)
         return make_response(jsonify({'message': "Success", "status": 0}))
     except Exception as err:
         print(err)
         return make_response(jsonify({'message': "Error receiving MPESA response", "status": -1})), 401
+
+
+def bearer_authorized(token):
+    """
+    Check the `Authorization: Bearer` header of machine clients. No token configured means open access
+    """
+    return not token or request.headers.get('Authorization') == f'Bearer {token}'
+
+
+def cacheable_json(data):
+    """
+    JSON response that clients and proxies may keep for `REPORT_MAX_AGE` seconds,
+    answered with 304 Not Modified when the client already has it
+    """
+    resp = jsonify(data)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = app.config['REPORT_MAX_AGE']
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
+@app.route('/authorize', methods=['GET', 'POST'])
+def authorize():
+    """
+    Paid status of up to `authz.MAX_BATCH` subscribers for the OLT/BNG, without touching the database
+    in the common case. Telephones are passed as repeated `telephone` query arguments
+    or as a JSON body {"telephones": [...]}
+    """
+    if not bearer_authorized(app.config['AUTHORIZATION_TOKEN']):
+        return make_response(jsonify({'message': "Not authorized", 'status': -1})), 401
+    telephones, error = authz.validate(request.get_json(silent=True) or {}, request.args.getlist('telephone'))
+    if error:
+        return make_response(jsonify({'message': error, 'status': -3})), 400
+    normalised = authz.normalise(telephones)
+    statuses = authz.status([e164 for e164 in normalised.values() if e164])
+    return make_response(jsonify(authz.answer(normalised, statuses)))
+
+
+@app.route('/reports/daily')
+def daily_report():
+    """
+    Payments, revenue, signups and expirations per day, from `start` to `end` (YYYY-MM-DD, inclusive).
+    Defaults to the last 30 days
+    """
+    if not bearer_authorized(app.config['REPORTING_TOKEN']):
+        return make_response(jsonify({'message': "Not authorized", 'status': -1})), 401
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else reporting.today()
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(days=29)
+    except ValueError:
+        return make_response(jsonify({'message': "Dates must be YYYY-MM-DD", 'status': -3})), 400
+    if start > end or (end - start).days >= app.config['REPORT_MAX_DAYS']:
+        return make_response(jsonify({'message': f"At most {app.config['REPORT_MAX_DAYS']} days per call",
+                                      'status': -3})), 400
+    return cacheable_json({'start': start.isoformat(), 'end': end.isoformat(),
+                           'days': reporting.daily(start, end), 'status': 0})
+
+
+@app.route('/reports/summary')
+def summary_report():
+    """
+    Paid and unpaid subscribers, with payments and revenue of today, this month and the last 30 days
+    """
+    if not bearer_authorized(app.config['REPORTING_TOKEN']):
+        return make_response(jsonify({'message': "Not authorized", 'status': -1})), 401
+    return cacheable_json(dict(reporting.summary(), status=0))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Request, database, job and Redis measurements of all processes, for Prometheus
+    """
+    if not bearer_authorized(app.config['METRICS_TOKEN']):
+        return make_response(jsonify({'message': "Not authorized", 'status': -1})), 401
+    # Include what this process measured since its last flush
+    metrics.flush(force=True)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/status')
+@login_required
+def subscriber_status():
+    """
+    Paid status of the logged in subscriber, polled by the portal
+    """
+    telephone = current_user.telephone
+    return jsonify(dict(authz.status([telephone])[telephone], status=0))
@@ -0,0 +1,94 @@
+# app/worker.py
+
+from rq import Worker, SimpleWorker, Queue
+from app import app, db, metrics, configure_app
+import argparse
+import time
+
+"""
+This module shall contain the entry point of the background workers.
+Workers get an app with the database and Redis only; the views, forms, templates and phone metadata
+of the web app are never loaded. The tasks are imported once before the first job, so neither mode
+pays for the imports per job:
+
+    python -m app.worker            # runs jobs in this process, reusing the app context and database pool
+    python -m app.worker --fork     # forks a work horse per job from this warm process
+"""
+
+
+def create_worker_app():
+    """
+    The app as the workers need it
+    """
+    return configure_app()
+
+
+class InstrumentedWorker:
+    """
+    Records the duration and outcome of each job, and its queries
+    """
+
+    def perform_job(self, job, queue, heartbeat_ttl=None):
+        metrics.start_work(job.func_name)
+        started = time.perf_counter()
+        ok = False
+        try:
+            ok = super().perform_job(job, queue, heartbeat_ttl=heartbeat_ttl)
+            return ok
+        finally:
+            metrics.end_work()
+            metrics.record_job(job.func_name, time.perf_counter() - started, ok)
+            # A work horse exits right after its job
+            metrics.flush(force=True)
+
+
+class WarmWorker(InstrumentedWorker, SimpleWorker):
+    """
+    Runs jobs in the worker process, so the app context and database connections are kept across jobs
+    """
+
+    def perform_job(self, job, queue, heartbeat_ttl=None):
+        try:
+            return super().perform_job(job, queue, heartbeat_ttl=heartbeat_ttl)
+        finally:
+            # Don't carry a session, or a transaction left open by a failed job, into the next job
+            db.session.remove()
+
+
+class PreforkWorker(InstrumentedWorker, Worker):
+    """
+    Forks a work horse per job from a process that has already imported the tasks,
+    for jobs that must not share a process, e.g. to free the memory of a large billing run
+    """
+
+    def fork_work_horse(self, job, queue):
+        # A connection must not be shared by two processes, the work horse opens its own
+        db.engine.dispose()
+        return super().fork_work_horse(job, queue)
+
+
+def run(queues=None, fork=False, burst=False):
+    """
+    Start a worker on the task queues
+    :param queues: queue names, the app's task queue and shard queues by default
+    :param fork: fork a work horse per job instead of running jobs in this process
+    :param burst: stop once the queues are empty
+    """
+    # Importing the tasks builds the worker app and pushes its context
+    from app import tasks  # noqa: F401
+    worker_class = PreforkWorker if fork else WarmWorker
+    queues = [Queue(name, connection=app.redis) for name in queues] if queues else [app.task_queue] + app.shard_queues
+    worker = worker_class(queues, connection=app.redis)
+    if not fork:
+        # Open the first database connection before the first job rather than during it
+        db.engine.connect().close()
+    return worker.work(burst=burst)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the background task worker.')
+    parser.add_argument('queues', nargs='*', help='queues to work on, default ann_tasks and its shards')
+    parser.add_argument('--fork', action='store_true', help='fork a work horse per job')
+    parser.add_argument('--burst', action='store_true', help='stop once the queues are empty')
+    args = parser.parse_args()
+    run(args.queues, args.fork, args.burst)
@@ -0,0 +1,121 @@
+# benchmarks/bench_ledger.py
+
+from datetime import datetime, timedelta
+import statistics
+import argparse
+import tempfile
+import random
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select, func, and_  # noqa: E402
+from app.models import User, LedgerEntry, LedgerSnapshot  # noqa: E402
+from app import db  # noqa: E402
+
+"""
+Benchmark of reading a subscriber's balance and paid-until date from the ledger.
+Times the snapshot and tail read of `ledger.states` against replaying every entry, as histories grow:
+
+    python benchmarks/bench_ledger.py --users 1000 --history 10 100 1000 --tail 5
+"""
+
+CHUNK = 10000
+PRICE = 100000
+
+
+def seed(engine, users, history, tail):
+    """
+    `history` payments and charges per subscriber, with a snapshot taken `tail` entries before the last
+    """
+    start = datetime(2021, 1, 1)
+    entries, snapshots = LedgerEntry.__table__, LedgerSnapshot.__table__
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'id': i + 1, 'username': f'user{i}', 'password_hash': 'x', 'telephone': f'+2547{i:08d}',
+             'creation_date': start}
+            for i in range(users)
+        ])
+        rows, last = [], {}
+        for n in range(history):
+            for user_id in range(1, users + 1):
+                at = start + timedelta(days=30 * n)
+                kind, amount = ('payment', PRICE) if n % 2 == 0 else ('charge', -PRICE)
+                rows.append({
+                    'transaction': f'{kind}:{user_id}:{n}', 'account': 'subscriber', 'user_id': user_id,
+                    'kind': kind, 'amount_cents': amount, 'creation_date': at,
+                    'paid_until': at + timedelta(days=30) if kind == 'charge' else None,
+                })
+                if len(rows) == CHUNK:
+                    conn.execute(entries.insert(), rows)
+                    rows = []
+        if rows:
+            conn.execute(entries.insert(), rows)
+
+        cut = max(history - tail, 0)
+        if cut:
+            # Entries were inserted a round at a time, so each subscriber's first `cut` are the lowest ids
+            for user_id, entry_id, balance, paid_until in conn.execute(
+                    select([entries.c.user_id, func.max(entries.c.id), func.sum(entries.c.amount_cents),
+                            func.max(entries.c.paid_until)])
+                    .where(entries.c.id <= cut * users).group_by(entries.c.user_id)):
+                last[user_id] = {'user_id': user_id, 'entry_id': entry_id, 'balance_cents': balance,
+                                 'paid_until': paid_until, 'taken_at': start}
+            conn.execute(snapshots.insert(), list(last.values()))
+
+
+def snapshot_and_tail(conn, user_id):
+    entries, snapshots = LedgerEntry.__table__, LedgerSnapshot.__table__
+    snapshot = conn.execute(select([snapshots]).where(snapshots.c.user_id == user_id)).first()
+    return conn.execute(select([
+        func.max(entries.c.id), func.sum(entries.c.amount_cents), func.max(entries.c.paid_until),
+    ]).where(and_(entries.c.user_id == user_id, entries.c.id > (snapshot.entry_id if snapshot else 0)))).first()
+
+
+def replay(conn, user_id):
+    entries = LedgerEntry.__table__
+    return conn.execute(select([func.sum(entries.c.amount_cents), func.max(entries.c.paid_until)])
+                        .where(entries.c.user_id == user_id)).first()
+
+
+READS = {'snapshot + tail': snapshot_and_tail, 'replay': replay}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time ledger state reads against full replays')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--history', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Entries per subscriber, one run each')
+    parser.add_argument('--tail', type=int, default=5, help='Entries after the snapshot')
+    parser.add_argument('--runs', type=int, default=500)
+    parser.add_argument('--url', help='Database URL, defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    for history in args.history:
+        url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+        engine = create_engine(url)
+        db.metadata.drop_all(engine)
+        db.metadata.create_all(engine)
+        started = time.perf_counter()
+        seed(engine, args.users, history, args.tail)
+        print(f"Seeded {args.users} users with {history} entries each in {time.perf_counter() - started:.1f}s")
+
+        timings = {}
+        with engine.connect() as conn:
+            for _ in range(args.runs):
+                user_id = random.randint(1, args.users)
+                for name, read in READS.items():
+                    started = time.perf_counter()
+                    read(conn, user_id)
+                    timings.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        for name, samples in timings.items():
+            samples.sort()
+            print(f"  {name:16} median {statistics.median(samples):8.3f} ms  "
+                  f"p99 {samples[int(len(samples) * 0.99) - 1]:8.3f} ms")
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# benchmarks/bench_lookups.py
+
+from datetime import datetime, timedelta
+import statistics
+import argparse
+import tempfile
+import random
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select, func, and_, text  # noqa: E402
+from app.models import User, Payment  # noqa: E402
+from app import db  # noqa: E402
+
+"""
+Benchmark of the hot lookups on the payments and users tables.
+Seeds a database and times each lookup, e.g. at 1M payments:
+
+    python benchmarks/bench_lookups.py --payments 1000000
+    python benchmarks/bench_lookups.py --payments 1000000 --drop-indexes
+"""
+
+INDEXES = ['ix_users_paid_date_paid', 'ix_payments_creation_date', 'ix_payments_user_creation_date']
+CHUNK = 10000
+
+
+def seed(engine, users, payments):
+    start = datetime(2021, 1, 1)
+    users_table, payments_table = User.__table__, Payment.__table__
+    with engine.begin() as conn:
+        for offset in range(0, users, CHUNK):
+            conn.execute(users_table.insert(), [
+                {
+                    'username': f'user{i}', 'password_hash': 'x', 'telephone': f'+2547{i:08d}',
+                    'paid': i % 2 == 0, 'date_paid': start + timedelta(minutes=i),
+                    'creation_date': start,
+                }
+                for i in range(offset, min(offset + CHUNK, users))
+            ])
+        for offset in range(0, payments, CHUNK):
+            conn.execute(payments_table.insert(), [
+                {
+                    'code': f'P{i:09d}', 'sender': 'Sender', 'amount_cents': 100000,
+                    'creation_date': start + timedelta(seconds=i * 30),
+                    'User': f'+2547{i % users:08d}', 'scheduled_task_id': '',
+                }
+                for i in range(offset, min(offset + CHUNK, payments))
+            ])
+
+
+def lookups(users, payments):
+    """
+    The statements run by receiver(), check_payment_status, User.payer, the sweeper and reports
+    """
+    telephone = f'+2547{random.randrange(users):08d}'
+    day = datetime(2021, 1, 1) + timedelta(seconds=random.randrange(payments) * 30)
+    return {
+        'user by telephone': select([User.__table__]).where(User.telephone == telephone),
+        'payment by code': select([Payment.__table__]).where(Payment.code == f'P{random.randrange(payments):09d}'),
+        'payments of user': select([Payment.__table__]).where(Payment.source == telephone)
+        .order_by(Payment.creation_date.desc()).limit(20),
+        'overdue paid users': select([User.id])
+        .where(and_(User.paid.is_(True), User.date_paid <= datetime(2021, 1, 2))),
+        'revenue for a day': select([func.count(), func.sum(Payment.amount_cents)])
+        .where(and_(Payment.creation_date >= day, Payment.creation_date < day + timedelta(days=1))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot payments and users lookups')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--payments', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--url', help='Database URL, defaults to a temporary SQLite file')
+    parser.add_argument('--drop-indexes', action='store_true', help='Time the lookups without the new indexes')
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    started = time.perf_counter()
+    seed(engine, args.users, args.payments)
+    print(f"Seeded {args.users} users and {args.payments} payments in {time.perf_counter() - started:.1f}s")
+    if args.drop_indexes:
+        with engine.begin() as conn:
+            for index in INDEXES:
+                conn.execute(text(f'DROP INDEX {index}'))
+
+    timings = {}
+    with engine.connect() as conn:
+        for _ in range(args.runs):
+            for name, statement in lookups(args.users, args.payments).items():
+                started = time.perf_counter()
+                conn.execute(statement).fetchall()
+                timings.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+    for name, samples in timings.items():
+        samples.sort()
+        p99 = samples[int(len(samples) * 0.99) - 1]
+        print(f"{name:20} median {statistics.median(samples):8.3f} ms  p99 {p99:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# benchmarks/bench_notifications.py
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import argparse
+import tempfile
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+"""
+Benchmark of the pre-expiry reminders. Seeds subscribers whose subscription ends within `NOTIFY_DAYS`,
+queues their reminders on the shard queues with `notifications.fan_out` and runs the jobs on
+`--workers` threads, each as a warm worker would, against the stub gateway with a simulated latency per request:
+
+    python benchmarks/bench_notifications.py --users 50000 --workers 4 --latency 0.2 --rate 500
+
+Redis is a fakeredis server in this process unless `--redis` names a real one.
+"""
+
+CHUNK = 10000
+
+
+def write_config(args):
+    """
+    Write an `instance/config.py` for the benchmark and put it first on the path
+    """
+    directory = tempfile.mkdtemp(prefix='bench-notifications-')
+    os.mkdir(os.path.join(directory, 'instance'))
+    open(os.path.join(directory, 'instance', '__init__.py'), 'w').close()
+    with open(os.path.join(directory, 'instance', 'config.py'), 'w') as file:
+        file.write(f"DEBUG = False\n"
+                   f"SQLALCHEMY_DATABASE_URI = {'sqlite:///' + os.path.join(directory, 'bench.db')!r}\n"
+                   f"REDIS_URL = {args.redis or 'redis://'!r}\n"
+                   f"SMS_GATEWAY = {{'adapter': 'stub', 'path': {os.devnull!r}, 'latency': {args.latency}}}\n"
+                   f"NOTIFY_RATE = {args.rate}\n"
+                   f"NOTIFY_CONCURRENCY = {args.concurrency}\n")
+    sys.path.insert(0, directory)
+
+
+def build_app(args):
+    from app import configure_app
+    app = configure_app()
+    if not args.redis:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("Install fakeredis or pass --redis redis://...")
+        from app.metrics import InstrumentedRedis
+        from app import queues
+        server = fakeredis.FakeServer()
+        app.redis = InstrumentedRedis(connection_pool=fakeredis.FakeRedis(server=server).connection_pool)
+        queues.configure(app)
+    return app
+
+
+def seed(users):
+    """
+    Paid subscribers whose subscription ends within the next two days
+    """
+    from app.models import User
+    from app import db, subscriptions
+    db.drop_all()
+    db.create_all()
+    now = subscriptions.now()
+    start = now - subscriptions.payment_deadline()
+    with db.engine.begin() as conn:
+        for offset in range(0, users, CHUNK):
+            conn.execute(User.__table__.insert(), [
+                {
+                    'username': f'user{i}', 'password_hash': 'x', 'telephone': f'+2547{i:08d}', 'paid': True,
+                    'date_paid': start + timedelta(seconds=1 + i * 172800 // users), 'creation_date': now,
+                }
+                for i in range(offset, min(offset + CHUNK, users))
+            ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time sending reminders to subscriptions ending soon')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=4, help='Workers running the send jobs')
+    parser.add_argument('--concurrency', type=int, default=4, help='Gateway requests per job at a time')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds the stub gateway takes per request')
+    parser.add_argument('--rate', type=int, default=500, help='Messages per second across all workers')
+    parser.add_argument('--redis', help='Redis URL, defaults to fakeredis')
+    args = parser.parse_args()
+
+    write_config(args)
+    app = build_app(args)
+    from app import db, notifications, queues
+    with app.app_context():
+        seed(args.users)
+        started = time.perf_counter()
+        due, queued = notifications.fan_out()
+        fanned_out = time.perf_counter() - started
+        jobs = [job for queue in queues.all_queues() for job in queue.jobs]
+        print(f"{due} subscriptions ending soon, {queued} reminders in {len(jobs)} jobs queued in {fanned_out:.2f}s")
+
+    def work(jobs):
+        counts = {}
+        with app.app_context():
+            for job in jobs:
+                for result, count in notifications.send(job.kwargs['user_ids'], *job.args).items():
+                    counts[result] = counts.get(result, 0) + count
+            db.session.remove()
+        return counts
+
+    started = time.perf_counter()
+    totals = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for counts in executor.map(work, [jobs[i::args.workers] for i in range(args.workers)]):
+            for result, count in counts.items():
+                totals[result] = totals.get(result, 0) + count
+    elapsed = time.perf_counter() - started
+    print(f"Sent {totals.get('sent', 0)}, failed {totals.get('failed', 0)}, skipped {totals.get('skipped', 0)} "
+          f"in {elapsed:.1f}s, {totals.get('sent', 0) / elapsed:.0f} messages/s")
+
+
+if __name__ == '__main__':
+    main()
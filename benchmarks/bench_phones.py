@@ -0,0 +1,65 @@
+# benchmarks/bench_phones.py
+
+from phonenumbers import carrier
+import phonenumbers
+import argparse
+import random
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import phones  # noqa: E402
+
+"""
+Micro-benchmark of the phone number checks made on every sign up, login and M-Pesa callback:
+
+    python benchmarks/bench_phones.py --subscribers 5000 --requests 100000
+"""
+
+
+def uncached(telephone):
+    """
+    The checks as the forms made them before app.phones
+    """
+    phone = phonenumbers.parse(telephone, "KE")
+    phonenumbers.is_possible_number(phone)
+    phonenumbers.is_valid_number_for_region(phone, "KE")
+    phone_number = phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164)
+    operator = carrier.name_for_number(phone, "en") if carrier.name_for_number(phone, "en") else ''
+    return phone_number, operator
+
+
+def cached(telephone):
+    phone = phones.lookup(telephone)
+    return phone.e164, phone.carrier
+
+
+def run(check, numbers):
+    started = time.perf_counter()
+    for telephone in numbers:
+        check(telephone)
+    return (time.perf_counter() - started) / len(numbers) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time phone number normalisation and carrier lookup')
+    parser.add_argument('--subscribers', type=int, default=5000, help='Distinct numbers')
+    parser.add_argument('--requests', type=int, default=100000, help='Lookups, drawn from the subscribers')
+    args = parser.parse_args()
+
+    subscribers = [f'07{random.choice("0129")}{i:07d}' for i in range(args.subscribers)]
+    numbers = [random.choice(subscribers) for _ in range(args.requests)]
+
+    started = time.perf_counter()
+    uncached(subscribers[0])
+    print(f"first lookup, metadata loaded lazily: {(time.perf_counter() - started) * 1000:8.1f} ms")
+    print(f"uncached:                             {run(uncached, numbers):8.1f} us per request")
+    print(f"cached:                               {run(cached, numbers):8.1f} us per request")
+    info = phones.lookup.cache_info()
+    print(f"cache hits {info.hits}, misses {info.misses}")
+
+
+if __name__ == '__main__':
+    main()
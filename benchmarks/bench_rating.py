@@ -0,0 +1,65 @@
+# benchmarks/bench_rating.py
+
+import argparse
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+from app.models import Plan  # noqa: E402
+from app import metering  # noqa: E402
+
+"""
+Benchmark of usage metering: sums a month of 5-minute traffic samples per subscriber and day,
+a day of samples at a time as the collector delivers them, then rates the month against the plans
+
+    python benchmarks/bench_rating.py --subscribers 50000 --days 30
+"""
+
+SAMPLES_PER_DAY = 24 * 60 // 5
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time usage rollup and rating')
+    parser.add_argument('--subscribers', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--bucket', type=int, default=86400, help='Seconds per usage record')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    plans = [
+        Plan(id=1, name='basic', price_cents=100000, quota_bytes=100 * metering.GB, overage_cents_per_gb=2000),
+        Plan(id=2, name='unlimited', price_cents=300000, quota_bytes=0, overage_cents_per_gb=0),
+    ]
+    user_ids = np.arange(1, args.subscribers + 1, dtype=np.int64)
+    start = 1614556800  # 2021-03-01 UTC
+
+    rolled_up = 0
+    used = np.zeros(args.subscribers + 1, dtype=np.int64)
+    started = time.perf_counter()
+    for day in range(args.days):
+        times = start + day * 86400 + np.arange(SAMPLES_PER_DAY, dtype=np.int64) * 300
+        samples_users = np.repeat(user_ids, SAMPLES_PER_DAY)
+        samples_times = np.tile(times, args.subscribers)
+        received = rng.integers(0, 5 * 10 ** 6, size=samples_users.size)
+        sent = received // 10
+        ids, _, summed_in, summed_out = metering.rollup(samples_users, samples_times, received, sent, args.bucket)
+        np.add.at(used, ids, summed_in + summed_out)
+        rolled_up += ids.size
+    elapsed = time.perf_counter() - started
+    samples = args.subscribers * SAMPLES_PER_DAY * args.days
+    print(f"rollup: {samples} samples into {rolled_up} records in {elapsed:.2f}s "
+          f"({samples / elapsed / 1e6:.1f}M samples/s, including generating them)")
+
+    plan_ids = rng.integers(1, 3, size=args.subscribers)
+    started = time.perf_counter()
+    plan_cents, overage_cents = metering.rate(plans, used[1:], plan_ids)
+    elapsed = time.perf_counter() - started
+    print(f"rating: {args.subscribers} subscribers in {elapsed * 1000:.1f} ms, "
+          f"total Ksh{(plan_cents + overage_cents).sum() / 100:,.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/bench_worker_startup.py
+
+import subprocess
+import statistics
+import argparse
+import time
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rq import Queue  # noqa: E402
+
+"""
+Benchmark of what a background job pays before it runs.
+Times a fresh process building the full web app, as app/tasks.py used to, against the worker app,
+then optionally runs the same jobs through a plain forking rq worker and both modes of app/worker.py.
+Uses `instance/config.py`, and the Redis it names for `--jobs`:
+
+    python benchmarks/bench_worker_startup.py --runs 20
+    python benchmarks/bench_worker_startup.py --runs 20 --jobs 200
+"""
+
+BENCH_QUEUE = 'ann_bench'
+STARTUPS = {
+    'web app': 'from app import create_app; create_app()',
+    'worker app': 'import app.tasks',
+}
+WORKERS = {
+    # What `rq worker` does: every work horse imports the tasks, which built the app, for itself
+    'rq worker': (
+        "from rq import Worker, Queue; from redis import Redis; import instance.config as cfg\n"
+        "redis = Redis.from_url(getattr(cfg, 'REDIS_URL', 'redis://'))\n"
+        f"Worker([Queue('{BENCH_QUEUE}', connection=redis)], connection=redis).work(burst=True)"
+    ),
+    'app.worker --fork': f"from app import worker; worker.run(['{BENCH_QUEUE}'], fork=True, burst=True)",
+    'app.worker': f"from app import worker; worker.run(['{BENCH_QUEUE}'], burst=True)",
+}
+
+
+def timed(code):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def startup(runs):
+    for name, code in STARTUPS.items():
+        timings = [timed(code) * 1000 for _ in range(runs)]
+        print(f"{name:>20}: mean {statistics.mean(timings):7.1f} ms, min {min(timings):7.1f} ms")
+
+
+def jobs(count):
+    from app.worker import create_worker_app
+    app = create_worker_app()
+    queue = Queue(BENCH_QUEUE, connection=app.redis)
+    for name, code in WORKERS.items():
+        queue.empty()
+        for _ in range(count):
+            # A real job that reads the database: expires nobody on an up to date install
+            queue.enqueue('app.tasks.sweep_expired_subscriptions')
+        elapsed = timed(code)
+        print(f"{name:>20}: {count} jobs in {elapsed:6.2f}s, {elapsed / count * 1000:7.1f} ms per job")
+    queue.empty()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare web app and worker app start up and job overhead.')
+    parser.add_argument('--runs', type=int, default=10, help='fresh processes started per app')
+    parser.add_argument('--jobs', type=int, default=0, help='jobs run per worker mode, needs Redis')
+    args = parser.parse_args()
+    startup(args.runs)
+    if args.jobs:
+        jobs(args.jobs)
@@ -0,0 +1,143 @@
+# benchmarks/fake_olt.py
+
+import argparse
+import threading
+import socket
+import random
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paramiko  # noqa: E402
+
+"""
+A local SSH server that behaves like an OLT command line, for trying out and timing app.provisioning
+without network equipment. Every command gets a reply and a fresh 'OLT#' prompt after a small delay;
+commands containing 'bad' get an error
+
+    python benchmarks/fake_olt.py --port 2222
+    python benchmarks/fake_olt.py --port 2222 --bench 5000
+"""
+
+PROMPT = 'OLT#'
+
+
+class FakeOltServer(paramiko.ServerInterface):
+    def __init__(self):
+        self.shell_requested = threading.Event()
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_requested.set()
+        return True
+
+
+def serve_shell(channel, delay):
+    channel.sendall(f'Welcome\r\n{PROMPT} '.encode())
+    buffer = b''
+    while True:
+        data = channel.recv(65536)
+        if not data:
+            break
+        buffer += data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            command = line.decode().strip()
+            time.sleep(random.uniform(0, 2 * delay))
+            reply = 'Failure: unknown ONT' if 'bad' in command else 'success'
+            channel.sendall(f'{command}\r\n  {reply}\r\n{PROMPT} '.encode())
+    channel.close()
+
+
+def handle(client, host_key, delay):
+    transport = paramiko.Transport(client)
+    transport.add_server_key(host_key)
+    server = FakeOltServer()
+    transport.start_server(server=server)
+    channel = transport.accept(20)
+    if channel is None:
+        transport.close()
+        return
+    server.shell_requested.wait(10)
+    serve_shell(channel, delay)
+
+
+def start(port=0, delay=0.002):
+    """
+    Serve in background threads
+    :return: the port listened on
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(100)
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            threading.Thread(target=handle, args=(client, host_key, delay), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def bench(port, onts, olts):
+    """
+    Suspend and resume `onts` ONTs spread over `olts` fake OLTs through app.provisioning
+    """
+    from flask import Flask
+    from app import provisioning
+    app = Flask(__name__)
+    app.config.update(
+        OLTS={
+            f'olt-{i}': {'host': '127.0.0.1', 'port': port, 'username': 'admin', 'password': 'admin',
+                         'prompt': PROMPT, 'trust_unknown_host': True, 'pool_size': 2}
+            for i in range(olts)
+        },
+        OLT_COMMANDS=provisioning.DEFAULT_COMMANDS, OLT_BATCH_SIZE=50, OLT_WORKERS=2 * olts, OLT_RETRIES=0,
+    )
+    targets = [(f'olt-{i % olts}', f'0/1/{i % 16} {i}') for i in range(onts)]
+    with app.app_context():
+        for action in ('suspend', 'resume'):
+            started = time.perf_counter()
+            results = provisioning.provision(action, targets)
+            elapsed = time.perf_counter() - started
+            failed = sum(not result.ok for result in results)
+            print(f"{action}: {len(results)} ONTs in {elapsed:.2f}s, {failed} failed, "
+                  f"{provisioning.latency_report(results)}")
+        provisioning.close_pools()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OLT SSH server')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--delay', type=float, default=0.002, help='Average seconds taken per command')
+    parser.add_argument('--bench', type=int, default=0, help='Provision this many ONTs against the server and exit')
+    parser.add_argument('--olts', type=int, default=4, help='OLTs the benchmark spreads ONTs over')
+    args = parser.parse_args()
+
+    port = start(args.port, args.delay)
+    if args.bench:
+        bench(port, args.bench, args.olts)
+        return
+    print(f"Fake OLT listening on 127.0.0.1:{port}")
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
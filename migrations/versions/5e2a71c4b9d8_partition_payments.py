@@ -0,0 +1,111 @@
+"""partition payments by month
+
+Revision ID: 5e2a71c4b9d8
+Revises: 3b9e0c5f71d2
+Create Date: 2021-04-06 15:27:03.914562
+
+"""
+from alembic import op
+from datetime import datetime
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2a71c4b9d8'
+down_revision = '3b9e0c5f71d2'
+branch_labels = None
+depends_on = None
+
+# Partitions created after the current month, as the PAYMENTS_PARTITIONS_AHEAD default
+PARTITIONS_AHEAD = 2
+# Date given to payments saved without one, the primary key of a partitioned table can't be null
+UNKNOWN_DATE = '1970-01-01'
+
+COLUMNS = 'code, sender, creation_date, amount_cents, "User", scheduled_task_id'
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    op.create_table('payment_archives',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('payments', sa.Integer(), nullable=False),
+    sa.Column('amount_cents', sa.BigInteger(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('month')
+    )
+
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        # SQLite has no partitions, closed months are deleted from the table once archived
+        return
+
+    # PostgreSQL: copy the payments into a table partitioned by month.
+    # The partition key has to be part of the primary key, codes stay unique within a month
+    op.execute('ALTER TABLE payments RENAME TO payments_unpartitioned')
+    op.execute('ALTER INDEX payments_pkey RENAME TO payments_unpartitioned_pkey')
+    op.execute('ALTER INDEX ix_payments_creation_date RENAME TO ix_payments_unpartitioned_creation_date')
+    op.execute('ALTER INDEX ix_payments_user_creation_date RENAME TO ix_payments_unpartitioned_user_creation_date')
+    op.execute("""
+        CREATE TABLE payments (
+            code TEXT NOT NULL,
+            sender TEXT,
+            creation_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            amount_cents INTEGER NOT NULL DEFAULT 0,
+            "User" VARCHAR(16) REFERENCES users (telephone) ON DELETE CASCADE ON UPDATE CASCADE,
+            scheduled_task_id VARCHAR(36),
+            PRIMARY KEY (code, creation_date)
+        ) PARTITION BY RANGE (creation_date)
+    """)
+    op.execute('CREATE TABLE payments_default PARTITION OF payments DEFAULT')
+
+    oldest = bind.execute(sa.text('SELECT min(creation_date) FROM payments_unpartitioned')).scalar()
+    # A partition for every month with payments, up to the ones the archiver would create
+    month = add_months(min(oldest or datetime.now(), datetime.now()), 0)
+    last = add_months(datetime.now(), PARTITIONS_AHEAD)
+    while month <= last:
+        bind.execute(sa.text(
+            f"CREATE TABLE payments_{month:%Y_%m} PARTITION OF payments FOR VALUES FROM (:start) TO (:end)"
+        ), {'start': month, 'end': add_months(month, 1)})
+        month = add_months(month, 1)
+
+    op.execute(f"""
+        INSERT INTO payments ({COLUMNS})
+        SELECT code, sender, COALESCE(creation_date, '{UNKNOWN_DATE}'), amount_cents, "User", scheduled_task_id
+        FROM payments_unpartitioned
+    """)
+    op.execute('DROP TABLE payments_unpartitioned')
+    op.create_index('ix_payments_creation_date', 'payments', ['creation_date'], unique=False)
+    op.create_index('ix_payments_user_creation_date', 'payments', ['User', 'creation_date'], unique=False)
+
+
+def downgrade():
+    # Archived months stay in the archive, only the payments still in the table are kept
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('ALTER TABLE payments RENAME TO payments_partitioned')
+        op.execute('ALTER INDEX payments_pkey RENAME TO payments_partitioned_pkey')
+        op.execute('ALTER INDEX ix_payments_creation_date RENAME TO ix_payments_partitioned_creation_date')
+        op.execute('ALTER INDEX ix_payments_user_creation_date RENAME TO ix_payments_partitioned_user_creation_date')
+        op.execute("""
+            CREATE TABLE payments (
+                code TEXT NOT NULL PRIMARY KEY,
+                sender TEXT,
+                creation_date TIMESTAMP WITHOUT TIME ZONE,
+                amount_cents INTEGER NOT NULL DEFAULT 0,
+                "User" VARCHAR(16) REFERENCES users (telephone) ON DELETE CASCADE ON UPDATE CASCADE,
+                scheduled_task_id VARCHAR(36)
+            )
+        """)
+        op.execute(f"""
+            INSERT INTO payments ({COLUMNS})
+            SELECT DISTINCT ON (code) {COLUMNS} FROM payments_partitioned ORDER BY code, creation_date
+        """)
+        op.execute('DROP TABLE payments_partitioned CASCADE')
+        op.create_index('ix_payments_creation_date', 'payments', ['creation_date'], unique=False)
+        op.create_index('ix_payments_user_creation_date', 'payments', ['User', 'creation_date'], unique=False)
+
+    op.drop_table('payment_archives')
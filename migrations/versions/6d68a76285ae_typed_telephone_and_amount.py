@@ -0,0 +1,109 @@
+"""typed telephone and amount
+
+Revision ID: 6d68a76285ae
+Revises: 8ddc5d48de91
+Create Date: 2021-03-04 09:41:27.530114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import phonenumbers
+
+
+# revision identifiers, used by Alembic.
+revision = '6d68a76285ae'
+down_revision = '8ddc5d48de91'
+branch_labels = None
+depends_on = None
+
+# Rows converted per round trip
+BATCH_SIZE = 5000
+
+payments = sa.table(
+    'payments',
+    sa.column('code', sa.Text()),
+    sa.column('amount', sa.Text()),
+    sa.column('amount_cents', sa.Integer()),
+    sa.column('User', sa.String()),
+)
+
+
+def to_e164(telephone):
+    try:
+        phone = phonenumbers.parse(str(telephone), "KE")
+    except phonenumbers.NumberParseException:
+        return telephone
+    return phonenumbers.format_number(phone, phonenumbers.PhoneNumberFormat.E164)
+
+
+def to_cents(amount):
+    try:
+        return int(round(float(str(amount).split("h")[-1].replace(',', '') or 0) * 100))
+    except ValueError:
+        return 0
+
+
+def upgrade():
+    bind = op.get_bind()
+    old_telephone_type = sa.Integer() if bind.dialect.name == 'sqlite' else sa.String(length=60)
+
+    # Users: telephone is stored as an E.164 string.
+    # SQLite kept the digits of '+2547...' as an integer, so the '+' is put back
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('telephone', existing_type=old_telephone_type,
+                              type_=sa.String(length=16), existing_nullable=False)
+        batch_op.drop_index('ix_users_date_paid')
+        batch_op.create_index('ix_users_paid_date_paid', ['paid', 'date_paid'], unique=False)
+    op.execute("UPDATE users SET telephone = '+' || telephone WHERE telephone NOT LIKE '+%'")
+
+    # Payments: amount in integer cents and the payer's telephone in E.164
+    with op.batch_alter_table('payments') as batch_op:
+        batch_op.add_column(sa.Column('amount_cents', sa.Integer(), nullable=False, server_default='0'))
+
+    statement = payments.update().where(payments.c.code == sa.bindparam('_code')).values(
+        amount_cents=sa.bindparam('amount_cents'), User=sa.bindparam('User'),
+    )
+    last_code = ''
+    while True:
+        # Page through payments by primary key so memory use stays flat
+        rows = bind.execute(
+            sa.select([payments.c.code, payments.c.amount, payments.c.User])
+            .where(payments.c.code > last_code).order_by(payments.c.code).limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        bind.execute(statement, [
+            {'_code': code, 'amount_cents': to_cents(amount), 'User': to_e164(telephone) if telephone else telephone}
+            for code, amount, telephone in rows
+        ])
+        last_code = rows[-1][0]
+
+    with op.batch_alter_table('payments') as batch_op:
+        batch_op.drop_column('amount')
+        batch_op.alter_column('User', existing_type=sa.String(length=60), type_=sa.String(length=16),
+                              existing_nullable=True)
+        batch_op.create_index('ix_payments_creation_date', ['creation_date'], unique=False)
+        batch_op.create_index('ix_payments_user_creation_date', ['User', 'creation_date'], unique=False)
+
+
+def downgrade():
+    bind = op.get_bind()
+    old_telephone_type = sa.Integer() if bind.dialect.name == 'sqlite' else sa.String(length=60)
+
+    with op.batch_alter_table('payments') as batch_op:
+        batch_op.drop_index('ix_payments_user_creation_date')
+        batch_op.drop_index('ix_payments_creation_date')
+        batch_op.alter_column('User', existing_type=sa.String(length=16), type_=sa.String(length=60),
+                              existing_nullable=True)
+        batch_op.add_column(sa.Column('amount', sa.Text(), nullable=True))
+    op.execute("UPDATE payments SET amount = 'Ksh' || printf('%.2f', amount_cents / 100.0)"
+               if bind.dialect.name == 'sqlite' else
+               "UPDATE payments SET amount = 'Ksh' || to_char(amount_cents / 100.0, 'FM999999990.00')")
+    with op.batch_alter_table('payments') as batch_op:
+        batch_op.drop_column('amount_cents')
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_index('ix_users_paid_date_paid')
+        batch_op.create_index('ix_users_date_paid', ['date_paid'], unique=False)
+        batch_op.alter_column('telephone', existing_type=sa.String(length=16),
+                              type_=old_telephone_type, existing_nullable=False)
@@ -17,6 +17,9 @@ depends_on = None
 
 
 def upgrade():
+    # PostgreSQL refuses a foreign key from payments.User (string) to an integer telephone.
+    # SQLite installs keep the type they were created with
+    telephone_type = sa.Integer() if op.get_bind().dialect.name == 'sqlite' else sa.String(length=60)
     # ### commands auto generated by Alembic - please adjust! ###
     op.create_table('scheduled_tasks',
     sa.Column('id', sa.String(length=36), nullable=False),
@@ -32,7 +35,7 @@ def upgrade():
     sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
     sa.Column('username', sa.Text(), nullable=False),
     sa.Column('password_hash', sa.Text(), nullable=False),
-    sa.Column('telephone', sa.Integer(), nullable=False),
+    sa.Column('telephone', telephone_type, nullable=False),
     sa.Column('paid', sa.Boolean(), nullable=False),
     sa.Column('date_paid', sa.DateTime(), nullable=True),
     sa.Column('creation_date', sa.DateTime(), nullable=True),
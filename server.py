@@ -1,6 +1,7 @@
 # server.py
 
 from app import create_app
+import click
 
 """
 This module shall be the starting up of the web app
@@ -9,6 +10,251 @@ This module shall be the starting up of the web app
 
 app = create_app()
 
+
+@app.cli.command('schedule-sweeper')
+def schedule_sweeper():
+    """Register the periodic subscription expiry sweeper."""
+    from app.scheduling import schedule_expiry_sweeper
+    task = schedule_expiry_sweeper()
+    click.echo(f"Expiry sweeper scheduled every {task.interval} seconds")
+
+
+@app.cli.command('schedule-reconciler')
+def schedule_reconciler():
+    """Register the periodic removal of orphaned scheduler jobs."""
+    from app.scheduling import schedule_reconciler as schedule
+    task = schedule()
+    click.echo(f"Scheduler reconciler scheduled every {task.interval} seconds")
+
+
+@app.cli.command('reconcile-scheduler')
+def reconcile_scheduler():
+    """Remove scheduler jobs that no scheduled task accounts for."""
+    from app.scheduling import reconcile
+    removed, stale = reconcile()
+    click.echo(f"Removed {removed} orphaned jobs, marked {stale} tasks cancelled")
+
+
+@app.cli.command('schedule-archiver')
+def schedule_archiver():
+    """Register the periodic creation of payment partitions and archiving of closed months."""
+    from app.scheduling import schedule_archiver as schedule
+    task = schedule()
+    click.echo(f"Payments archiver scheduled every {task.interval} seconds")
+
+
+@app.cli.command('schedule-ledger-snapshots')
+def schedule_ledger_snapshots():
+    """Register the periodic update of the subscribers' balance snapshots."""
+    from app.scheduling import schedule_ledger_snapshots as schedule
+    task = schedule()
+    click.echo(f"Balance snapshots scheduled every {task.interval} seconds")
+
+
+@app.cli.command('schedule-reminders')
+def schedule_reminders():
+    """Register the periodic reminders of subscriptions ending soon."""
+    from app.scheduling import schedule_reminders as schedule
+    task = schedule()
+    click.echo(f"Reminders scheduled every {task.interval} seconds")
+
+
+@app.cli.command('send-reminders')
+@click.option('--days', type=int, default=None, help='Remind subscriptions ending within this many days')
+def send_reminders(days):
+    """Queue the reminders of subscriptions ending soon now."""
+    from app.notifications import fan_out
+    due, queued = fan_out(days)
+    click.echo(f"{due} subscriptions ending soon, queued {queued} reminders")
+
+
+@app.cli.command('scheduler')
+@click.option('--interval', type=int, default=None, help='Seconds between checks for due jobs')
+def scheduler(interval):
+    """Run the scheduler on whichever node holds the scheduler lease."""
+    from app.leader import run_scheduler
+    run_scheduler(interval)
+
+
+@app.cli.command('queue-status')
+def queue_status():
+    """Show the jobs in each queue and the node running the scheduler."""
+    from app.queues import depths
+    from app.leader import holder
+    for name, (queued, started, failed) in depths().items():
+        click.echo(f"{name}: {queued} queued, {started} running, {failed} failed")
+    click.echo(f"Scheduler: {holder('scheduler') or 'no leader'}")
+
+
+@app.cli.command('retire-payment-jobs')
+def retire_payment_jobs():
+    """Cancel the old per-subscriber check_payment_status jobs."""
+    from app.scheduling import retire_payment_jobs as retire
+    click.echo(f"Cancelled {retire()} per-subscriber payment jobs")
+
+
+@app.cli.command('expiry-worker')
+@click.option('--max-sleep', default=60, help='Longest time to sleep between checks, in seconds')
+def expiry_worker(max_sleep):
+    """Expire subscriptions exactly when they end."""
+    from app.subscriptions import run_expiry_worker
+    run_expiry_worker(max_sleep)
+
+
+@app.cli.command('rebuild-expiry-index')
+def rebuild_expiry_index():
+    """Index the expiry time of every paid subscriber."""
+    from app.subscriptions import rebuild_expiry_index as rebuild
+    click.echo(f"Indexed {rebuild()} paid subscribers")
+
+
+@app.cli.command('payments-worker')
+@click.option('--name', default=None, help='Consumer name, defaults to the host name')
+@click.option('--batch-size', default=500, help='Most payments saved per transaction')
+def payments_worker(name, batch_size):
+    """Save the M-Pesa callbacks queued by /receiver."""
+    from app.ingest import run_consumer
+    run_consumer(name, batch_size)
+
+
+@app.cli.command('import-statement')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--unmatched', default=None, help='CSV file for transactions of unregistered telephones')
+@click.option('--chunk-size', default=5000, help='Payments inserted per statement')
+def import_statement(path, unmatched, chunk_size):
+    """Rebuild payments from an M-Pesa statement export (CSV or JSON)."""
+    from app.statements import import_statement as run_import
+    import time
+    started = time.perf_counter()
+    report = run_import(path, unmatched, chunk_size)
+    click.echo(
+        f"{report['rows']} rows in {time.perf_counter() - started:.1f}s: {report['inserted']} inserted, "
+        f"{report['duplicates']} already saved, {report['invalid']} invalid, {report['unmatched']} unmatched"
+    )
+    if report['unmatched']:
+        click.echo(f"Unmatched transactions written to {unmatched or path + '.unmatched.csv'}")
+
+
+@app.cli.command('ingest-usage')
+@click.argument('files', nargs=-1, type=click.File('r'))
+def ingest_usage(files):
+    """Save ONT traffic samples from files, or from stdin when none are given."""
+    from app.metering import ingest
+    import sys
+    for file in files or [sys.stdin]:
+        report = ingest(file)
+        click.echo(f"{file.name}: {report['samples']} samples into {report['buckets']} buckets, "
+                   f"{report['unknown']} from unknown ONTs")
+
+
+def month_period(month):
+    from datetime import datetime
+    start = datetime.strptime(month, '%Y-%m')
+    end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start, end
+
+
+@app.cli.command('rate-usage')
+@click.option('--month', required=True, help='Month to rate, e.g. 2021-03')
+def rate_usage(month):
+    """Rate a month of usage against the subscribers' plans."""
+    from app.metering import rate_usage as rate
+    import time
+    start, end = month_period(month)
+    started = time.perf_counter()
+    rating = rate(start, end)
+    click.echo(f"Rated {len(rating.user_ids)} subscribers in {time.perf_counter() - started:.2f}s: "
+               f"{rating.used_bytes.sum() / 1e9:.1f} GB used, "
+               f"overage Ksh{rating.overage_cents.sum() / 100:.2f}, total Ksh{rating.total_cents.sum() / 100:.2f}")
+
+
+@app.cli.command('archive-payments')
+@click.option('--month', default=None, help='Month to archive, e.g. 2021-03. Defaults to every closed month')
+def archive_payments(month):
+    """Create the coming payment partitions and move closed months to the archive."""
+    from app import archive
+    click.echo(f"Created {archive.ensure_partitions()} partitions")
+    if month:
+        start = month_period(month)[0]
+        archived = {start: archive.archive_month(start)}
+    else:
+        archived = archive.archive_closed_months()
+    for start, payments in archived.items():
+        click.echo(f"{start:%Y-%m}: archived {payments} payments")
+
+
+@app.cli.command('audit-payments')
+@click.option('--start', 'start_month', required=True, help='First month, e.g. 2020-01')
+@click.option('--end', 'end_month', default=None, help='Last month, defaults to the first one')
+@click.option('--telephone', default=None, help="Only this subscriber's payments")
+@click.option('--code', default=None, help='Only the payment with this M-Pesa code')
+def audit_payments(start_month, end_month, telephone, code):
+    """List archived payments."""
+    from app.phones import process_telephone
+    from app.archive import find_payments
+    start, end = month_period(start_month)[0], month_period(end_month or start_month)[1]
+    payments = find_payments(start, end, process_telephone(telephone) if telephone else None, code)
+    for payment in payments:
+        click.echo(f"{payment['creation_date']:%Y-%m-%d %H:%M:%S} {payment['code']} {payment['source']} "
+                   f"Ksh{payment['amount_cents'] / 100:.2f} {payment['sender']}")
+    click.echo(f"{len(payments)} payments, Ksh{sum(payment['amount_cents'] for payment in payments) / 100:.2f}")
+
+
+@app.cli.command('open-ledger')
+def open_ledger():
+    """Open the ledger account of every subscriber, paid until their current deadline."""
+    from app.ledger import open_accounts
+    click.echo(f"Opened {open_accounts()} accounts")
+
+
+@app.cli.command('snapshot-ledger')
+def snapshot_ledger():
+    """Bring the subscribers' balance snapshots up to date."""
+    from app.ledger import snapshot
+    click.echo(f"Updated {snapshot()} balance snapshots")
+
+
+@app.cli.command('rebuild-reports')
+def rebuild_reports():
+    """Recount the daily payment and signup counters from the payments and users tables."""
+    from app.reporting import rebuild
+    click.echo(f"Rebuilt the counters of {rebuild()} days")
+
+
+@app.cli.command('billing-run')
+@click.option('--month', required=True, help='Month to bill, e.g. 2021-03')
+@click.option('--shards', default=16, help='Number of jobs the subscribers are split into')
+@click.option('--restart', is_flag=True, help='Bill every shard again, even those already done')
+def billing_run(month, shards, restart):
+    """Queue the invoice jobs of a month, skipping shards already billed."""
+    from app.billing import start_run, BillingError
+    from app.archive import is_archived
+    start, end = month_period(month)
+    if is_archived(start):
+        click.echo("The month's payments are archived, it can no longer be billed")
+        return
+    try:
+        queued = start_run(start, end, shards, restart)
+    except BillingError as err:
+        click.echo(str(err))
+        return
+    click.echo(f"Queued {queued} of {shards} shards")
+
+
+@app.cli.command('billing-status')
+@click.option('--month', required=True, help='Billed month, e.g. 2021-03')
+def billing_status(month):
+    """Show the progress and throughput of a billing run."""
+    from app.billing import run_status
+    status = run_status(month_period(month)[0])
+    if not status:
+        click.echo("No billing run for that month")
+        return
+    rate = status['invoices_per_second']
+    click.echo(f"{status['shards_done']}/{status['shards']} shards, {status['invoices']} invoices "
+               f"in {status['wall_seconds']:.1f}s" + (f", {rate:.0f} invoices/s" if rate else ''))
+
+
 # route different pages
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')